@@ -0,0 +1,130 @@
+# soft block with a small stiff box: uniform substeps at the stiff region's stable
+# dt vs multi-rate subcycling, particle updates per simulated second and wall time,
+# and the total momentum drift of both without gravity and colliders
+# usage: python benchmarks/bench_multirate.py [device] [num_particles] [stiffness_ratio]
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "mpm_solver_warp")
+)
+
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+
+wp.init()
+
+E_soft = 1e4
+
+
+def build_solver(n, ratio, device, free=False):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x.to(device), torch.ones(n, device=device) * 1e-6, n_grid=32, device=device
+    )
+    solver.set_parameters_dict(
+        {
+            "material": "jelly",
+            "E": E_soft,
+            "nu": 0.3,
+            "density": 100.0,
+            "g": [0.0, 0.0, 0.0] if free else [0.0, 0.0, -9.8],
+            "additional_material_params": [
+                {
+                    "point": [0.4, 0.4, 0.4],
+                    "size": [0.05, 0.05, 0.05],
+                    "density": 100.0,
+                    "E": E_soft * ratio,
+                    "nu": 0.3,
+                }
+            ],
+        },
+        device=device,
+    )
+    solver.finalize_mu_lam(device=device)
+    if free:
+        # random velocities, the total momentum must stay where it starts
+        solver.import_particle_v_from_torch(
+            (torch.randn(n, 3) * 0.1).to(device), device=device
+        )
+    else:
+        solver.add_surface_collider([0.0, 0.0, 0.3], [0.0, 0.0, 1.0], surface="slip")
+    return solver
+
+
+def get_momentum(solver):
+    mass = wp.to_torch(solver.mpm_state.particle_mass).double()
+    v = wp.to_torch(solver.mpm_state.particle_v).double()
+    return (mass[:, None] * v).sum(dim=0).cpu()
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    ratio = float(sys.argv[3]) if len(sys.argv) > 3 else 256.0
+    sim_time = 0.05
+
+    solver = build_solver(n, ratio, device)
+    stiff_dt = solver.get_cfl_substep_dt()
+    # the soft region's stable substep, with some room for |v|
+    coarse_dt = 0.8 * stiff_dt * 2 ** round(0.5 * torch.log2(torch.tensor(ratio)).item())
+    n_coarse = int(sim_time / coarse_dt)
+    n_fine = int(round(n_coarse * coarse_dt / stiff_dt))
+
+    # warm up the kernels
+    solver.p2g2p(0, stiff_dt, device=device)
+    solver.p2g2p_multirate(0, coarse_dt, device=device)
+
+    solver = build_solver(n, ratio, device)
+    wp.synchronize()
+    start = time.time()
+    for step in range(n_fine):
+        solver.p2g2p(step, stiff_dt, device=device)
+    wp.synchronize()
+    uniform_time = time.time() - start
+    uniform_x = solver.export_particle_x_to_torch().clone().cpu()
+
+    solver = build_solver(n, ratio, device)
+    wp.synchronize()
+    start = time.time()
+    for step in range(n_coarse):
+        solver.p2g2p_multirate(step, coarse_dt, device=device)
+    wp.synchronize()
+    multirate_time = time.time() - start
+    multirate_x = solver.export_particle_x_to_torch().clone().cpu()
+    levels = [rate_class is not None for rate_class in solver.rate_classes]
+
+    print(f"{n} particles, stiff box E x{ratio:g}, {sim_time} s simulated")
+    print(f"rate levels present: {[l for l, present in enumerate(levels) if present]}")
+    print(f"{'':<12}{'substep':>12}{'updates/s':>14}{'wall s':>10}")
+    print(f"{'uniform':<12}{stiff_dt:>12.3e}{n * n_fine / sim_time:>14.3e}{uniform_time:>10.2f}")
+    print(
+        f"{'multi-rate':<12}{coarse_dt:>12.3e}"
+        f"{solver.multirate_particle_updates / sim_time:>14.3e}{multirate_time:>10.2f}"
+    )
+    difference = torch.linalg.norm(multirate_x - uniform_x, dim=1)
+    print(
+        f"position difference to uniform: mean {difference.mean():.2e}, "
+        f"max {difference.max():.2e} (dx {solver.mpm_model.dx:.2e})"
+    )
+
+    steps = 20
+    print(f"momentum drift after {steps} coarse steps, no gravity or colliders:")
+    for name in ["uniform", "multi-rate"]:
+        solver = build_solver(n, ratio, device, free=True)
+        start_momentum = get_momentum(solver)
+        for step in range(steps):
+            if name == "uniform":
+                for substep in range(round(coarse_dt / stiff_dt)):
+                    solver.p2g2p(step, stiff_dt, device=device)
+            else:
+                solver.p2g2p_multirate(step, coarse_dt, device=device)
+        drift = torch.linalg.norm(get_momentum(solver) - start_momentum).item()
+        print(
+            f"{name:<12}{drift:>12.3e}"
+            f" (|p| {torch.linalg.norm(start_momentum).item():.3e})"
+        )
@@ -0,0 +1,70 @@
+# throughput of the stress pass per material, svd vs warm-started polar rotation,
+# and accuracy of the exported rotation against svd
+# usage: python benchmarks/bench_polar.py [device] [num_particles] [material,material,...]
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "mpm_solver_warp")
+)
+
+import numpy as np
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+
+wp.init()
+
+materials = sys.argv[3].split(",") if len(sys.argv) > 3 else ["jelly", "metal", "sand", "foam", "plasticine"]
+
+
+def build_solver(material, polar_rotation, n, device):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x.to(device), torch.ones(n, device=device) * 1e-6, n_grid=64, device=device
+    )
+    solver.set_parameters_dict(
+        {
+            "material": material,
+            "E": 2e4,
+            "nu": 0.3,
+            "density": 100.0,
+            "yield_stress": 1e3,
+            "hardening": 0,
+            "xi": 0.0,
+            "g": [0.0, 0.0, -9.8],
+            "polar_rotation": polar_rotation,
+        },
+        device=device,
+    )
+    solver.finalize_mu_lam(device=device)
+    # spin the block so F carries a real rotation
+    v = torch.cross(
+        torch.tensor([0.0, 0.0, 20.0]).expand_as(x), x - 0.5, dim=1
+    ).contiguous()
+    solver.import_particle_v_from_torch(v.to(device), device=device)
+    return solver
+
+
+def run(material, polar_rotation, n, device, steps=200):
+    solver = build_solver(material, polar_rotation, n, device)
+    for step in range(steps):
+        solver.p2g2p(step, 1e-4, device=device)
+    stress_ms = np.mean(solver.time_profile["compute_stress_from_F_trial"][steps // 2 :])
+    R = solver.export_particle_R_to_torch(device=device).clone().cpu().double()
+    return stress_ms, R
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cuda:0"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+    print(f"{n} particles on {device}, compute_stress_from_F_trial per substep")
+    print(f"{'material':<12}{'svd ms':>10}{'polar ms':>10}{'speedup':>10}{'max |dR|':>12}")
+    for material in materials:
+        svd_ms, R_svd = run(material, 0, n, device)
+        polar_ms, R_polar = run(material, 1, n, device)
+        dR = (R_svd - R_polar).abs().max().item()
+        print(f"{material:<12}{svd_ms:>10.3f}{polar_ms:>10.3f}{svd_ms / polar_ms:>10.2f}{dR:>12.2e}")
@@ -0,0 +1,101 @@
+# wall time of simulate-then-render per frame vs RenderPipeline, which renders
+# frame n on a worker thread while frame n + 1 is simulated, with the measured
+# overlap; the renderer is a torch splatting stand-in, so this runs on CPU
+# usage: python benchmarks/bench_render_pipeline.py [device] [num_particles] [frames] [image_size]
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(root, "mpm_solver_warp"))
+sys.path.append(root)
+
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+from utils.render_pipeline import RenderPipeline
+
+wp.init()
+
+
+def make_solver(n, device):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x.to(device), torch.ones(n, device=device) * 1e-6, n_grid=64, device=device
+    )
+    solver.set_parameters_dict(
+        {
+            "material": "jelly",
+            "E": 2e4,
+            "nu": 0.3,
+            "density": 100.0,
+            "g": [0.0, 0.0, -9.8],
+        },
+        device=device,
+    )
+    solver.finalize_mu_lam(device=device)
+    solver.add_surface_collider([0.0, 0.0, 0.3], [0.0, 0.0, 1.0], surface="slip")
+    return solver
+
+
+# splats the particles into an image, weighted by the trace of their covariance
+def make_renderer(size, images):
+    def render(frame, particles):
+        with torch.inference_mode():
+            pos, cov3D = particles["pos"], particles["cov3D"]
+            pixel = (pos[:, :2].clamp(0, 1 - 1e-6) * size).long()
+            weight = torch.exp(-(cov3D[:, 0] + cov3D[:, 3] + cov3D[:, 5]) * 1e4)
+            image = torch.zeros(size * size, device=pos.device)
+            image.index_add_(0, pixel[:, 0] * size + pixel[:, 1], weight)
+            image = image.view(1, 1, size, size)
+            for _ in range(4):
+                image = torch.nn.functional.avg_pool2d(image, 3, 1, 1)
+            images[frame] = image.sum().item()
+
+    return render
+
+
+def run(n, frames, size, device, pipelined, steps_per_frame=20):
+    solver = make_solver(n, device)
+    images = {}
+    render = make_renderer(size, images)
+    pipeline = RenderPipeline(render) if pipelined else None
+    start = time.perf_counter()
+    for frame in range(frames):
+        for step in range(steps_per_frame):
+            solver.p2g2p(frame, 1e-4, device=device)
+        particles = {
+            "pos": solver.export_particle_x_to_torch(),
+            "cov3D": solver.export_particle_cov_to_torch(device=device).view(-1, 6),
+        }
+        if pipeline is not None:
+            pipeline.submit(frame, particles)
+        else:
+            render(frame, particles)
+    stats = None
+    if pipeline is not None:
+        pipeline.close()
+        stats = pipeline.stats()
+    return time.perf_counter() - start, stats, images
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    frames = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    size = int(sys.argv[4]) if len(sys.argv) > 4 else 1024
+
+    serial_time, _, serial_images = run(n, frames, size, device, False)
+    pipelined_time, stats, images = run(n, frames, size, device, True)
+    same = all(
+        abs(images[f] - serial_images[f]) <= 1e-6 * abs(serial_images[f]) for f in images
+    )
+    print(f"{n} particles, {frames} frames, {size}x{size}, {os.cpu_count()} cores")
+    print(f"serial     {serial_time:8.2f}s")
+    print(
+        f"pipelined  {pipelined_time:8.2f}s  speedup {serial_time / pipelined_time:.2f}"
+        f"  simulation {stats['sim_time']:.2f}s  rendering {stats['render_time']:.2f}s"
+        f"  overlap {stats['overlap']:.0%}  same images {same}"
+    )
@@ -0,0 +1,56 @@
+# compare the batched Jacobi eigensolver with torch.svd for per-Gaussian normals
+# usage: python benchmarks/bench_sym_eig.py [num_gaussians]
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import torch
+from utils.sym_eig_utils import *
+
+
+def random_cov(n):
+    # gaussians from 3dgs are mostly thin disks with a tiny normal axis
+    q, _ = torch.linalg.qr(torch.randn(n, 3, 3))
+    scales = torch.rand(n, 3) * 1e-2
+    scales[:, 2] = scales[:, 2] * 1e-3
+    cov = q @ torch.diag_embed(scales * scales) @ q.transpose(1, 2)
+    return torch.stack(
+        [cov[:, 0, 0], cov[:, 0, 1], cov[:, 0, 2], cov[:, 1, 1], cov[:, 1, 2], cov[:, 2, 2]],
+        dim=-1,
+    )
+
+
+def svd_min_axis(cov3d_tensor):
+    rot_matrix, scales, _ = torch.svd(cov3d_tensor_to_matrix(cov3d_tensor))
+    return rot_matrix[:, :, 2]
+
+
+def timeit(fn, *args, repeat=5):
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    torch.manual_seed(0)
+    cov = random_cov(n)
+
+    t_svd = timeit(svd_min_axis, cov)
+    t_jacobi = timeit(get_min_variance_axis, cov)
+    t_inv = timeit(get_inverse_cov, cov)
+
+    # the min axis is only defined up to round-off when the two smallest variances
+    # are closer than float32 resolution of the largest one, skip those needles
+    eigvals, _ = sym_eig3x3(cov)
+    gap = (eigvals[:, 1] - eigvals[:, 0]) > 1e-4 * eigvals[:, 2]
+    err = 1.0 - (svd_min_axis(cov) * get_min_variance_axis(cov)).sum(-1).abs()[gap]
+    print(f"gaussians:              {n}")
+    print(f"torch.svd min axis:     {t_svd * 1e3:.1f} ms")
+    print(f"jacobi min axis:        {t_jacobi * 1e3:.1f} ms ({t_svd / t_jacobi:.1f}x)")
+    print(f"jacobi inverse cov:     {t_inv * 1e3:.1f} ms")
+    print(f"max 1-|cos| vs svd:     {err.max().item():.2e} ({gap.sum().item()} well-separated)")
@@ -0,0 +1,128 @@
+# size of the compact keyframe + quantized delta trajectory cache vs the plain
+# float32 one for a simulated trajectory, the largest error per field and the
+# time of a random frame read
+# usage: python benchmarks/bench_trajectory_format.py [device] [num_particles] [frames] [keyframe_interval,...]
+import os
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(root, "mpm_solver_warp"))
+sys.path.append(root)
+
+import numpy as np
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+from utils.trajectory_cache import (
+    CompactTrajectoryWriter,
+    TrajectoryReader,
+    TrajectoryWriter,
+)
+
+wp.init()
+
+
+def simulate(n, frames, device, steps_per_frame=20):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x.to(device),
+        torch.ones(n, device=device) * 1e-6,
+        torch.ones(n, 6, device=device) * 1e-5,
+        n_grid=64,
+        device=device,
+    )
+    solver.set_parameters_dict(
+        {
+            "material": "jelly",
+            "E": 2e4,
+            "nu": 0.3,
+            "density": 100.0,
+            "g": [0.0, 0.0, -9.8],
+        },
+        device=device,
+    )
+    solver.finalize_mu_lam(device=device)
+    solver.add_surface_collider([0.0, 0.0, 0.3], [0.0, 0.0, 1.0], surface="slip")
+    trajectory = []
+    for frame in range(frames):
+        for step in range(steps_per_frame):
+            solver.p2g2p(frame, 1e-4, device=device)
+        trajectory.append(
+            {
+                "pos": solver.export_particle_x_to_torch().clone(),
+                "cov3D": solver.export_particle_cov_to_torch(device=device)
+                .view(-1, 6)
+                .clone(),
+                "rot": solver.export_particle_R_to_torch(device=device)
+                .view(-1, 3, 3)
+                .clone(),
+            }
+        )
+    return trajectory
+
+
+def cache_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def measure(writer, trajectory, path, raw_size):
+    for frame, particles in enumerate(trajectory):
+        writer.write(frame, particles)
+    writer.close()
+    reader = TrajectoryReader(path)
+    errors = {
+        name: max(
+            (reader.read(frame)[name] - particles[name].cpu()).abs().max().item()
+            for frame, particles in enumerate(trajectory)
+        )
+        for name in ["pos", "cov3D", "rot"]
+    }
+    order = np.random.default_rng(0).permutation(len(trajectory))
+    start = time.perf_counter()
+    for frame in order:
+        reader.read(int(frame))
+    read_ms = (time.perf_counter() - start) / len(order) * 1000
+    size = cache_size(path)
+    return size, raw_size / size, errors, read_ms
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    frames = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+    intervals = [int(k) for k in sys.argv[4].split(",")] if len(sys.argv) > 4 else [10]
+
+    trajectory = simulate(n, frames, device)
+    path = tempfile.mkdtemp()
+    raw = TrajectoryWriter(os.path.join(path, "raw"), frames, {})
+    raw_size, _, _, raw_read_ms = measure(raw, trajectory, os.path.join(path, "raw"), 1)
+
+    print(f"{n} particles, {frames} frames")
+    print(
+        f"{'format':<22}{'MB':>9}{'ratio':>8}{'|dpos|':>11}{'|dcov|':>11}"
+        f"{'|drot|':>11}{'read ms':>10}"
+    )
+    print(
+        f"{'float32':<22}{raw_size / 2**20:>9.1f}{1.0:>8.2f}{0:>11}{0:>11}{0:>11}"
+        f"{raw_read_ms:>10.2f}"
+    )
+    for keyframe_interval in intervals:
+        for compress in [False, True]:
+            name = f"K={keyframe_interval}{' zlib' if compress else ''}"
+            cache = os.path.join(path, name.replace(" ", "_"))
+            writer = CompactTrajectoryWriter(
+                cache,
+                frames,
+                {},
+                keyframe_interval=keyframe_interval,
+                compress=compress,
+            )
+            size, ratio, errors, read_ms = measure(writer, trajectory, cache, raw_size)
+            print(
+                f"{name:<22}{size / 2**20:>9.1f}{ratio:>8.2f}{errors['pos']:>11.2e}"
+                f"{errors['cov3D']:>11.2e}{errors['rot']:>11.2e}{read_ms:>10.2f}"
+            )
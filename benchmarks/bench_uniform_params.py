@@ -0,0 +1,63 @@
+# stress pass with uniform material constants read from model scalars vs the
+# per-particle arrays, and the largest stress difference between the two
+# usage: python benchmarks/bench_uniform_params.py [device] [num_particles] [material,material,...]
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "mpm_solver_warp")
+)
+
+import numpy as np
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+
+wp.init()
+
+materials = sys.argv[3].split(",") if len(sys.argv) > 3 else ["jelly", "metal", "sand", "foam"]
+
+
+def run(material, uniform, n, device, steps=200):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x.to(device), torch.ones(n, device=device) * 1e-6, n_grid=64, device=device
+    )
+    solver.set_parameters_dict(
+        {
+            "material": material,
+            "E": 2e4,
+            "nu": 0.3,
+            "density": 100.0,
+            "yield_stress": 1e3,
+            "hardening": 0,
+            "xi": 0.0,
+            "g": [0.0, 0.0, -9.8],
+        },
+        device=device,
+    )
+    solver.finalize_mu_lam(device=device)
+    if not uniform:
+        solver.mpm_model.uniform_params = 0
+    v = torch.randn(n, 3).contiguous()
+    solver.import_particle_v_from_torch(v.to(device), device=device)
+    for step in range(steps):
+        solver.p2g2p(step, 1e-4, device=device)
+    stress_ms = np.mean(solver.time_profile["compute_stress_from_F_trial"][steps // 2 :])
+    return stress_ms, solver.mpm_state.particle_stress.numpy()
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cuda:0"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+    print(f"{'material':<12}{'arrays ms':>12}{'uniform ms':>12}{'speedup':>10}{'max |dstress|':>16}")
+    for material in materials:
+        array_ms, array_stress = run(material, False, n, device)
+        uniform_ms, uniform_stress = run(material, True, n, device)
+        print(
+            f"{material:<12}{array_ms:>12.3f}{uniform_ms:>12.3f}"
+            f"{array_ms / uniform_ms:>10.2f}{np.abs(array_stress - uniform_stress).max():>16.3e}"
+        )
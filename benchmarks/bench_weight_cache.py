@@ -0,0 +1,56 @@
+# p2g/g2p throughput with and without the per-particle B-spline weight cache,
+# its memory cost, and the largest position difference between the two
+# usage: python benchmarks/bench_weight_cache.py [device] [num_particles] [n_grid]
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "mpm_solver_warp")
+)
+
+import numpy as np
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+
+wp.init()
+
+
+def run(weight_cache, n, n_grid, device, steps=100):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x.to(device), torch.ones(n, device=device) * 1e-6, n_grid=n_grid, device=device
+    )
+    solver.set_parameters_dict(
+        {"material": "jelly", "E": 2e4, "nu": 0.3, "density": 100.0, "g": [0.0, 0.0, -9.8]},
+        device=device,
+    )
+    solver.finalize_mu_lam(device=device)
+    solver.enable_weight_cache(weight_cache, device=device)
+    for step in range(steps):
+        solver.p2g2p(step, 1e-4, device=device)
+    p2g_ms = np.mean(solver.time_profile["p2g"][steps // 2 :])
+    g2p_ms = np.mean(solver.time_profile["g2p"][steps // 2 :])
+    return p2g_ms, g2p_ms, solver.mpm_state.particle_x.numpy()
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cuda:0"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    n_grid = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+
+    p2g_ms, g2p_ms, x = run(False, n, n_grid, device)
+    cached_p2g_ms, cached_g2p_ms, cached_x = run(True, n, n_grid, device)
+    cache_mb = n * MPM_Simulator_WARP.weight_cache_bytes_per_particle / 2**20
+
+    print(f"{n} particles, grid {n_grid}^3, cache {cache_mb:.1f} MB")
+    print(f"{'':<10}{'p2g ms':>10}{'g2p ms':>10}{'total ms':>10}")
+    print(f"{'no cache':<10}{p2g_ms:>10.3f}{g2p_ms:>10.3f}{p2g_ms + g2p_ms:>10.3f}")
+    print(
+        f"{'cache':<10}{cached_p2g_ms:>10.3f}{cached_g2p_ms:>10.3f}"
+        f"{cached_p2g_ms + cached_g2p_ms:>10.3f}"
+    )
+    print(f"speedup {(p2g_ms + g2p_ms) / (cached_p2g_ms + cached_g2p_ms):.2f}x")
+    print(f"max |dx| {np.abs(x - cached_x).max():.3e}")
@@ -0,0 +1,127 @@
+# finite-difference check of compute_trajectory_gradients on a small cpu scene,
+# with and without substep checkpointing, also for metal without hardening, and
+# that every unsupported configuration is rejected up front
+# usage: python benchmarks/check_gradients.py [num_substeps] [checkpoint_every]
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "mpm_solver_warp")
+)
+
+import torch
+import warp as wp
+from mpm_solver_warp import MPM_Simulator_WARP
+
+wp.init()
+
+device = "cpu"
+n = 300
+dt = 1e-3
+
+
+def build_solver(E=1e4, nu=0.3, density=100.0, material="jelly", extra=None):
+    torch.manual_seed(0)
+    x = torch.rand(n, 3) * 0.4 + 0.3
+    v = torch.randn(n, 3) * 0.5
+    solver = MPM_Simulator_WARP(10, device=device)
+    solver.load_initial_data_from_torch(
+        x, torch.ones(n) * 1e-6, n_grid=16, device=device
+    )
+    params = {
+        "material": material,
+        "E": E,
+        "nu": nu,
+        "density": density,
+        "g": [0.0, 0.0, -9.8],
+    }
+    params.update(extra or {})
+    solver.set_parameters_dict(params, device=device)
+    solver.finalize_mu_lam(device=device)
+    solver.import_particle_v_from_torch(v, device=device)
+    return solver
+
+
+if __name__ == "__main__":
+    num_substeps = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    checkpoint_every = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    # observed trajectory from a stiffer material
+    reference = build_solver(E=1.3e4)
+    targets = {}
+    for step in range(num_substeps):
+        reference.p2g2p(step, dt, device=device)
+        if (step + 1) % 5 == 0:
+            targets[step + 1] = reference.export_particle_x_to_torch().clone()
+
+    def loss_and_grads(k, **kwargs):
+        return build_solver(**kwargs).compute_trajectory_gradients(
+            targets, dt, checkpoint_every=k, device=device
+        )
+
+    loss, grads = loss_and_grads(checkpoint_every)
+    _, grads_full = loss_and_grads(num_substeps)
+    print(f"loss {loss:.6e}, {num_substeps} substeps, checkpoint every {checkpoint_every}")
+    print(
+        "max |grad E| difference to the unchecked tape:",
+        (grads["E"] - grads_full["E"]).abs().max().item(),
+    )
+
+    # directional derivative along a uniform change of each parameter
+    def check_finite_differences(checkpoint_every, **kwargs):
+        _, grads = loss_and_grads(checkpoint_every, **kwargs)
+        print(f"{'param':<10}{'adjoint':>14}{'finite diff':>14}")
+        for name, value, h in [
+            ("E", 1e4, 2e2),
+            ("nu", 0.3, 1e-2),
+            ("density", 100.0, 2.0),
+        ]:
+            loss_plus, _ = loss_and_grads(
+                checkpoint_every, **{name: value + h}, **kwargs
+            )
+            loss_minus, _ = loss_and_grads(
+                checkpoint_every, **{name: value - h}, **kwargs
+            )
+            fd = (loss_plus - loss_minus) / (2.0 * h)
+            print(f"{name:<10}{grads[name].sum().item():>14.6e}{fd:>14.6e}")
+
+    print("jelly")
+    check_finite_differences(checkpoint_every)
+    # von Mises return mapping without hardening only reads yield_stress
+    print("metal, no hardening")
+    check_finite_differences(
+        checkpoint_every, material="metal", extra={"yield_stress": 2e2}
+    )
+
+    # each of these writes parameters in place or has no adjoint
+    rejected = {
+        "metal with hardening": lambda: build_solver(
+            material="metal", extra={"yield_stress": 2e2, "hardening": 1, "xi": 0.1}
+        ),
+        "plasticine softening": lambda: build_solver(
+            material="plasticine", extra={"yield_stress": 2e2, "softening": 0.1}
+        ),
+        "plasticine without softening": lambda: build_solver(
+            material="plasticine", extra={"yield_stress": 2e2, "softening": 0.0}
+        ),
+        "grid damping": lambda: build_solver(extra={"grid_v_damping_scale": 0.9}),
+    }
+
+    def with_collider():
+        solver = build_solver()
+        solver.add_surface_collider([0.0, 0.0, 0.3], [0.0, 0.0, 1.0])
+        return solver
+
+    def with_cov_update():
+        solver = build_solver()
+        solver.mpm_model.update_cov_with_F = True
+        return solver
+
+    rejected["surface collider"] = with_collider
+    rejected["covariance update"] = with_cov_update
+    for name, make_solver in rejected.items():
+        try:
+            make_solver().compute_trajectory_gradients(targets, dt, device=device)
+            print(f"{name:<30} NOT rejected")
+        except ValueError as e:
+            print(f"{name:<30} rejected: {e}")
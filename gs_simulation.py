@@ -34,7 +34,7 @@ from utils.general_utils import sample_camera_rays, get_env_rayd1, get_env_rayd2
 
 # MPM dependencies
 from mpm_solver_warp.engine_utils import *
-from mpm_solver_warp.mpm_solver_warp import MPM_Simulator_WARP
+from mpm_solver_warp.mpm_solver_warp import MPM_Simulator_WARP, get_material_id
 import warp as wp
 
 # Particle filling dependencies
@@ -45,6 +45,10 @@ from utils.decode_param import *
 from utils.transformation_utils import *
 from utils.camera_view_utils import *
 from utils.render_utils import *
+from utils.image_writer import *
+from utils.render_pipeline import *
+from utils.trajectory_cache import *
+from utils.sym_eig_utils import *
 
 
 import nvdiffrast.torch as dr
@@ -100,12 +104,6 @@ def latlong_to_cubemap(latlong_map: torch.Tensor, res: List[int]) -> torch.Tenso
     return cubemap.permute(0, 3, 1, 2)
 
 
-wp.init()
-wp.config.verify_cuda = True
-
-ti.init(arch=ti.cuda, device_memory_GB=8.0)
-
-
 class PipelineParamsNoparse:
     """Same as PipelineParams but without argument parser."""
 
@@ -130,40 +128,145 @@ def load_checkpoint(model_path, sh_degree=3, iteration=-1):
     gaussians.load_ply(checkpt_path)
     return gaussians
 
+# the Gaussians of all objects of a scene manifest, placed in world space by
+# their rotation, scale and translation and concatenated in manifest order.
+# view-dependent color keeps each model's own orientation. The first model
+# also provides the SH degree and environment map for rendering.
+# object_ids holds the object index of every Gaussian
+def load_scene_objects(scene_objects, pipeline):
+    params = {}
+    object_ids = []
+    gaussians = None
+    for i, obj in enumerate(scene_objects):
+        print("Loading {} from {}".format(obj["name"], obj["model_path"]))
+        obj_gaussians = load_checkpoint(obj["model_path"])
+        if gaussians is None:
+            gaussians = obj_gaussians
+        obj_params = load_params_from_gs(obj_gaussians, pipeline)
+        rotation_matrices = generate_rotation_matrices(
+            torch.tensor(obj["rotation_degree"]), obj["rotation_axis"]
+        )
+        translation = torch.tensor(obj["translation"], device="cuda")
+        obj_params["pos"] = (
+            apply_rotations(obj_params["pos"], rotation_matrices) * obj["scale"]
+            + translation
+        )
+        obj_params["cov3D_precomp"] = (
+            apply_cov_rotations(obj_params["cov3D_precomp"], rotation_matrices)
+            * obj["scale"]
+            * obj["scale"]
+        )
+        for name in ["pos", "cov3D_precomp", "screen_points", "opacity", "shs", "refl"]:
+            params.setdefault(name, []).append(obj_params[name])
+        object_ids.append(
+            torch.full(
+                (obj_params["pos"].shape[0],), i, dtype=torch.long, device="cuda"
+            )
+        )
+    params = {name: torch.cat(value, dim=0) for name, value in params.items()}
+    return gaussians, params, torch.cat(object_ids)
+
+
+# particles of a scene manifest: all Gaussians in manifest order, then the
+# filled particles of every object, each with its own particle_filling.
+# Returns the positions, the object index of every particle and per object the
+# [start, end) of its Gaussians and of its filled particles
+def fill_scene_objects(pos, opacity, cov, object_ids, scene_objects, grid_lim):
+    filled_pos = [pos]
+    filled_ids = [object_ids]
+    object_ranges = []
+    gs_start = 0
+    filled_start = pos.shape[0]
+    for i, obj in enumerate(scene_objects):
+        mask = object_ids == i
+        n_gaussians = int(mask.sum())
+        filled = pos[:0]
+        filling_params = obj["particle_filling"]
+        if filling_params is not None and n_gaussians > 0:
+            print("Filling internal particles of {}...".format(obj["name"]))
+            filled = fill_particles(
+                pos=pos[mask],
+                opacity=opacity[mask],
+                cov=cov[mask],
+                grid_n=filling_params["n_grid"],
+                max_samples=filling_params["max_particles_num"],
+                grid_dx=grid_lim / filling_params["n_grid"],
+                density_thres=filling_params["density_threshold"],
+                search_thres=filling_params["search_threshold"],
+                max_particles_per_cell=filling_params["max_partciels_per_cell"],
+                search_exclude_dir=filling_params["search_exclude_direction"],
+                ray_cast_dir=filling_params["ray_cast_direction"],
+                boundary=filling_params["boundary"],
+                smooth=filling_params["smooth"],
+            )[n_gaussians:]
+        filled_pos.append(filled)
+        filled_ids.append(object_ids.new_full((filled.shape[0],), i))
+        object_ranges.append(
+            {
+                "name": obj["name"],
+                "gaussians": [gs_start, gs_start + n_gaussians],
+                "filled": [filled_start, filled_start + filled.shape[0]],
+            }
+        )
+        gs_start += n_gaussians
+        filled_start += filled.shape[0]
+    return torch.cat(filled_pos, dim=0), torch.cat(filled_ids), object_ranges
+
+
 def get_normals_from_cov(pts,cov3d_tensor,cam_o):
     p2o = cam_o[None] - pts
-    
-    cov3d_matrix = cov3d_tensor_to_matrix(cov3d_tensor)
-    rot_matrix, scales, _ = torch.svd(cov3d_matrix)
 
-    # print("rot_matrix 0", rot_matrix[1250])
-    # print("rot_matrix 0", rot_t[1250])
-    # print("rot_matrix det", torch.linalg.det(rot_matrix[12]))
-    # print("r*rt:", torch.matmul(rot_matrix[12], rot_matrix[12].T))
-    # assert torch.allclose(rot_matrix, rot_t, rtol=1e-2, atol=1e-2)
-
-    min_axis_id = torch.argmin(scales, dim = -1, keepdim=True)
-    min_axis = torch.zeros_like(scales).scatter(1, min_axis_id, 1)
-    
-    ndir = torch.bmm(rot_matrix, min_axis.unsqueeze(-1)).squeeze(-1)
+    # eigenvector of the smallest variance, no full svd needed
+    ndir = get_min_variance_axis(cov3d_tensor)
     neg_msk = torch.sum(p2o*ndir, dim=-1) < 0
     ndir[neg_msk] = -ndir[neg_msk] # make sure normal orient to camera
     return ndir
 
 
-def cov3d_tensor_to_matrix(cov3d_tensor):
-    cov3d_tensor = cov3d_tensor.view(-1, 6)
-    cov3d_matrix = torch.zeros((cov3d_tensor.shape[0], 3, 3), device=cov3d_tensor.device)
-    cov3d_matrix[:, 0, 0] = cov3d_tensor[:, 0]
-    cov3d_matrix[:, 0, 1] = cov3d_tensor[:, 1]
-    cov3d_matrix[:, 0, 2] = cov3d_tensor[:, 2]
-    cov3d_matrix[:, 1, 0] = cov3d_tensor[:, 1]
-    cov3d_matrix[:, 1, 1] = cov3d_tensor[:, 3]
-    cov3d_matrix[:, 1, 2] = cov3d_tensor[:, 4]
-    cov3d_matrix[:, 2, 0] = cov3d_tensor[:, 2]
-    cov3d_matrix[:, 2, 1] = cov3d_tensor[:, 4]
-    cov3d_matrix[:, 2, 2] = cov3d_tensor[:, 5]
-    return cov3d_matrix
+# one material id per Gaussian, from a .npy or text file of integer labels
+def load_material_labels(path, label_map=None):
+    if path.endswith(".npy"):
+        labels = np.load(path)
+    else:
+        labels = np.loadtxt(path)
+    labels = labels.reshape(-1).astype(np.int64)
+    if label_map is not None:
+        material_ids = labels.copy()
+        for label, material in label_map.items():
+            material_ids[labels == int(label)] = get_material_id(material)
+        labels = material_ids
+    return torch.from_numpy(labels)
+
+
+# named material parameters from a .npz, or from a .npy whose channels follow
+# `channels`: channels first for a (C, X, Y, Z) volume, last for (N, C) per Gaussian
+def load_material_field(path, channels):
+    data = np.load(path)
+    if path.endswith(".npz"):
+        return {name: torch.from_numpy(data[name]).float() for name in data.files}
+    if data.ndim == 4:
+        return {
+            name: torch.from_numpy(data[i]).float() for i, name in enumerate(channels)
+        }
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    return {
+        name: torch.from_numpy(data[:, i]).float() for i, name in enumerate(channels)
+    }
+
+
+# index of the closest Gaussian for every filled particle, whose material
+# labels and parameters the filled particle takes. Distances are computed for
+# chunks of filled particles, sized so that one chunk's distance matrix holds
+# at most max_distances entries
+def get_nearest_gaussian_indices(gs_pos, filled_pos, max_distances=2**26):
+    nearest = torch.zeros(filled_pos.shape[0], dtype=torch.long, device=gs_pos.device)
+    chunk_size = max(1, max_distances // max(gs_pos.shape[0], 1))
+    for i in range(0, filled_pos.shape[0], chunk_size):
+        dist = torch.cdist(filled_pos[i : i + chunk_size], gs_pos)
+        nearest[i : i + chunk_size] = torch.argmin(dist, dim=1)
+    return nearest
+
 
 # rayd: x,3, from camera to world points
 # normal: x,3
@@ -184,6 +287,241 @@ def get_refl_color(envmap: torch.Tensor, HWK, R, T, normal_map): #RT W2C
     #rays_d = rays_d.clamp(-1, 1) # avoid numerical error when arccos
     return sample_cubemap_color(rays_d, envmap)
 
+# Per-frame render buffers, allocated once. The static Gaussians outside
+# sim_area are copied in once behind the simulated ones, and every frame only
+# writes the simulated positions, covariances, colors and normals in place.
+# Runs under inference mode, so no autograd graph is built and steady-state
+# frames only take temporaries from torch's caching allocator.
+class FrameRenderer:
+    @torch.inference_mode()
+    def __init__(self, opacity, shs, refl, background, static_gaussians=None):
+        self.n_dynamic = opacity.shape[0]
+        opacity, shs, refl = [opacity.detach()], [shs.detach()], [refl.detach()]
+        if static_gaussians is not None:
+            opacity.append(static_gaussians["opacity"].detach())
+            shs.append(static_gaussians["shs"].detach())
+            refl.append(static_gaussians["refl"].detach())
+        self.opacity = torch.cat(opacity, dim=0)
+        self.shs = torch.cat(shs, dim=0)
+        n, device = self.opacity.shape[0], self.opacity.device
+
+        self.pos = torch.zeros((n, 3), device=device)
+        self.cov3D = torch.zeros((n, 6), device=device)
+        if static_gaussians is not None:
+            self.pos[self.n_dynamic :] = static_gaussians["pos"]
+            self.cov3D[self.n_dynamic :] = static_gaussians["cov3D"]
+        self.screen_points = torch.zeros((n, 3), device=device)
+        # rgb, normal, reflection strength
+        refl = torch.cat(refl, dim=0)
+        self.colors_precomp = torch.zeros((n, 6 + refl.shape[1]), device=device)
+        self.colors_precomp[:, 6:] = refl
+        self.background = background.detach().to(device)
+        # background color and zero normal/reflection, per image size
+        self.bg_maps = {}
+
+    @torch.inference_mode()
+    def get_bg_map(self, height, width):
+        if (height, width) not in self.bg_maps:
+            bg_map = torch.zeros((7, height, width), device=self.background.device)
+            bg_map[:3] = self.background[:, None, None]
+            self.bg_maps[(height, width)] = bg_map
+        return self.bg_maps[(height, width)]
+
+    # pos, cov3D and rot of the simulated Gaussians in world space
+    @torch.inference_mode()
+    def render(self, rasterize, camera, gaussians, pos, cov3D, rot):
+        self.pos[: self.n_dynamic] = pos
+        self.cov3D[: self.n_dynamic] = cov3D
+        self.colors_precomp[:, :3] = convert_SH(
+            self.shs, camera, gaussians, self.pos, rot
+        )
+        self.colors_precomp[:, 3:6] = get_normals_from_cov(
+            self.pos, self.cov3D, camera.camera_center
+        )
+        out_ts, radii = rasterize(
+            means3D=self.pos,
+            means2D=self.screen_points,
+            shs=None,
+            colors_precomp=self.colors_precomp,
+            opacities=self.opacity,
+            scales=None,
+            rotations=None,
+            cov3D_precomp=self.cov3D,
+            bg_map=self.get_bg_map(int(camera.image_height), int(camera.image_width)),
+        )
+        return out_ts
+
+
+# the four images of every frame, written by ImageWriter and, with fps, also
+# streamed to one video each
+class RenderOutput:
+    dirs = ["base_color", "refl", "normals", "final_image"]
+    names = ["base_color", "refl_color", "normal_map", "final_image"]
+
+    def __init__(
+        self,
+        output_path,
+        fps=None,
+        image_format="png",
+        skip_images=False,
+        num_writers=2,
+    ):
+        self.paths = [os.path.join(output_path, name) for name in self.dirs]
+        self.image_format = image_format
+        self.skip_images = skip_images
+        self.image_writer = ImageWriter(
+            num_workers=num_writers, max_pending=4 * num_writers
+        )
+        # one ffmpeg process per output, fed while the simulation runs
+        self.videos = [None] * 4
+        if fps is not None:
+            self.videos = [
+                VideoStream(os.path.join(output_path, name + ".mp4"), fps)
+                for name in self.names
+            ]
+
+    def write(self, frame, images):
+        for i in range(4):
+            image_path = None
+            if not self.skip_images:
+                file_name = f"{frame}.{self.image_format}"
+                image_path = os.path.join(
+                    self.paths[i], file_name.rjust(5 + len(self.image_format), "0")
+                )
+            self.image_writer.write(image_path, images[i], video=self.videos[i])
+
+    def close(self):
+        self.image_writer.close()
+        for video in self.videos:
+            if video is not None:
+                video.close()
+
+
+# renders a frame from the particle state of the simulated Gaussians in solver
+# space (pos, cov3D, rot) and writes it to output. transform holds the
+# rotation_matrices, scale_origin and original_mean_pos that placed the scene
+# in the solver domain
+def render_frame(
+    frame,
+    particles,
+    camera_trajectory,
+    frame_renderer,
+    gaussians,
+    pipeline,
+    background,
+    transform,
+    output,
+    device="cuda:0",
+):
+    current_camera = camera_trajectory.get_camera(frame)
+    # rasterize = initialize_resterize(
+    #     current_camera, gaussians, pipeline, background
+    # )
+    rasterize = initialize_resterizer_3dgsdr(
+        current_camera, gaussians, pipeline, background
+    )
+    with torch.inference_mode():
+        pos = particles["pos"].to(device)
+        cov3D = particles["cov3D"].to(device)
+        rot = particles["rot"].to(device)
+        rotation_matrices, scale_origin, original_mean_pos = transform
+        pos = apply_inverse_rotations(
+            undotransform2origin(
+                undoshift2center111(pos), scale_origin, original_mean_pos
+            ),
+            rotation_matrices,
+        )
+        cov3D = cov3D / (scale_origin * scale_origin)
+        cov3D = apply_inverse_cov_rotations(cov3D, rotation_matrices)
+        out_ts = frame_renderer.render(
+            rasterize, current_camera, gaussians, pos, cov3D, rot
+        )
+
+        base_color = out_ts[:3,...] # 3,H,W
+        refl_strength = out_ts[6:7,...] #
+        normal_map = out_ts[3:6,...] 
+    
+
+        normal_clone = normal_map.clone()
+
+
+        normal_map = normal_map.permute(1,2,0)
+        # normal_map = normal_map / (torch.norm(normal_map, dim=-1, keepdim=True)+1e-6) # in my experiments it seems that normalized normal map will cause error, but dont know why for now.
+
+
+
+        refl_color = get_refl_color(gaussians.get_envmap, current_camera.HWK, current_camera.R, current_camera.T, normal_map)
+    
+        final_image = (1-refl_strength) * base_color + refl_strength * refl_color
+                    
+        output.write(frame, [base_color, refl_color, normal_clone, final_image])
+
+
+# renders every frame of a trajectory cache written with --save_trajectory,
+# with the cameras, background and environment map of this run. The solver,
+# the particle filling, Taichi and Warp are never set up
+def replay_trajectory(
+    args, trajectory, gaussians, pipeline, background, camera_params, device="cuda:0"
+):
+    static = to_device(trajectory.static, device)
+    transform = (
+        static["rotation_matrices"],
+        static["scale_origin"],
+        static["original_mean_pos"],
+    )
+    frame_renderer = FrameRenderer(
+        static["opacity"],
+        static["shs"],
+        static["refl"],
+        background,
+        static_gaussians=static["static_gaussians"],
+    )
+    output = RenderOutput(
+        args.output_path,
+        fps=int(1.0 / static["frame_dt"]) if args.compile_video else None,
+        image_format=args.image_format,
+        skip_images=args.skip_images,
+        num_writers=args.image_writers,
+    )
+
+    viewpoint_center_worldspace, observant_coordinates = (
+        get_center_view_worldspace_and_observant_coordinate(
+            torch.tensor(camera_params["mpm_space_viewpoint_center"])
+            .reshape((1, 3))
+            .to(device),
+            torch.tensor(camera_params["mpm_space_vertical_upward_axis"])
+            .reshape((1, 3))
+            .to(device),
+            *transform,
+        )
+    )
+    camera_trajectory = CameraTrajectory(
+        args.model_path,
+        len(trajectory),
+        camera_params,
+        center_view_world_space=viewpoint_center_worldspace,
+        observant_coordinates=observant_coordinates,
+        frame_scale=args.preview_scale if args.preview else 1,
+        resolution_scale=1.0 / args.preview_scale if args.preview else 1.0,
+    )
+
+    frames = trajectory.prefetch(range(len(trajectory)), device=device)
+    for frame, particles in tqdm(frames, total=len(trajectory)):
+        render_frame(
+            frame,
+            particles,
+            camera_trajectory,
+            frame_renderer,
+            gaussians,
+            pipeline,
+            background,
+            transform,
+            output,
+            device=device,
+        )
+    output.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_path", type=str, required=True)
@@ -197,8 +535,40 @@ if __name__ == "__main__":
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--relight", action="store_true")
     parser.add_argument("--hdri_path", type=str, default=None)
+    # coarse, fast run to check BCs and cameras, see get_preview_params
+    parser.add_argument("--preview", action="store_true")
+    parser.add_argument("--preview_scale", type=int, default=2)
+    # per-frame energy/momentum/CFL/det(F) log in output_path/diagnostics.jsonl
+    parser.add_argument("--diagnostics", action="store_true")
+    # rendered images are encoded by background threads, see ImageWriter
+    parser.add_argument(
+        "--image_format", type=str, default="png", choices=["png", "jpg"]
+    )
+    parser.add_argument("--image_writers", type=int, default=2)
+    # with --compile_video, only write the videos
+    parser.add_argument("--skip_images", action="store_true")
+    # render frame n on a worker thread while frame n + 1 is simulated
+    parser.add_argument("--pipeline_render", action="store_true")
+    # write what rendering needs per frame to a trajectory cache, and render
+    # such a cache again (new cameras, background, envmap) without simulating
+    parser.add_argument("--save_trajectory", type=str, default=None)
+    parser.add_argument("--replay", type=str, default=None)
+    # with K > 0 the cache keeps a full keyframe every K frames and quantized
+    # deltas in between, within the given pos, cov3D and rot errors
+    parser.add_argument("--trajectory_keyframes", type=int, default=0)
+    parser.add_argument(
+        "--trajectory_error", type=float, nargs=3, default=[1e-4, 1e-8, 1e-3]
+    )
+    parser.add_argument("--trajectory_compress", action="store_true")
     args = parser.parse_args()
 
+    # a replay only renders, the solver and the particle filling are not set up
+    if args.replay is None:
+        wp.init()
+        wp.config.verify_cuda = True
+
+        ti.init(arch=ti.cuda, device_memory_GB=8.0)
+
 
 
     if not os.path.exists(args.model_path):
@@ -231,13 +601,24 @@ if __name__ == "__main__":
         preprocessing_params,
         camera_params,
     ) = decode_param_json(args.config)
+    if args.preview:
+        get_preview_params(
+            material_params, time_params, preprocessing_params, args.preview_scale
+        )
 
     # load gaussians
     print("Loading gaussians...")
     model_path = args.model_path
-    gaussians = load_checkpoint(model_path)
     pipeline = PipelineParamsNoparse()
     pipeline.compute_cov3D_python = True
+    # with a scene manifest, model_path only provides the cameras
+    scene_objects = preprocessing_params["scene_objects"]
+    init_object = None
+    if scene_objects is not None:
+        gaussians, params, init_object = load_scene_objects(scene_objects, pipeline)
+    else:
+        gaussians = load_checkpoint(model_path)
+        params = load_params_from_gs(gaussians, pipeline)
     background = (
         torch.tensor([1, 1, 1], dtype=torch.float32, device="cuda")
         if args.white_bg
@@ -246,12 +627,16 @@ if __name__ == "__main__":
 
     # init the scene
     print("Initializing scene and pre-processing...")
-    params = load_params_from_gs(gaussians, pipeline)
 
 
     # envmap = gaussians.get_envmap
     # print(repr(envmap))
-    if args.hdri_path is not None and args.relight and not args.debug and args.render_img:
+    if (
+        args.hdri_path is not None
+        and args.relight
+        and not args.debug
+        and (args.render_img or args.replay is not None)
+    ):
         with torch.no_grad():
             hdri_path = args.hdri_path
             print(f"read hdri from {hdri_path}")
@@ -262,6 +647,18 @@ if __name__ == "__main__":
             envmap.params["Cubemap_texture"] = latlong_to_cubemap(hdri, [res, res])
             gaussians.env_map = envmap.cuda()
 
+    if args.replay is not None:
+        print("Rendering the trajectory cache " + args.replay + "...")
+        replay_trajectory(
+            args,
+            TrajectoryReader(args.replay),
+            gaussians,
+            pipeline,
+            background,
+            camera_params,
+        )
+        sys.exit()
+
     init_pos = params["pos"]
     init_cov = params["cov3D_precomp"]
     init_screen_points = params["screen_points"]
@@ -277,6 +674,29 @@ if __name__ == "__main__":
     init_screen_points = init_screen_points[mask, :]
     init_shs = init_shs[mask, :]
     init_refl = init_refl[mask, :]
+    if init_object is not None:
+        init_object = init_object[mask]
+
+    # per-Gaussian labels and parameters refer to a single model, a manifest
+    # sets them per object instead
+    init_material = None
+    if preprocessing_params["material_label_file"] is not None and init_object is None:
+        init_material = load_material_labels(
+            preprocessing_params["material_label_file"],
+            preprocessing_params["material_label_map"],
+        ).to(device="cuda")
+        init_material = init_material[mask]
+
+    init_material_params = None
+    if preprocessing_params["material_param_file"] is not None and init_object is None:
+        init_material_params = load_material_field(
+            preprocessing_params["material_param_file"],
+            preprocessing_params["material_field_channels"],
+        )
+        init_material_params = {
+            name: value.to(device="cuda")[mask]
+            for name, value in init_material_params.items()
+        }
 
     # rorate and translate object
     if args.debug:
@@ -302,6 +722,7 @@ if __name__ == "__main__":
         None,
         None,
     )
+    unselected_refl = None
     if preprocessing_params["sim_area"] is not None:
         boundary = preprocessing_params["sim_area"]
         assert len(boundary) == 6
@@ -314,6 +735,7 @@ if __name__ == "__main__":
         unselected_cov = init_cov[~mask, :]
         unselected_opacity = init_opacity[~mask, :]
         unselected_shs = init_shs[~mask, :]
+        unselected_refl = init_refl[~mask, :]
 
         # normals = 
 
@@ -321,10 +743,26 @@ if __name__ == "__main__":
         init_cov = init_cov[mask, :]
         init_opacity = init_opacity[mask, :]
         init_shs = init_shs[mask, :]
+        init_refl = init_refl[mask, :]
+        if init_material is not None:
+            init_material = init_material[mask]
+        if init_material_params is not None:
+            init_material_params = {
+                name: value[mask] for name, value in init_material_params.items()
+            }
+        if init_object is not None:
+            init_object = init_object[mask]
 
     transformed_pos, scale_origin, original_mean_pos = transform2origin(rotated_pos)
     transformed_pos = shift2center111(transformed_pos)
 
+    # the same transform for other scene geometry, like collider meshes
+    def world_to_mpm(points):
+        points = torch.from_numpy(points).to(device="cuda")
+        points = apply_rotations(points, rotation_matrices)
+        points = shift2center111((points - original_mean_pos) * scale_origin)
+        return points.cpu().numpy()
+
     # modify covariance matrix accordingly
     init_cov = apply_cov_rotations(init_cov, rotation_matrices)
     init_cov = scale_origin * scale_origin * init_cov
@@ -340,7 +778,19 @@ if __name__ == "__main__":
     device = "cuda:0"
     filling_params = preprocessing_params["particle_filling"]
 
-    if filling_params is not None:
+    if scene_objects is not None:
+        mpm_init_pos, mpm_init_object, object_ranges = fill_scene_objects(
+            transformed_pos,
+            init_opacity,
+            init_cov,
+            init_object,
+            scene_objects,
+            material_params["grid_lim"],
+        )
+        mpm_init_pos = mpm_init_pos.to(device=device)
+        with open(os.path.join(args.output_path, "objects.json"), "w") as f:
+            json.dump(object_ranges, f, indent=2)
+    elif filling_params is not None:
         print("Filling internal particles...")
         mpm_init_pos = fill_particles(
             pos=transformed_pos,
@@ -363,6 +813,46 @@ if __name__ == "__main__":
     else:
         mpm_init_pos = transformed_pos.to(device=device)
 
+    # every object of a manifest has one material and one set of parameters
+    if scene_objects is not None:
+        material_params["particle_material"] = torch.tensor(
+            [get_material_id(obj["material"]["material"]) for obj in scene_objects],
+            device=device,
+        )[mpm_init_object]
+        material_params["particle_material_params"] = {
+            name: torch.tensor(
+                [float(obj["material"][name]) for obj in scene_objects], device=device
+            )[mpm_init_object]
+            for name in ["E", "nu", "density", "yield_stress"]
+            if all(name in obj["material"].keys() for obj in scene_objects)
+        }
+    else:
+        # one nearest-Gaussian search, shared by the labels and every parameter
+        nearest_gaussian = None
+        if init_material is not None or init_material_params is not None:
+            nearest_gaussian = get_nearest_gaussian_indices(
+                mpm_init_pos[:gs_num], mpm_init_pos[gs_num:]
+            )
+        if init_material is not None:
+            material_params["particle_material"] = torch.cat(
+                [init_material, init_material[nearest_gaussian]]
+            )
+        if init_material_params is not None:
+            material_params["particle_material_params"] = {
+                name: torch.cat([value, value[nearest_gaussian]])
+                for name, value in init_material_params.items()
+            }
+
+    if preprocessing_params["material_field_file"] is not None:
+        material_params["material_field"] = {
+            "volumes": load_material_field(
+                preprocessing_params["material_field_file"],
+                preprocessing_params["material_field_channels"],
+            ),
+            "origin": preprocessing_params["material_field_origin"],
+            "size": preprocessing_params["material_field_size"],
+        }
+
     # init the mpm solver
     print("Initializing MPM solver and setting up boundary conditions...")
     mpm_init_vol = get_particle_volume(
@@ -380,12 +870,16 @@ if __name__ == "__main__":
             init_opacity,
             mpm_init_pos[gs_num:], # filled particles
         )
+        # filled particles do not reflect
+        n_filled = mpm_init_pos.shape[0] - gs_num
+        refl = torch.cat([init_refl, init_refl.new_zeros((n_filled, init_refl.shape[1]))])
         gs_num = mpm_init_pos.shape[0]
     else:
         mpm_init_cov = torch.zeros((mpm_init_pos.shape[0], 6), device=device)
         mpm_init_cov[:gs_num] = init_cov
         shs = init_shs
         opacity = init_opacity
+        refl = init_refl
 
     if args.debug:
         print("check *.ply files to see if it's ready for simulation")
@@ -401,8 +895,59 @@ if __name__ == "__main__":
     )
     mpm_solver.set_parameters_dict(material_params)
 
+    # particles may be merged or split, render the Gaussians through the mapping
+    resampling_params = preprocessing_params["particle_resampling"]
+    if resampling_params is not None or args.preview:
+        mpm_solver.init_render_mapping(gs_num)
+
+    # preview: at most 8 particles per coarse cell and the coarse-grid CFL substep
+    if args.preview:
+        mpm_solver.resample_particles(
+            max_particles_per_cell=8, split_extent=float("inf"), device=device
+        )
+        time_params["substep_dt"] = min(
+            max(time_params["substep_dt"], mpm_solver.get_cfl_substep_dt()),
+            time_params["frame_dt"],
+        )
+        print("Preview substep_dt: ", time_params["substep_dt"])
+
     # Note: boundary conditions may depend on mass, so the order cannot be changed!
-    set_boundary_conditions(mpm_solver, bc_params, time_params)
+    set_boundary_conditions(
+        mpm_solver, bc_params, time_params, world_to_mpm=world_to_mpm
+    )
+
+    # the static scene outside sim_area becomes one sdf collider
+    static_collider_params = preprocessing_params["static_collider"]
+    if static_collider_params is not None and unselected_pos is not None:
+        static_pos = apply_rotations(unselected_pos, rotation_matrices)
+        static_pos = shift2center111((static_pos - original_mean_pos) * scale_origin)
+        static_cov = apply_cov_rotations(unselected_cov, rotation_matrices)
+        static_cov = scale_origin * scale_origin * static_cov
+        n_grid, dx = mpm_solver.mpm_model.n_grid, mpm_solver.mpm_model.dx
+        density = get_density_grid(
+            static_pos, unselected_opacity, static_cov, grid_n=n_grid, grid_dx=dx
+        )
+        # the nodes within 2 cells of a simulated particle (its whole quadratic
+        # B-spline stencil) stay free, so an object resting on the scene does not
+        # start inside it
+        node = torch.round(mpm_init_pos / dx).long().clamp(0, n_grid - 1)
+        occupied = torch.zeros(
+            (1, 1, n_grid, n_grid, n_grid), device=node.device, dtype=torch.float32
+        )
+        occupied[0, 0, node[:, 0], node[:, 1], node[:, 2]] = 1.0
+        occupied = F.max_pool3d(occupied, kernel_size=5, stride=1, padding=2)
+        density[occupied[0, 0].cpu().numpy() > 0] = 0.0
+        static_sdf = density_to_sdf(
+            density, dx, static_collider_params["density_threshold"]
+        )
+        if static_sdf is not None:
+            mpm_solver.add_sdf_collider(
+                static_sdf,
+                surface=static_collider_params["surface"],
+                friction=static_collider_params["friction"],
+                thickness=static_collider_params["thickness"],
+                device=device,
+            )
 
     mpm_solver.finalize_mu_lam()
 
@@ -440,40 +985,156 @@ if __name__ == "__main__":
             save_to_h5=args.output_h5,
         )
 
+    if args.diagnostics:
+        diagnostics_log = os.path.join(args.output_path, "diagnostics.jsonl")
+        open(diagnostics_log, "w").close()
+
+    guard_params = preprocessing_params["guard"]
+    if guard_params is not None:
+        mpm_solver.guard_enabled = True
+
     substep_dt = time_params["substep_dt"]
     frame_dt = time_params["frame_dt"]
     frame_num = time_params["frame_num"]
     step_per_frame = int(frame_dt / substep_dt)
-    opacity_render = opacity
-    shs_render = shs
-    height = None
-    width = None
-    for frame in tqdm(range(frame_num)):
-        current_camera = get_camera_view(
-            model_path,
-            default_camera_index=camera_params["default_camera_index"],
-            center_view_world_space=viewpoint_center_worldspace,
-            observant_coordinates=observant_coordinates,
-            show_hint=camera_params["show_hint"],
-            init_azimuthm=camera_params["init_azimuthm"],
-            init_elevation=camera_params["init_elevation"],
-            init_radius=camera_params["init_radius"],
-            move_camera=camera_params["move_camera"],
-            current_frame=frame,
-            delta_a=camera_params["delta_a"],
-            delta_e=camera_params["delta_e"],
-            delta_r=camera_params["delta_r"],
+    multirate_params = time_params["multirate"]
+    static_gaussians = None
+    if preprocessing_params["sim_area"] is not None:
+        static_gaussians = {
+            "pos": unselected_pos,
+            "cov3D": unselected_cov,
+            "opacity": unselected_opacity,
+            "shs": unselected_shs,
+            "refl": unselected_refl,
+        }
+    trajectory_writer = None
+    if args.save_trajectory is not None:
+        static_render_params = {
+            "opacity": opacity,
+            "shs": shs,
+            "refl": refl,
+            "static_gaussians": static_gaussians,
+            "rotation_matrices": rotation_matrices,
+            "scale_origin": scale_origin,
+            "original_mean_pos": original_mean_pos,
+            "frame_dt": frame_dt,
+        }
+        if args.trajectory_keyframes > 0:
+            trajectory_writer = CompactTrajectoryWriter(
+                args.save_trajectory,
+                frame_num,
+                static_render_params,
+                keyframe_interval=args.trajectory_keyframes,
+                error_bounds=dict(zip(["pos", "cov3D", "rot"], args.trajectory_error)),
+                compress=args.trajectory_compress,
+            )
+        else:
+            trajectory_writer = TrajectoryWriter(
+                args.save_trajectory, frame_num, static_render_params
+            )
+    if args.render_img:
+        frame_renderer = FrameRenderer(
+            opacity, shs, refl, background, static_gaussians=static_gaussians
         )
+        render_output = RenderOutput(
+            args.output_path,
+            fps=int(1.0 / time_params["frame_dt"]) if args.compile_video else None,
+            image_format=args.image_format,
+            skip_images=args.skip_images,
+            num_writers=args.image_writers,
+        )
+    camera_trajectory = CameraTrajectory(
+        model_path,
+        frame_num,
+        camera_params,
+        center_view_world_space=viewpoint_center_worldspace,
+        observant_coordinates=observant_coordinates,
+        frame_scale=args.preview_scale if args.preview else 1,
+        resolution_scale=1.0 / args.preview_scale if args.preview else 1.0,
+    )
 
-        # rasterize = initialize_resterize(
-        #     current_camera, gaussians, pipeline, background
-        # )
-        rasterize = initialize_resterizer_3dgsdr(
-            current_camera, gaussians, pipeline, background
+    transform = (rotation_matrices, scale_origin, original_mean_pos)
+
+    # on the render worker with --pipeline_render
+    def render_simulated_frame(frame, particles):
+        render_frame(
+            frame,
+            particles,
+            camera_trajectory,
+            frame_renderer,
+            gaussians,
+            pipeline,
+            background,
+            transform,
+            render_output,
+            device=device,
         )
 
+    render_pipeline = None
+    if args.render_img and args.pipeline_render:
+        render_pipeline = RenderPipeline(render_simulated_frame)
+    for frame in tqdm(range(frame_num)):
+        if guard_params is not None:
+            snapshot = mpm_solver.snapshot()
         for step in range(step_per_frame):
-            mpm_solver.p2g2p(frame, substep_dt, device=device)
+            if multirate_params is not None:
+                mpm_solver.p2g2p_multirate(
+                    frame, substep_dt, device=device, **multirate_params
+                )
+            else:
+                mpm_solver.p2g2p(frame, substep_dt, device=device)
+
+        if guard_params is not None:
+            report = mpm_solver.check_guard(device=device)
+            retries = 0
+            while report is not None:
+                report["frame"] = frame + 1
+                report["substep_dt"] = substep_dt
+                if (
+                    guard_params["mode"] != "rollback"
+                    or retries >= guard_params["max_retries"]
+                ):
+                    report_file = os.path.join(args.output_path, "guard_report.json")
+                    with open(report_file, "w") as f:
+                        json.dump(report, f, indent=2)
+                    raise RuntimeError(
+                        "Simulation blew up in frame {} ({}), report in {}".format(
+                            frame + 1, ", ".join(report["stages"].keys()), report_file
+                        )
+                    )
+                # the halved substep is kept for the rest of the run
+                mpm_solver.restore(snapshot, device=device)
+                substep_dt = substep_dt / 2.0
+                step_per_frame = step_per_frame * 2
+                retries += 1
+                print(
+                    "Guard triggered in frame {} ({}), retrying with substep_dt {}".format(
+                        frame + 1, ", ".join(report["stages"].keys()), substep_dt
+                    )
+                )
+                for step in range(step_per_frame):
+                    if multirate_params is not None:
+                        mpm_solver.p2g2p_multirate(
+                            frame, substep_dt, device=device, **multirate_params
+                        )
+                    else:
+                        mpm_solver.p2g2p(frame, substep_dt, device=device)
+                report = mpm_solver.check_guard(device=device)
+
+        if args.diagnostics:
+            save_diagnostics_at_frame(
+                mpm_solver, diagnostics_log, frame + 1, substep_dt, device=device
+            )
+
+        if (
+            resampling_params is not None
+            and (frame + 1) % resampling_params["interval"] == 0
+        ):
+            mpm_solver.resample_particles(
+                max_particles_per_cell=resampling_params["max_particles_per_cell"],
+                split_extent=resampling_params["split_extent"],
+                device=device,
+            )
 
         if args.output_ply or args.output_h5:
             save_data_at_frame(
@@ -484,88 +1145,37 @@ if __name__ == "__main__":
                 save_to_h5=args.output_h5,
             )
 
-        if args.render_img:
-            pos = mpm_solver.export_particle_x_to_torch()[:gs_num].to(device)
-            cov3D = mpm_solver.export_particle_cov_to_torch()
-            rot = mpm_solver.export_particle_R_to_torch()
-            cov3D = cov3D.view(-1, 6)[:gs_num].to(device)
-            rot = rot.view(-1, 3, 3)[:gs_num].to(device)
-            pos = apply_inverse_rotations(
-                undotransform2origin(
-                    undoshift2center111(pos), scale_origin, original_mean_pos
-                ),
-                rotation_matrices,
-            )
-            cov3D = cov3D / (scale_origin * scale_origin)
-            cov3D = apply_inverse_cov_rotations(cov3D, rotation_matrices)
-            opacity = opacity_render
-            shs = shs_render
-        
-            if preprocessing_params["sim_area"] is not None:
-                pos = torch.cat([pos, unselected_pos], dim=0)
-                cov3D = torch.cat([cov3D, unselected_cov], dim=0)
-                opacity = torch.cat([opacity_render, unselected_opacity], dim=0)
-                shs = torch.cat([shs_render, unselected_shs], dim=0)
-            
-            normals = get_normals_from_cov(pos, cov3D, current_camera.camera_center)
-            rgb_precomp = convert_SH(shs, current_camera, gaussians, pos, rot)
-
-            colors_precomp = torch.cat([rgb_precomp, normals, init_refl], dim=-1)
-            # print("colors_precomp shape:", colors_precomp.shape)
-            
-            imH = int(current_camera.image_height)
-            imW = int(current_camera.image_width)
-            bg_const = background[:, None, None].cuda().expand(3, imH, imW)
-            bg_map = torch.cat([bg_const, torch.zeros(4,imH,imW, device='cuda')], dim=0)
-
-            out_ts, radii = rasterize(
-                means3D = pos,
-                means2D = init_screen_points,
-                shs = None,
-                colors_precomp = colors_precomp,
-                opacities = opacity,
-                scales = None,
-                rotations = None,
-                cov3D_precomp = cov3D,
-                bg_map = bg_map)
-            
-            base_color = out_ts[:3,...] # 3,H,W
-            refl_strength = out_ts[6:7,...] #
-            normal_map = out_ts[3:6,...] 
-            
-
-            normal_clone = normal_map.clone()
-
-
-            normal_map = normal_map.permute(1,2,0)
-            # normal_map = normal_map / (torch.norm(normal_map, dim=-1, keepdim=True)+1e-6) # in my experiments it seems that normalized normal map will cause error, but dont know why for now.
-
-
-
-            refl_color = get_refl_color(gaussians.get_envmap, current_camera.HWK, current_camera.R, current_camera.T, normal_map)
-            
-            final_image = (1-refl_strength) * base_color + refl_strength * refl_color
-                            
-            to_save = [base_color, refl_color, normal_clone, final_image]
-            paths = [base_color_path, refl_path, normap_path, final_image_path]
-            names = ["base_color", "refl_color", "normal_map", "final_image"]
-
-            for i in range(4):
-                rendering = to_save[i]
-                cv2_img = rendering.permute(1, 2, 0).detach().cpu().numpy()
-                cv2_img = cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB)
-                if height is None or width is None:
-                    height = cv2_img.shape[0] // 2 * 2
-                    width = cv2_img.shape[1] // 2 * 2
-                assert args.output_path is not None
-                cv2.imwrite(
-                    os.path.join(paths[i], f"{frame}.png".rjust(8, "0")),
-                    255 * cv2_img,
-                )
-
-    if args.compile_video and args.render_img:
-        fps = int(1.0 / time_params["frame_dt"])
-        for i in range(4):
-            os.system(
-                f"ffmpeg -framerate {fps} -i {paths[i]}/%04d.png -c:v libx264 -s {width}x{height} -y -pix_fmt yuv420p {args.output_path}/{names[i]}.mp4"
+        if args.render_img or trajectory_writer is not None:
+            with torch.inference_mode():
+                if mpm_solver.render_particle_ids is not None:
+                    pos = mpm_solver.export_render_x_to_torch()
+                    cov3D = mpm_solver.export_render_cov_to_torch()
+                    rot = mpm_solver.export_render_R_to_torch()
+                else:
+                    pos = mpm_solver.export_particle_x_to_torch()[:gs_num]
+                    cov3D = mpm_solver.export_particle_cov_to_torch()
+                    rot = mpm_solver.export_particle_R_to_torch()
+                particles = {
+                    "pos": pos,
+                    "cov3D": cov3D.view(-1, 6)[:gs_num],
+                    "rot": rot.view(-1, 3, 3)[:gs_num],
+                }
+            if trajectory_writer is not None:
+                trajectory_writer.write(frame, particles)
+            if render_pipeline is not None:
+                render_pipeline.submit(frame, particles)
+            elif args.render_img:
+                render_simulated_frame(frame, particles)
+
+    if render_pipeline is not None:
+        render_pipeline.close()
+        print(
+            "Rendered {frames} frames in {wall_time:.1f}s: simulation {sim_time:.1f}s, "
+            "rendering {render_time:.1f}s, overlap {overlap:.0%}".format(
+                **render_pipeline.stats()
             )
+        )
+    if args.render_img:
+        render_output.close()
+    if trajectory_writer is not None:
+        trajectory_writer.close()
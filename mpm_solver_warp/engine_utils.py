@@ -1,5 +1,6 @@
 import numpy as np
 import h5py
+import json
 import os
 import sys
 import warp as wp
@@ -46,6 +47,15 @@ def save_data_at_frame(mpm_solver, dir_name, frame, save_to_ply=True, save_to_h5
         print("save siumlation data at frame ", frame, " to ", fullfilename)
 
 
+# append one line of solver diagnostics to a JSONL log
+def save_diagnostics_at_frame(mpm_solver, log_file, frame, dt, device="cuda:0"):
+    diagnostics = mpm_solver.compute_diagnostics(dt, device=device)
+    diagnostics["frame"] = frame
+    with open(log_file, "a") as f:
+        f.write(json.dumps(diagnostics) + "\n")
+    return diagnostics
+
+
 def particle_position_to_ply(mpm_solver, filename):
     # position is (n,3)
     if os.path.exists(filename):
@@ -86,3 +96,43 @@ end_header
         f.write(str.encode(header))
         f.write(position.tobytes())
         print("write", filename)
+
+
+# vertices (n, 3) and triangles (m, 3) of an OBJ or PLY mesh, polygons are
+# split into triangle fans
+def load_triangle_mesh(filename):
+    if filename.endswith(".ply"):
+        from plyfile import PlyData
+
+        plydata = PlyData.read(filename)
+        vertex = plydata["vertex"]
+        vertices = np.stack([vertex["x"], vertex["y"], vertex["z"]], axis=1)
+        face = plydata["face"].data
+        if "vertex_indices" in face.dtype.names:
+            polygons = face["vertex_indices"]
+        else:
+            polygons = face["vertex_index"]
+    elif filename.endswith(".obj"):
+        vertices, polygons = [], []
+        with open(filename, "r") as f:
+            for line in f:
+                values = line.split()
+                if len(values) == 0:
+                    continue
+                if values[0] == "v":
+                    vertices.append([float(x) for x in values[1:4]])
+                elif values[0] == "f":
+                    # v, v/vt, v//vn or v/vt/vn, 1-based or negative
+                    ids = [int(x.split("/")[0]) for x in values[1:]]
+                    polygons.append(
+                        [i - 1 if i > 0 else len(vertices) + i for i in ids]
+                    )
+        vertices = np.array(vertices)
+    else:
+        raise ValueError("Unsupported mesh format: " + filename)
+    faces = [
+        [polygon[0], polygon[i], polygon[i + 1]]
+        for polygon in polygons
+        for i in range(1, len(polygon) - 1)
+    ]
+    return vertices.astype(np.float32), np.array(faces, dtype=np.int32).reshape(-1, 3)
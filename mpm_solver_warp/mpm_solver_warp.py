@@ -1,5 +1,7 @@
 import sys
 import os
+import copy
+import hashlib
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from engine_utils import *
@@ -7,7 +9,45 @@ from warp_utils import *
 from mpm_utils import *
 
 
+# material name -> id used by model.material and state.particle_material
+def get_material_id(material):
+    if material == "jelly":
+        return 0
+    elif material == "metal":
+        return 1
+    elif material == "sand":
+        return 2
+    elif material == "foam":
+        return 3
+    elif material == "snow":
+        return 4
+    elif material == "plasticine":
+        return 5
+    else:
+        raise TypeError("Undefined material type")
+
+
 class MPM_Simulator_WARP:
+    # slots of the on-device diagnostics buffer, see compute_diagnostics
+    diagnostics_names = [
+        "kinetic_energy",
+        "elastic_energy",
+        "momentum_x",
+        "momentum_y",
+        "momentum_z",
+        "max_speed",
+        "min_J",
+        "max_J",
+        "particle_mass",
+        "grid_mass",
+    ]
+    # slots of the NaN/explosion guard, see check_guard
+    guard_stages = ["stress", "grid", "g2p", "deformation_gradient", "out_of_grid"]
+    # per-particle parameters a material field can set, see set_material_field
+    material_field_names = ["E", "nu", "density", "yield_stress"]
+    # 27 weights and 27 weight gradients, see enable_weight_cache
+    weight_cache_bytes_per_particle = 27 * (4 + 3 * 4)
+
     def __init__(self, n_particles, n_grid=100, grid_lim=1.0, device="cuda:0"):
         self.initialize(n_particles, n_grid, grid_lim, device=device)
         self.time_profile = {}
@@ -38,6 +78,17 @@ class MPM_Simulator_WARP:
 
         self.mpm_model.update_cov_with_F = False
 
+        # rotation for FCR stress and R export by warm-started polar iteration instead of svd
+        self.mpm_model.polar_rotation = 1
+        self.mpm_model.polar_max_iters = 8
+        self.mpm_model.polar_tol = 1e-6
+
+        # scalar material constants, set by finalize_mu_lam when they are uniform
+        self.mpm_model.uniform_params = 0
+        self.mpm_model.uniform_mu = 0.0
+        self.mpm_model.uniform_lam = 0.0
+        self.mpm_model.uniform_yield_stress = 0.0
+
         # material is used to switch between different elastoplastic models. 0 is jelly
         self.mpm_model.material = 0
 
@@ -74,6 +125,17 @@ class MPM_Simulator_WARP:
             shape=n_particles, dtype=wp.mat33, device=device
         )  # particle R rotation
 
+        self.mpm_state.particle_polar_q = wp.zeros(
+            shape=n_particles, dtype=wp.quat, device=device
+        )  # rotation of F, warm start of the polar decomposition in the stress
+
+        # rotation of F_trial, warm start of the polar decomposition in the R
+        # export. F and F_trial differ for plastic materials, so sharing one
+        # warm start would start each from the other's rotation
+        self.mpm_state.particle_R_q = wp.zeros(
+            shape=n_particles, dtype=wp.quat, device=device
+        )
+
         self.mpm_state.particle_init_cov = wp.zeros(
             shape=n_particles * 6, dtype=float, device=device
         )  # initial covariance matrix
@@ -110,6 +172,45 @@ class MPM_Simulator_WARP:
             shape=n_particles, dtype=int, device=device
         )
 
+        self.mpm_state.particle_material = wp.zeros(
+            shape=n_particles, dtype=int, device=device
+        )  # per-particle material id, defaults to model.material
+        # (material id, particle indices) for each material of a mixed scene,
+        # empty while all particles share model.material
+        self.material_groups = []
+
+        # Gaussian -> particle mapping for rendering, see init_render_mapping
+        self.render_particle_ids = None
+
+        self.mpm_state.particle_rigid_id = wp.empty(
+            shape=n_particles, dtype=int, device=device
+        )  # rigid body of the particle, -1 if deformable
+        wp.launch(
+            kernel=set_value_to_int_array,
+            dim=n_particles,
+            inputs=[self.mpm_state.particle_rigid_id, -1],
+            device=device,
+        )
+        self.rigid_bodies = RigidBodyStruct()
+        self.n_rigid_bodies = 0
+
+        self.diagnostics = wp.zeros(
+            shape=len(self.diagnostics_names), dtype=float, device=device
+        )
+        # set guard_enabled to check every substep for non-finite values
+        self.guard_enabled = False
+        self.guard = wp.zeros(shape=len(self.guard_stages), dtype=int, device=device)
+
+        # p2g weights reused by g2p, see enable_weight_cache
+        self.weight_cache = None
+
+        # multi-rate stepping, see update_rate_classes
+        self.rate_classes = []
+        self.rate_class_build = None
+        self.particle_time = None
+        self.particle_dv = None
+        self.multirate_particle_updates = 0
+
         self.mpm_state.grid_m = wp.zeros(
             shape=(self.mpm_model.n_grid, self.mpm_model.n_grid, self.mpm_model.n_grid),
             dtype=float,
@@ -181,6 +282,18 @@ class MPM_Simulator_WARP:
             inputs=[self.mpm_state.particle_F_trial],
             device=device,
         )
+        wp.launch(
+            kernel=set_quat_to_identity,
+            dim=self.n_particles,
+            inputs=[self.mpm_state.particle_polar_q],
+            device=device,
+        )
+        wp.launch(
+            kernel=set_quat_to_identity,
+            dim=self.n_particles,
+            inputs=[self.mpm_state.particle_R_q],
+            device=device,
+        )
         # initial deformation gradient is set to identity
 
         self.mpm_state.particle_vol = wp.from_numpy(
@@ -205,7 +318,7 @@ class MPM_Simulator_WARP:
         # assert tensor_x.shape[0] == tensor_cov.reshape(-1, 6).shape[0]
         self.initialize(self.n_particles, n_grid, grid_lim, device=device)
 
-        self.import_particle_x_from_torch(tensor_x, device)
+        self.import_particle_x_from_torch(tensor_x, device=device)
         self.mpm_state.particle_vol = wp.from_numpy(
             tensor_volume.detach().clone().cpu().numpy(), dtype=float, device=device
         )
@@ -235,6 +348,18 @@ class MPM_Simulator_WARP:
             inputs=[self.mpm_state.particle_F_trial],
             device=device,
         )
+        wp.launch(
+            kernel=set_quat_to_identity,
+            dim=self.n_particles,
+            inputs=[self.mpm_state.particle_polar_q],
+            device=device,
+        )
+        wp.launch(
+            kernel=set_quat_to_identity,
+            dim=self.n_particles,
+            inputs=[self.mpm_state.particle_R_q],
+            device=device,
+        )
         # initial trial deformation gradient is set to identity
 
         print("Particles initialized from torch data.")
@@ -245,21 +370,21 @@ class MPM_Simulator_WARP:
         self.set_parameters_dict(device, kwargs)
 
     def set_parameters_dict(self, kwargs={}, device="cuda:0"):
+        # back to the per-particle arrays until finalize_mu_lam checks again
+        self.mpm_model.uniform_params = 0
         if "material" in kwargs:
-            if kwargs["material"] == "jelly":
-                self.mpm_model.material = 0
-            elif kwargs["material"] == "metal":
-                self.mpm_model.material = 1
-            elif kwargs["material"] == "sand":
-                self.mpm_model.material = 2
-            elif kwargs["material"] == "foam":
-                self.mpm_model.material = 3
-            elif kwargs["material"] == "snow":
-                self.mpm_model.material = 4
-            elif kwargs["material"] == "plasticine":
-                self.mpm_model.material = 5
-            else:
-                raise TypeError("Undefined material type")
+            self.mpm_model.material = get_material_id(kwargs["material"])
+            wp.launch(
+                kernel=set_value_to_int_array,
+                dim=self.n_particles,
+                inputs=[self.mpm_state.particle_material, self.mpm_model.material],
+                device=device,
+            )
+        # per-particle material ids, e.g. from a per-Gaussian label file
+        if "particle_material" in kwargs:
+            self.import_particle_material_from_torch(
+                kwargs["particle_material"], device=device
+            )
 
         if "grid_lim" in kwargs:
             self.mpm_model.grid_lim = kwargs["grid_lim"]
@@ -352,6 +477,29 @@ class MPM_Simulator_WARP:
             self.mpm_model.softening = kwargs["softening"]
         if "grid_v_damping_scale" in kwargs:
             self.mpm_model.grid_v_damping_scale = kwargs["grid_v_damping_scale"]
+        if "polar_rotation" in kwargs:
+            self.mpm_model.polar_rotation = int(kwargs["polar_rotation"])
+        if "polar_max_iters" in kwargs:
+            self.mpm_model.polar_max_iters = kwargs["polar_max_iters"]
+        if "polar_tol" in kwargs:
+            self.mpm_model.polar_tol = kwargs["polar_tol"]
+        if "weight_cache" in kwargs:
+            self.enable_weight_cache(bool(kwargs["weight_cache"]), device=device)
+
+        # spatially varying parameters: a voxel volume, then per-particle values,
+        # then the boxes of additional_material_params, each overriding the last
+        if "material_field" in kwargs:
+            field = kwargs["material_field"]
+            self.set_material_field(
+                field["volumes"],
+                origin=field.get("origin"),
+                size=field.get("size"),
+                device=device,
+            )
+        if "particle_material_params" in kwargs:
+            self.import_particle_material_params_from_torch(
+                kwargs["particle_material_params"], device=device
+            )
 
         if "additional_material_params" in kwargs:
             for params in kwargs["additional_material_params"]:
@@ -361,6 +509,10 @@ class MPM_Simulator_WARP:
                 param_modifier.density = params["density"]
                 param_modifier.E = params["E"]
                 param_modifier.nu = params["nu"]
+                if "material" in params:
+                    param_modifier.material = get_material_id(params["material"])
+                else:
+                    param_modifier.material = -1
                 wp.launch(
                     kernel=apply_additional_params,
                     dim=self.n_particles,
@@ -368,6 +520,11 @@ class MPM_Simulator_WARP:
                     device=device,
                 )
 
+        if (
+            "material_field" in kwargs
+            or "particle_material_params" in kwargs
+            or "additional_material_params" in kwargs
+        ):
             wp.launch(
                 kernel=get_float_array_product,
                 dim=self.n_particles,
@@ -379,6 +536,220 @@ class MPM_Simulator_WARP:
                 device=device,
             )
 
+        if (
+            "material" in kwargs
+            or "particle_material" in kwargs
+            or "additional_material_params" in kwargs
+        ):
+            self.update_material_groups(device=device)
+
+        if "rigid_bodies" in kwargs:
+            for params in kwargs["rigid_bodies"]:
+                self.add_rigid_body_on_cuboid(
+                    params["point"], params["size"], device=device
+                )
+
+    # Samples material parameters from voxel volumes in MPM space in a single
+    # launch. volumes maps names of material_field_names to (X, Y, Z) arrays
+    # covering the box origin..origin+size (default the whole grid), sampled
+    # trilinearly at the particles. Particles outside the box keep their
+    # values; call before finalize_mu_lam. The mass is updated by
+    # set_parameters_dict, or by reset_densities_and_update_masses.
+    def set_material_field(self, volumes, origin=None, size=None, device="cuda:0"):
+        self.mpm_model.uniform_params = 0
+        unknown = set(volumes.keys()) - set(self.material_field_names)
+        if len(unknown) > 0:
+            raise ValueError("unknown material field channels: {}".format(unknown))
+        shape = None
+        channels = []
+        for name in self.material_field_names:
+            if name in volumes:
+                volume = torch.as_tensor(volumes[name], dtype=torch.float32)
+                if shape is not None and volume.shape != shape:
+                    raise ValueError("material field volumes differ in shape")
+                shape = volume.shape
+                channels.append(volume)
+            else:
+                channels.append(None)
+        if shape is None:
+            return
+        field = torch.stack(
+            [torch.zeros(shape) if c is None else c for c in channels]
+        ).contiguous()
+        has_channel = np.array([c is not None for c in channels], dtype=np.int32)
+
+        if origin is None:
+            origin = [0.0, 0.0, 0.0]
+        if size is None:
+            size = [self.mpm_model.grid_lim] * 3
+        wp.launch(
+            kernel=apply_material_field,
+            dim=self.n_particles,
+            inputs=[
+                self.mpm_state,
+                self.mpm_model,
+                wp.from_numpy(field.numpy(), dtype=float, device=device),
+                wp.from_numpy(has_channel, dtype=int, device=device),
+                wp.vec3(origin[0], origin[1], origin[2]),
+                wp.vec3(
+                    shape[0] / size[0],
+                    shape[1] / size[1],
+                    shape[2] / size[2],
+                ),
+            ],
+            device=device,
+        )
+
+    # per-particle material parameters, params maps names of
+    # material_field_names to (n_particles,) tensors
+    def import_particle_material_params_from_torch(self, params, device="cuda:0"):
+        self.mpm_model.uniform_params = 0
+        arrays = {
+            "E": self.mpm_model.E,
+            "nu": self.mpm_model.nu,
+            "density": self.mpm_state.particle_density,
+            "yield_stress": self.mpm_model.yield_stress,
+        }
+        for name, value in params.items():
+            if name not in arrays:
+                raise ValueError("unknown material parameter: {}".format(name))
+            target = wp.to_torch(arrays[name])
+            target.copy_(torch.as_tensor(value).reshape(-1).to(target))
+
+    # group particles by material so that each stress launch runs one material only.
+    # index lists are sorted, so every group still reads the particle arrays in order
+    def update_material_groups(self, device="cuda:0"):
+        # the rate classes keep per-material id lists too
+        self.rate_class_build = None
+        particle_material = self.mpm_state.particle_material.numpy()
+        material_ids = np.unique(particle_material)
+        self.material_groups = []
+        if len(material_ids) == 1:
+            self.mpm_model.material = int(material_ids[0])
+            return
+        for material_id in material_ids:
+            particle_ids = np.nonzero(particle_material == material_id)[0]
+            self.material_groups.append(
+                (
+                    int(material_id),
+                    wp.from_numpy(
+                        particle_ids.astype(np.int32), dtype=int, device=device
+                    ),
+                )
+            )
+
+    # largest substep allowed by the elastic wave speed sqrt((lam + 2 mu) / density)
+    # of the deformable particles on the current grid
+    def get_cfl_substep_dt(self, cfl=0.5):
+        E = wp.to_torch(self.mpm_model.E)
+        nu = wp.to_torch(self.mpm_model.nu)
+        density = wp.to_torch(self.mpm_state.particle_density)
+        deformable = wp.to_torch(self.mpm_state.particle_rigid_id) < 0
+        if not deformable.any():
+            return float("inf")
+        modulus = E * (1.0 - nu) / ((1.0 + nu) * (1.0 - 2.0 * nu))
+        wave_speed = torch.sqrt(modulus[deformable] / density[deformable]).max()
+        return cfl * self.mpm_model.dx / float(wave_speed)
+
+    # Rate classes for p2g2p_multirate. A particle with local wave speed
+    # c = sqrt((lam + 2 mu) / density) + |v| is stable with
+    # cfl * dx / c; it gets the level l whose substep coarse_dt / 2^l is the
+    # largest stable one, up to max_level. Each class also lists the
+    # simulated particles of other classes within halo_cells cells, which
+    # serve as its boundary data. The halo is built skin_cells * 2 cells wider,
+    # so the classes are only rebuilt once a level changes or a particle has
+    # moved skin_cells cells since the last build; otherwise the check is a
+    # single comparison on the device.
+    def update_rate_classes(
+        self,
+        coarse_dt,
+        cfl=0.5,
+        max_level=6,
+        halo_cells=3,
+        skin_cells=1,
+        device="cuda:0",
+    ):
+        E = wp.to_torch(self.mpm_model.E)
+        nu = wp.to_torch(self.mpm_model.nu)
+        density = wp.to_torch(self.mpm_state.particle_density)
+        speed = torch.linalg.norm(wp.to_torch(self.mpm_state.particle_v), dim=1)
+        modulus = E * (1.0 - nu) / ((1.0 + nu) * (1.0 - 2.0 * nu))
+        wave_speed = torch.sqrt(modulus / density) + speed
+        level = torch.ceil(
+            torch.log2(coarse_dt * wave_speed / (cfl * self.mpm_model.dx))
+        )
+        level = torch.clamp(torch.nan_to_num(level, nan=0.0), 0, max_level).long()
+        simulated = wp.to_torch(self.mpm_state.particle_selection) == 0
+        level = torch.where(simulated, level, -1)
+        x = wp.to_torch(self.mpm_state.particle_x)
+
+        built = self.rate_class_build
+        if (
+            built is not None
+            and built["key"] == (coarse_dt, halo_cells, skin_cells)
+            and built["level"].shape == level.shape
+            and bool(
+                torch.equal(built["level"], level)
+                and torch.linalg.norm(x - built["x"], dim=1).max()
+                < skin_cells * self.mpm_model.dx
+            )
+        ):
+            return len(self.rate_classes)
+        self.rate_class_build = {
+            "key": (coarse_dt, halo_cells, skin_cells),
+            "level": level,
+            "x": x.clone(),
+        }
+        halo_cells = halo_cells + 2 * skin_cells
+        material = wp.to_torch(self.mpm_state.particle_material)
+
+        n_grid = self.mpm_model.n_grid
+        cell = torch.clamp((x * self.mpm_model.inv_dx).long(), 0, n_grid - 1)
+        cell_id = (cell[:, 0] * n_grid + cell[:, 1]) * n_grid + cell[:, 2]
+
+        self.rate_classes = []
+        for l in range(int(level.max()) + 1):
+            in_class = level == l
+            if not in_class.any():
+                self.rate_classes.append(None)
+                continue
+            occupied = torch.zeros(n_grid**3, device=cell.device)
+            occupied[cell_id[in_class]] = 1.0
+            occupied = torch.nn.functional.max_pool3d(
+                occupied.reshape(1, 1, n_grid, n_grid, n_grid),
+                kernel_size=2 * halo_cells + 1,
+                stride=1,
+                padding=halo_cells,
+            ).reshape(-1)
+            halo = (level >= 0) & ~in_class & (occupied[cell_id] > 0)
+            active_ids = torch.nonzero(in_class).reshape(-1)
+            ids = torch.cat([active_ids, torch.nonzero(halo).reshape(-1)])
+
+            # stress launches per material, as in update_material_groups
+            groups = []
+            if len(self.material_groups) == 0:
+                groups.append((self.mpm_model.material, active_ids))
+            else:
+                for material_id in torch.unique(material[active_ids]).tolist():
+                    groups.append(
+                        (material_id, active_ids[material[active_ids] == material_id])
+                    )
+            self.rate_classes.append(
+                {
+                    "dt": coarse_dt / 2**l,
+                    "n_active": active_ids.shape[0],
+                    "ids": torch2warp_int(ids.int().contiguous(), dvc=device),
+                    "groups": [
+                        (
+                            material_id,
+                            torch2warp_int(group_ids.int().contiguous(), dvc=device),
+                        )
+                        for material_id, group_ids in groups
+                    ],
+                }
+            )
+        return len(self.rate_classes)
+
     def finalize_mu_lam(self, device="cuda:0"):
         wp.launch(
             kernel=compute_mu_lam_from_E_nu,
@@ -386,8 +757,53 @@ class MPM_Simulator_WARP:
             inputs=[self.mpm_state, self.mpm_model],
             device=device,
         )
+        self.update_uniform_params()
+
+    # Most scenes give every particle the same mu, lam and yield stress. Then the
+    # stress pass reads them from model scalars instead of per-particle arrays.
+    # Hardening and plasticine softening change them per particle and keep the
+    # arrays. Any parameter setter switches back until the next finalize_mu_lam.
+    def update_uniform_params(self):
+        model = self.mpm_model
+        model.uniform_params = 0
+        if model.hardening == 1:
+            return False
+        if (wp.to_torch(self.mpm_state.particle_material) == 5).any():
+            return False
+        values = []
+        for array in [model.mu, model.lam, model.yield_stress]:
+            array = wp.to_torch(array)
+            if array.shape[0] == 0 or array.min() != array.max():
+                return False
+            values.append(float(array[0]))
+        model.uniform_mu, model.uniform_lam, model.uniform_yield_stress = values
+        model.uniform_params = 1
+        return True
+
+    # Optional: p2g stores the 27 B-spline weights and weight gradients of every
+    # particle and g2p reads them back instead of recomputing them. This trades
+    # weight_cache_bytes_per_particle of memory and traffic for arithmetic, so it
+    # only helps compute-bound configurations, see benchmarks/bench_weight_cache.py.
+    # Results are identical either way.
+    def enable_weight_cache(self, enable=True, device="cuda:0"):
+        if not enable:
+            self.weight_cache = None
+            return
+        self.weight_cache = WeightCacheStruct()
+        self.weight_cache.weight = wp.zeros(
+            shape=(self.n_particles, 27), dtype=float, device=device
+        )
+        self.weight_cache.dweight = wp.zeros(
+            shape=(self.n_particles, 27), dtype=wp.vec3, device=device
+        )
 
     def p2g2p(self, step, dt, device="cuda:0"):
+        # particles may have been resampled since the cache was allocated
+        if (
+            self.weight_cache is not None
+            and self.weight_cache.weight.shape[0] != self.n_particles
+        ):
+            self.enable_weight_cache(device=device)
         grid_size = (
             self.mpm_model.grid_dim_x,
             self.mpm_model.grid_dim_y,
@@ -428,12 +844,27 @@ class MPM_Simulator_WARP:
             print=False,
             dict=self.time_profile,
         ):
-            wp.launch(
-                kernel=compute_stress_from_F_trial,
-                dim=self.n_particles,
-                inputs=[self.mpm_state, self.mpm_model, dt],
-                device=device,
-            )  # F and stress are updated
+            if len(self.material_groups) == 0:
+                wp.launch(
+                    kernel=compute_stress_from_F_trial,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.mpm_model, dt],
+                    device=device,
+                )  # F and stress are updated
+            else:
+                for material_id, particle_ids in self.material_groups:
+                    wp.launch(
+                        kernel=compute_stress_from_F_trial_grouped,
+                        dim=particle_ids.shape[0],
+                        inputs=[
+                            self.mpm_state,
+                            self.mpm_model,
+                            particle_ids,
+                            material_id,
+                            dt,
+                        ],
+                        device=device,
+                    )  # F and stress are updated
 
         # p2g
         with wp.ScopedTimer(
@@ -442,12 +873,20 @@ class MPM_Simulator_WARP:
             print=False,
             dict=self.time_profile,
         ):
-            wp.launch(
-                kernel=p2g_apic_with_stress,
-                dim=self.n_particles,
-                inputs=[self.mpm_state, self.mpm_model, dt],
-                device=device,
-            )  # apply p2g'
+            if self.weight_cache is not None:
+                wp.launch(
+                    kernel=p2g_apic_with_stress_cached,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.mpm_model, self.weight_cache, dt],
+                    device=device,
+                )  # apply p2g', keep the weights for g2p
+            else:
+                wp.launch(
+                    kernel=p2g_apic_with_stress,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.mpm_model, dt],
+                    device=device,
+                )  # apply p2g'
 
         # grid update
         with wp.ScopedTimer(
@@ -492,23 +931,683 @@ class MPM_Simulator_WARP:
         with wp.ScopedTimer(
             "g2p", synchronize=True, print=False, dict=self.time_profile
         ):
+            if self.weight_cache is not None:
+                wp.launch(
+                    kernel=g2p_cached,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.mpm_model, self.weight_cache, dt],
+                    device=device,
+                )  # x, v, C, F_trial are updated
+            else:
+                wp.launch(
+                    kernel=g2p,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.mpm_model, dt],
+                    device=device,
+                )  # x, v, C, F_trial are updated
+
+        # rigid particles move with one linear and angular velocity per body
+        if self.n_rigid_bodies > 0:
+            with wp.ScopedTimer(
+                "rigid_bodies", synchronize=True, print=False, dict=self.time_profile
+            ):
+                wp.launch(
+                    kernel=zero_rigid_bodies,
+                    dim=self.n_rigid_bodies,
+                    inputs=[self.rigid_bodies],
+                    device=device,
+                )
+                wp.launch(
+                    kernel=accumulate_rigid_bodies,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.rigid_bodies, dt],
+                    device=device,
+                )
+                wp.launch(
+                    kernel=compute_rigid_body_velocity,
+                    dim=self.n_rigid_bodies,
+                    inputs=[self.rigid_bodies],
+                    device=device,
+                )
+                wp.launch(
+                    kernel=project_rigid_particles,
+                    dim=self.n_particles,
+                    inputs=[self.mpm_state, self.mpm_model, self.rigid_bodies, dt],
+                    device=device,
+                )
+
+        # CFL and other health checks: see compute_diagnostics
+        if self.guard_enabled:
             wp.launch(
-                kernel=g2p,
+                kernel=check_particle_guard,
                 dim=self.n_particles,
-                inputs=[self.mpm_state, self.mpm_model, dt],
+                inputs=[self.mpm_state, self.mpm_model, self.guard],
+                device=device,
+            )
+            wp.launch(
+                kernel=check_grid_guard,
+                dim=(grid_size),
+                inputs=[self.mpm_state, self.guard],
                 device=device,
-            )  # x, v, C, F_trial are updated
-
-        #### CFL check ####
-        # particle_v = self.mpm_state.particle_v.numpy()
-        # if np.max(np.abs(particle_v)) > self.mpm_model.dx / dt:
-        #     print("max particle v: ", np.max(np.abs(particle_v)))
-        #     print("max allowed  v: ", self.mpm_model.dx / dt)
-        #     print("does not allow v*dt>dx")
-        #     input()
-        #### CFL check ####
+            )
         self.time = self.time + dt
 
+    # One step of dt with multi-rate subcycling: the class of level l takes
+    # 2^l substeps of dt / 2^l (see update_rate_classes), so soft regions do
+    # not pay for the substep of a small stiff one. Classes are stepped one
+    # after the other on the shared grid; at every fine substep the due
+    # classes go from coarse to fine. The momentum a class exchanges with its
+    # halo is handed to the halo particles at their own next substep (or at
+    # the end of the step), so total momentum is conserved. Particle
+    # operations and collider motion advance with the finest substep.
+    # Rigid bodies are projected once per substep of the whole scene, so they
+    # cannot be subcycled.
+    def p2g2p_multirate(
+        self,
+        step,
+        dt,
+        cfl=0.5,
+        max_level=6,
+        halo_cells=3,
+        skin_cells=1,
+        device="cuda:0",
+    ):
+        if self.n_rigid_bodies > 0:
+            raise ValueError("multi-rate stepping does not support rigid bodies")
+        grid_size = (
+            self.mpm_model.grid_dim_x,
+            self.mpm_model.grid_dim_y,
+            self.mpm_model.grid_dim_z,
+        )
+        n_levels = self.update_rate_classes(
+            dt,
+            cfl=cfl,
+            max_level=max_level,
+            halo_cells=halo_cells,
+            skin_cells=skin_cells,
+            device=device,
+        )
+        n_fine = 2 ** (n_levels - 1)
+        fine_dt = dt / n_fine
+        # time each particle's x and v belong to, relative to the step start
+        self.particle_time = wp.zeros(
+            shape=self.n_particles, dtype=float, device=device
+        )
+        if self.particle_dv is None or self.particle_dv.shape[0] != self.n_particles:
+            self.particle_dv = wp.zeros(
+                shape=self.n_particles, dtype=wp.vec3, device=device
+            )
+        start_time = self.time
+
+        for j in range(n_fine):
+            t = j * fine_dt
+            self.time = start_time + t
+            for k in range(len(self.pre_p2g_operations)):
+                wp.launch(
+                    kernel=self.pre_p2g_operations[k],
+                    dim=self.n_particles,
+                    inputs=[self.time, fine_dt, self.mpm_state, self.impulse_params[k]],
+                    device=device,
+                )
+            for k in range(len(self.particle_velocity_modifiers)):
+                wp.launch(
+                    kernel=self.particle_velocity_modifiers[k],
+                    dim=self.n_particles,
+                    inputs=[
+                        self.time,
+                        self.mpm_state,
+                        self.particle_velocity_modifier_params[k],
+                    ],
+                    device=device,
+                )
+
+            for l, rate_class in enumerate(self.rate_classes):
+                if rate_class is None or j % 2 ** (n_levels - 1 - l) != 0:
+                    continue
+                class_dt = rate_class["dt"]
+                self.multirate_particle_updates += rate_class["n_active"]
+
+                with wp.ScopedTimer(
+                    "compute_stress_from_F_trial",
+                    synchronize=True,
+                    print=False,
+                    dict=self.time_profile,
+                ):
+                    for material_id, particle_ids in rate_class["groups"]:
+                        wp.launch(
+                            kernel=compute_stress_from_F_trial_grouped,
+                            dim=particle_ids.shape[0],
+                            inputs=[
+                                self.mpm_state,
+                                self.mpm_model,
+                                particle_ids,
+                                material_id,
+                                class_dt,
+                            ],
+                            device=device,
+                        )
+
+                with wp.ScopedTimer(
+                    "p2g", synchronize=True, print=False, dict=self.time_profile
+                ):
+                    wp.launch(
+                        kernel=zero_grid,
+                        dim=(grid_size),
+                        inputs=[self.mpm_state, self.mpm_model],
+                        device=device,
+                    )
+                    wp.launch(
+                        kernel=p2g_apic_multirate,
+                        dim=rate_class["ids"].shape[0],
+                        inputs=[
+                            self.mpm_state,
+                            self.mpm_model,
+                            rate_class["ids"],
+                            self.particle_time,
+                            self.particle_dv,
+                            rate_class["n_active"],
+                            t,
+                            class_dt,
+                        ],
+                        device=device,
+                    )
+
+                with wp.ScopedTimer(
+                    "grid_update", synchronize=True, print=False, dict=self.time_profile
+                ):
+                    wp.launch(
+                        kernel=grid_normalization_and_gravity,
+                        dim=(grid_size),
+                        inputs=[self.mpm_state, self.mpm_model, class_dt],
+                        device=device,
+                    )
+                    if self.mpm_model.grid_v_damping_scale < 1.0:
+                        wp.launch(
+                            kernel=add_damping_via_grid,
+                            dim=(grid_size),
+                            inputs=[
+                                self.mpm_state,
+                                self.mpm_model.grid_v_damping_scale,
+                            ],
+                            device=device,
+                        )
+
+                with wp.ScopedTimer(
+                    "apply_BC_on_grid",
+                    synchronize=True,
+                    print=False,
+                    dict=self.time_profile,
+                ):
+                    for k in range(len(self.grid_postprocess)):
+                        wp.launch(
+                            kernel=self.grid_postprocess[k],
+                            dim=grid_size,
+                            inputs=[
+                                self.time,
+                                class_dt,
+                                self.mpm_state,
+                                self.mpm_model,
+                                self.collider_params[k],
+                            ],
+                            device=device,
+                        )
+
+                with wp.ScopedTimer(
+                    "g2p", synchronize=True, print=False, dict=self.time_profile
+                ):
+                    wp.launch(
+                        kernel=g2p_multirate,
+                        dim=rate_class["ids"].shape[0],
+                        inputs=[
+                            self.mpm_state,
+                            self.mpm_model,
+                            rate_class["ids"],
+                            self.particle_time,
+                            self.particle_dv,
+                            rate_class["n_active"],
+                            t,
+                            class_dt,
+                        ],
+                        device=device,
+                    )
+
+            for k in range(len(self.grid_postprocess)):
+                if self.modify_bc[k] is not None:
+                    self.modify_bc[k](self.time, fine_dt, self.collider_params[k])
+
+        # what the coarser classes received after their last substep
+        wp.launch(
+            kernel=apply_particle_dv,
+            dim=self.n_particles,
+            inputs=[self.mpm_state, self.particle_dv],
+            device=device,
+        )
+
+        if self.guard_enabled:
+            wp.launch(
+                kernel=check_particle_guard,
+                dim=self.n_particles,
+                inputs=[self.mpm_state, self.mpm_model, self.guard],
+                device=device,
+            )
+        self.time = start_time + dt
+
+    # Reads and clears the guard counters of the substeps since the last call,
+    # meant to be called once per frame. Returns None if every stage stayed
+    # finite, otherwise a report with the offending count per stage and the
+    # first few offending particles (or grid nodes) of each stage. Offending
+    # particles have been frozen with selection 2 by the guard kernel.
+    def check_guard(self, device="cuda:0", max_ids=10):
+        counts = self.guard.numpy().copy()
+        if counts.sum() == 0:
+            return None
+        self.guard.zero_()
+
+        # particle ids, or [x, y, z] for grid nodes. nodes are zeroed every
+        # substep, so only a nan of the last substep still shows up there
+        def first_ids(bad):
+            ids = torch.nonzero(bad)
+            if bad.dim() == 1:
+                ids = ids.reshape(-1)
+            return ids[:max_ids].tolist()
+
+        def non_finite(t):
+            return ~torch.isfinite(t.reshape(t.shape[0], -1)).all(dim=1)
+
+        state = self.mpm_state
+        frozen = wp.to_torch(state.particle_selection) == 2
+        grid_pos = wp.to_torch(state.particle_x) * self.mpm_model.inv_dx
+        upper = torch.tensor(
+            [
+                self.mpm_model.grid_dim_x,
+                self.mpm_model.grid_dim_y,
+                self.mpm_model.grid_dim_z,
+            ],
+            device=grid_pos.device,
+        )
+        bad = {
+            "stress": non_finite(wp.to_torch(state.particle_stress)),
+            "grid": non_finite(wp.to_torch(state.grid_v_out).reshape(-1, 3)),
+            "g2p": non_finite(wp.to_torch(state.particle_v))
+            | non_finite(wp.to_torch(state.particle_C)),
+            "deformation_gradient": non_finite(wp.to_torch(state.particle_F_trial)),
+            "out_of_grid": ~((grid_pos >= 0.5) & (grid_pos < upper - 1.5)).all(dim=1),
+        }
+        report = {
+            "time": self.time,
+            "frozen_particles": int(frozen.sum()),
+            "stages": {},
+        }
+        for name, count in zip(self.guard_stages, counts):
+            if count > 0:
+                if name == "grid":
+                    ids = first_ids(bad[name].reshape(wp.to_torch(state.grid_m).shape))
+                else:
+                    ids = first_ids(bad[name] & frozen)
+                # counts add up over the substeps since the last check
+                report["stages"][name] = {"count": int(count), "ids": ids}
+        return report
+
+    # Copy of the particle arrays, material parameters, time, colliders,
+    # particle modifiers and rigid bodies, enough to step again from here with
+    # another dt or to branch off variants, see clone. Structs are copied and
+    # every per-particle array is cloned on the device, kernels are shared.
+    def snapshot(self):
+        return {
+            "n_particles": self.n_particles,
+            "time": self.time,
+            "arrays": [
+                wp.clone(getattr(owner, name))
+                for owner, name, _, _ in self.get_particle_arrays()
+            ],
+            # the arrays of these structs are part of "arrays" above
+            "model": clone_struct(self.mpm_model, share_arrays=True),
+            "impulse_params": [
+                clone_struct(param, share_arrays=True) for param in self.impulse_params
+            ],
+            "particle_velocity_modifier_params": [
+                clone_struct(param, share_arrays=True)
+                for param in self.particle_velocity_modifier_params
+            ],
+            # the sdf of an sdf collider never changes
+            "collider_params": [
+                clone_struct(param, share_arrays=True) for param in self.collider_params
+            ],
+            "tailored_struct_for_bc": clone_struct(self.tailored_struct_for_bc),
+            "grid_postprocess": list(self.grid_postprocess),
+            "modify_bc": list(self.modify_bc),
+            "pre_p2g_operations": list(self.pre_p2g_operations),
+            "particle_velocity_modifiers": list(self.particle_velocity_modifiers),
+            "rigid_bodies": clone_struct(self.rigid_bodies),
+            "n_rigid_bodies": self.n_rigid_bodies,
+        }
+
+    # restores a snapshot, which stays valid and can be restored again
+    def restore(self, snapshot, device="cuda:0"):
+        self.mpm_model = clone_struct(snapshot["model"], share_arrays=True)
+        self.impulse_params = [
+            clone_struct(param, share_arrays=True)
+            for param in snapshot["impulse_params"]
+        ]
+        self.particle_velocity_modifier_params = [
+            clone_struct(param, share_arrays=True)
+            for param in snapshot["particle_velocity_modifier_params"]
+        ]
+        # get_particle_arrays lists the arrays of the structs restored above
+        for (owner, name, _, _), value in zip(
+            self.get_particle_arrays(), snapshot["arrays"]
+        ):
+            setattr(owner, name, wp.clone(value))
+        self.collider_params = [
+            clone_struct(param, share_arrays=True)
+            for param in snapshot["collider_params"]
+        ]
+        self.tailored_struct_for_bc = clone_struct(snapshot["tailored_struct_for_bc"])
+        self.grid_postprocess = list(snapshot["grid_postprocess"])
+        self.modify_bc = list(snapshot["modify_bc"])
+        self.pre_p2g_operations = list(snapshot["pre_p2g_operations"])
+        self.particle_velocity_modifiers = list(snapshot["particle_velocity_modifiers"])
+        self.rigid_bodies = clone_struct(snapshot["rigid_bodies"])
+        self.n_rigid_bodies = snapshot["n_rigid_bodies"]
+        self.n_particles = snapshot["n_particles"]
+        self.time = snapshot["time"]
+        self.guard.zero_()
+        self.update_material_groups(device=device)
+
+    # Independent copy of the simulator, to simulate a shared prefix once and
+    # branch variants from it (other impulses, colliders or E). Everything the
+    # copy writes to is its own, only the compiled kernels are shared.
+    def clone(self, device="cuda:0"):
+        other = copy.copy(self)
+        other.mpm_state = clone_struct(self.mpm_state, share_arrays=True)
+        for name in ["grid_m", "grid_v_in", "grid_v_out"]:
+            setattr(other.mpm_state, name, wp.zeros_like(getattr(self.mpm_state, name)))
+        other.diagnostics = wp.zeros_like(self.diagnostics)
+        other.guard = wp.zeros_like(self.guard)
+        other.time_profile = {}
+        other.rate_classes = []
+        other.rate_class_build = None
+        other.particle_time = None
+        other.particle_dv = None
+        other.restore(self.snapshot(), device=device)
+        if self.weight_cache is not None:
+            other.enable_weight_cache(device=device)
+        return other
+
+    # Energy, momentum, max speed, min/max det(F_trial) and grid mass of the
+    # current state. Reduced on the device into a few floats that are copied
+    # to the host in one transfer, meant to be called once per frame.
+    # cfl = max_speed * dt / dx should stay below 1.
+    def compute_diagnostics(self, dt, device="cuda:0"):
+        grid_size = (
+            self.mpm_model.grid_dim_x,
+            self.mpm_model.grid_dim_y,
+            self.mpm_model.grid_dim_z,
+        )
+        wp.launch(
+            kernel=reset_diagnostics,
+            dim=len(self.diagnostics_names),
+            inputs=[self.diagnostics],
+            device=device,
+        )
+        wp.launch(
+            kernel=compute_particle_diagnostics,
+            dim=self.n_particles,
+            inputs=[self.mpm_state, self.mpm_model, self.diagnostics],
+            device=device,
+        )
+        wp.launch(
+            kernel=compute_grid_diagnostics,
+            dim=grid_size,
+            inputs=[self.mpm_state, self.diagnostics],
+            device=device,
+        )
+        values = self.diagnostics.numpy()
+        diagnostics = {
+            name: float(value) for name, value in zip(self.diagnostics_names, values)
+        }
+        diagnostics["cfl"] = diagnostics["max_speed"] * dt / self.mpm_model.dx
+        diagnostics["time"] = self.time
+        return diagnostics
+
+    # particle arrays a substep produces, everything else is shared between substeps
+    substep_arrays = ["particle_x", "particle_v", "particle_C", "particle_F_trial"]
+
+    # state for one differentiable substep with its own substep_arrays, F,
+    # stress and grid; the remaining arrays are taken from shared_state
+    def create_substep_state(self, shared_state, requires_grad=True, device="cuda:0"):
+        state = MPMStateStruct()
+        for name in MPMStateStruct.vars:
+            setattr(state, name, getattr(shared_state, name))
+        n = self.n_particles
+        grid_size = (
+            self.mpm_model.grid_dim_x,
+            self.mpm_model.grid_dim_y,
+            self.mpm_model.grid_dim_z,
+        )
+        for name, dtype in [
+            ("particle_x", wp.vec3),
+            ("particle_v", wp.vec3),
+            ("particle_C", wp.mat33),
+            ("particle_F_trial", wp.mat33),
+            ("particle_F", wp.mat33),
+            ("particle_stress", wp.mat33),
+        ]:
+            setattr(
+                state,
+                name,
+                wp.zeros(shape=n, dtype=dtype, device=device, requires_grad=requires_grad),
+            )
+        state.grid_m = wp.zeros(
+            shape=grid_size, dtype=float, device=device, requires_grad=requires_grad
+        )
+        state.grid_v_in = wp.zeros(
+            shape=grid_size, dtype=wp.vec3, device=device, requires_grad=requires_grad
+        )
+        state.grid_v_out = wp.zeros(
+            shape=grid_size, dtype=wp.vec3, device=device, requires_grad=requires_grad
+        )
+        return state
+
+    # one substep from state to next_state without in-place updates, so it can
+    # be recorded on a wp.Tape. No boundary conditions, see compute_trajectory_gradients
+    def p2g2p_to_state(self, state, next_state, dt, device="cuda:0"):
+        grid_size = (
+            self.mpm_model.grid_dim_x,
+            self.mpm_model.grid_dim_y,
+            self.mpm_model.grid_dim_z,
+        )
+        if len(self.material_groups) == 0:
+            wp.launch(
+                kernel=compute_stress_from_F_trial,
+                dim=self.n_particles,
+                inputs=[state, self.mpm_model, dt],
+                device=device,
+            )
+        else:
+            for material_id, particle_ids in self.material_groups:
+                wp.launch(
+                    kernel=compute_stress_from_F_trial_grouped,
+                    dim=particle_ids.shape[0],
+                    inputs=[state, self.mpm_model, particle_ids, material_id, dt],
+                    device=device,
+                )
+        wp.launch(
+            kernel=zero_grid,
+            dim=grid_size,
+            inputs=[state, self.mpm_model],
+            device=device,
+        )
+        wp.launch(
+            kernel=p2g_apic_with_stress,
+            dim=self.n_particles,
+            inputs=[state, self.mpm_model, dt],
+            device=device,
+        )
+        wp.launch(
+            kernel=grid_normalization_and_gravity,
+            dim=grid_size,
+            inputs=[state, self.mpm_model, dt],
+            device=device,
+        )
+        wp.launch(
+            kernel=g2p_to_next_state,
+            dim=self.n_particles,
+            inputs=[state, next_state, self.mpm_model, dt],
+            device=device,
+        )
+
+    # Gradient of a trajectory loss w.r.t. the per-particle E, nu and density,
+    # starting from the current state, which is left unchanged.
+    # targets maps a substep count t to observed positions (n, 3) after t substeps,
+    # loss = sum_t mean_p |x_p(t) - target_p(t)|^2.
+    # The forward pass only keeps substep_arrays every checkpoint_every substeps
+    # (default sqrt(T)); backward recomputes one segment at a time on a wp.Tape,
+    # so memory is O(T / K + K) substep states instead of O(T).
+    # returns (loss, {"E": grad, "nu": grad, "density": grad}) as torch tensors
+    def compute_trajectory_gradients(
+        self, targets, dt, num_substeps=None, checkpoint_every=None, device="cuda:0"
+    ):
+        # only plain substeps are differentiable: every listed feature either
+        # has no adjoint or writes yield_stress, mu or lam in place during the
+        # step, which would silently corrupt the gradients of the parameters
+        model = self.mpm_model
+        materials = set(wp.to_torch(self.mpm_state.particle_material).unique().tolist())
+        unsupported = []
+        if len(self.grid_postprocess) > 0:
+            unsupported.append("grid boundary conditions")
+        if len(self.pre_p2g_operations) > 0:
+            unsupported.append("particle impulses")
+        if len(self.particle_velocity_modifiers) > 0:
+            unsupported.append("particle velocity modifiers")
+        if self.n_rigid_bodies > 0:
+            unsupported.append("rigid bodies")
+        if model.update_cov_with_F:
+            unsupported.append("covariance update with F")
+        if model.grid_v_damping_scale < 1.0:
+            unsupported.append("grid damping")
+        if model.hardening == 1:
+            unsupported.append("hardening (xi updates yield_stress in place)")
+        if 5 in materials:
+            unsupported.append(
+                "plasticine (softening updates yield_stress and zeroes mu and lam "
+                "in place)"
+            )
+        if len(unsupported) > 0:
+            raise ValueError(
+                "compute_trajectory_gradients does not support: "
+                + ", ".join(unsupported)
+            )
+        if num_substeps is None:
+            num_substeps = max(targets.keys())
+        if checkpoint_every is None:
+            checkpoint_every = max(1, int(math.ceil(math.sqrt(num_substeps))))
+        n = self.n_particles
+        target_x = {
+            t: torch2warp_vec3(x.detach().float().contiguous(), dvc=device)
+            for t, x in targets.items()
+        }
+
+        # grad-enabled copies of the parameters and of the shared particle arrays
+        saved_model = {
+            name: getattr(model, name) for name in ["E", "nu", "mu", "lam", "yield_stress"]
+        }
+        saved_polar_rotation = model.polar_rotation
+        saved_uniform_params = model.uniform_params
+        # the warm-started polar iteration has a data-dependent loop, svd has an adjoint
+        model.polar_rotation = 0
+        # gradients flow through the per-particle arrays
+        model.uniform_params = 0
+        for name, array in saved_model.items():
+            setattr(model, name, wp.clone(array, requires_grad=True))
+        shared_state = MPMStateStruct()
+        for name in MPMStateStruct.vars:
+            array = getattr(self.mpm_state, name)
+            if array.dtype == wp.int32:
+                setattr(shared_state, name, array)
+            else:
+                setattr(shared_state, name, wp.clone(array, requires_grad=True))
+
+        # mu, lam and mass as functions of E, nu and density
+        param_tape = wp.Tape()
+        with param_tape:
+            wp.launch(
+                kernel=compute_mu_lam_from_E_nu,
+                dim=n,
+                inputs=[shared_state, model],
+                device=device,
+            )
+            wp.launch(
+                kernel=get_float_array_product,
+                dim=n,
+                inputs=[
+                    shared_state.particle_density,
+                    shared_state.particle_vol,
+                    shared_state.particle_mass,
+                ],
+                device=device,
+            )
+
+        # forward, keeping only checkpoints
+        state = self.create_substep_state(shared_state, False, device)
+        next_state = self.create_substep_state(shared_state, False, device)
+        for name in self.substep_arrays:
+            wp.copy(getattr(state, name), getattr(self.mpm_state, name))
+        checkpoints = {}
+        for t in range(num_substeps):
+            if t % checkpoint_every == 0:
+                checkpoints[t] = [
+                    wp.clone(getattr(state, name)) for name in self.substep_arrays
+                ]
+            self.p2g2p_to_state(state, next_state, dt, device)
+            state, next_state = next_state, state
+
+        # backward, one recomputed segment at a time
+        loss_total = 0.0
+        adj = None  # adjoint of substep_arrays at the end of the segment
+        for start in sorted(checkpoints.keys(), reverse=True):
+            end = min(start + checkpoint_every, num_substeps)
+            states = [
+                self.create_substep_state(shared_state, True, device)
+                for _ in range(end - start + 1)
+            ]
+            for name, array in zip(self.substep_arrays, checkpoints.pop(start)):
+                wp.copy(getattr(states[0], name), array)
+            loss = wp.zeros(shape=1, dtype=float, device=device, requires_grad=True)
+            tape = wp.Tape()
+            with tape:
+                for t in range(start, end):
+                    self.p2g2p_to_state(
+                        states[t - start], states[t - start + 1], dt, device
+                    )
+                    if t + 1 in target_x:
+                        wp.launch(
+                            kernel=add_position_loss,
+                            dim=n,
+                            inputs=[states[t + 1 - start], target_x[t + 1], 1.0 / n, loss],
+                            device=device,
+                        )
+            if adj is not None:
+                for name, grad in zip(self.substep_arrays, adj):
+                    wp.copy(getattr(states[-1], name).grad, grad)
+            tape.backward(loss=loss)
+            loss_total += float(loss.numpy()[0])
+            adj = [wp.clone(getattr(states[0], name).grad) for name in self.substep_arrays]
+
+        # gradients on mu, lam and mass have accumulated over all segments
+        param_tape.backward()
+        grads = {
+            "E": wp.to_torch(model.E.grad).clone(),
+            "nu": wp.to_torch(model.nu.grad).clone(),
+            "density": wp.to_torch(shared_state.particle_density.grad).clone(),
+        }
+
+        for name, array in saved_model.items():
+            setattr(model, name, array)
+        model.polar_rotation = saved_polar_rotation
+        model.uniform_params = saved_uniform_params
+        return loss_total, grads
+
     # set particle densities to all_particle_densities,
     def reset_densities_and_update_masses(
         self, all_particle_densities, device="cuda:0"
@@ -558,6 +1657,17 @@ class MPM_Simulator_WARP:
             tensor_C = torch.reshape(tensor_C, (-1, 3, 3))  # arranged by rowmajor
             self.mpm_state.particle_C = torch2warp_mat33(tensor_C, dvc=device)
 
+    # material ids as in get_material_id, one per particle
+    def import_particle_material_from_torch(self, tensor_material, device="cuda:0"):
+        if tensor_material is not None:
+            self.mpm_model.uniform_params = 0
+            self.mpm_state.particle_material = wp.from_numpy(
+                tensor_material.detach().cpu().numpy().astype(np.int32),
+                dtype=int,
+                device=device,
+            )
+            self.update_material_groups(device=device)
+
     def export_particle_x_to_torch(self):
         return wp.to_torch(self.mpm_state.particle_x)
 
@@ -610,11 +1720,261 @@ class MPM_Simulator_WARP:
         cov = wp.to_torch(self.mpm_state.particle_cov)
         return cov
 
+    # render Gaussian g follows particle render_particle_ids[g] at offset
+    # F_trial * render_offsets[g], so the Gaussians can still be rendered after
+    # resample_particles has merged or split the particles they started on
+    def init_render_mapping(self, n_render):
+        particle_x = wp.to_torch(self.mpm_state.particle_x)
+        self.render_particle_ids = torch.arange(n_render, device=particle_x.device)
+        self.render_offsets = torch.zeros((n_render, 3), device=particle_x.device)
+        self.render_init_cov = (
+            wp.to_torch(self.mpm_state.particle_init_cov)
+            .reshape(-1, 6)[:n_render]
+            .clone()
+        )
+
+    def export_render_x_to_torch(self):
+        ids = self.render_particle_ids
+        x = wp.to_torch(self.mpm_state.particle_x)[ids]
+        F = wp.to_torch(self.mpm_state.particle_F_trial)[ids]
+        return x + torch.bmm(F, self.render_offsets.unsqueeze(-1)).squeeze(-1)
+
+    def export_render_cov_to_torch(self):
+        F = wp.to_torch(self.mpm_state.particle_F_trial)[self.render_particle_ids]
+        c = self.render_init_cov
+        init_cov = torch.stack(
+            [c[:, 0], c[:, 1], c[:, 2], c[:, 1], c[:, 3], c[:, 4], c[:, 2], c[:, 4], c[:, 5]],
+            dim=-1,
+        ).reshape(-1, 3, 3)
+        cov = torch.bmm(torch.bmm(F, init_cov), F.transpose(1, 2))
+        cov = torch.stack(
+            [cov[:, 0, 0], cov[:, 0, 1], cov[:, 0, 2], cov[:, 1, 1], cov[:, 1, 2], cov[:, 2, 2]],
+            dim=-1,
+        )
+        return cov.reshape(-1)
+
+    def export_render_R_to_torch(self, device="cuda:0"):
+        R_tensor = self.export_particle_R_to_torch(device=device)
+        return R_tensor[self.render_particle_ids]
+
+    # every per-particle array: (owner struct, attribute, torch2warp, how resample_particles merges it)
+    def get_particle_arrays(self):
+        state, model = self.mpm_state, self.mpm_model
+        arrays = [
+            (state, "particle_x", torch2warp_vec3, "mean"),
+            (state, "particle_v", torch2warp_vec3, "mean"),
+            (state, "particle_F", torch2warp_mat33, "mean"),
+            (state, "particle_F_trial", torch2warp_mat33, "mean"),
+            (state, "particle_R", torch2warp_mat33, "first"),
+            (state, "particle_polar_q", torch2warp_quat, "first"),
+            (state, "particle_R_q", torch2warp_quat, "first"),
+            (state, "particle_stress", torch2warp_mat33, "first"),
+            (state, "particle_C", torch2warp_mat33, "mean"),
+            (state, "particle_init_cov", torch2warp_float, "first"),
+            (state, "particle_cov", torch2warp_float, "first"),
+            (state, "particle_vol", torch2warp_float, "sum"),
+            (state, "particle_mass", torch2warp_float, "sum"),
+            (state, "particle_density", torch2warp_float, "mean"),
+            (state, "particle_Jp", torch2warp_float, "mean"),
+            (state, "particle_selection", torch2warp_int, "first"),
+            (state, "particle_material", torch2warp_int, "first"),
+            (state, "particle_rigid_id", torch2warp_int, "first"),
+            (model, "E", torch2warp_float, "mean"),
+            (model, "nu", torch2warp_float, "mean"),
+            (model, "mu", torch2warp_float, "mean"),
+            (model, "lam", torch2warp_float, "mean"),
+            (model, "yield_stress", torch2warp_float, "mean"),
+        ]
+        # particle masks of impulses and velocity modifiers
+        for param in self.impulse_params + self.particle_velocity_modifier_params:
+            arrays.append((param, "mask", torch2warp_int, "max"))
+        return arrays
+
+    # Adaptive resampling, meant to run every few frames.
+    # Merge: in cells holding more than max_particles_per_cell simulated particles,
+    # particles of the same material that share a sub-cell (about
+    # max_particles_per_cell sub-cells per cell) become one particle. Mass and
+    # volume are summed; x, v, F, C and material parameters are mass-weighted,
+    # which keeps mass, linear momentum and the mean deformation.
+    # Split: a particle whose current extent vol^(1/3) * sigma_max(F) exceeds
+    # split_extent (default dx) is halved along its direction of largest stretch.
+    # Both halves keep v and F, so mass and momentum are unchanged.
+    def resample_particles(
+        self, max_particles_per_cell=8, split_extent=None, device="cuda:0"
+    ):
+        if split_extent is None:
+            split_extent = self.mpm_model.dx
+        if self.render_particle_ids is not None:
+            render_x = self.export_render_x_to_torch()
+
+        n = self.n_particles
+        arrays = self.get_particle_arrays()
+        values = [
+            wp.to_torch(getattr(owner, name)).reshape(n, -1)
+            for owner, name, _, _ in arrays
+        ]
+        x = wp.to_torch(self.mpm_state.particle_x)
+        mass = wp.to_torch(self.mpm_state.particle_mass)
+        material = wp.to_torch(self.mpm_state.particle_material).long()
+        # rigid particles carry no stress and are left alone
+        active = (wp.to_torch(self.mpm_state.particle_selection) == 0) & (
+            wp.to_torch(self.mpm_state.particle_rigid_id) < 0
+        )
+        index = torch.arange(n, device=x.device)
+
+        # merge
+        n_grid = self.mpm_model.n_grid
+        cell = torch.clamp((x * self.mpm_model.inv_dx).long(), 0, n_grid - 1)
+        cell_id = (cell[:, 0] * n_grid + cell[:, 1]) * n_grid + cell[:, 2]
+        counts = torch.bincount(cell_id[active], minlength=n_grid**3)
+        dense = active & (counts[cell_id] > max_particles_per_cell)
+
+        sub = max(1, int(round(max_particles_per_cell ** (1.0 / 3.0))))
+        n_sub = n_grid * sub
+        sub_cell = torch.clamp(
+            (x * self.mpm_model.inv_dx * sub).long(), 0, n_sub - 1
+        )
+        key = ((sub_cell[:, 0] * n_sub + sub_cell[:, 1]) * n_sub + sub_cell[:, 2]) * 8
+        key = torch.where(dense, key + material, -1 - index)
+        _, group = torch.unique(key, return_inverse=True)
+        n_group = int(group.max()) + 1
+        # new particles keep the order of their first member
+        first = torch.full((n_group,), n, device=x.device).scatter_reduce(
+            0, group, index, "amin"
+        )
+        order = torch.argsort(first)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(n_group, device=x.device)
+        group, first = rank[group], first[order]
+        group_size = torch.bincount(group, minlength=n_group)
+        merged = group_size > 1
+        group_mass = torch.zeros(n_group, device=x.device).index_add_(0, group, mass)
+
+        for k, (_, _, _, reduction) in enumerate(arrays):
+            value = values[k]
+            new_value = value[first].clone()
+            if reduction == "mean":
+                reduced = torch.zeros(
+                    (n_group, value.shape[1]), dtype=value.dtype, device=x.device
+                ).index_add_(0, group, value * mass.unsqueeze(-1))
+                reduced = reduced / group_mass.unsqueeze(-1)
+            elif reduction == "sum":
+                reduced = torch.zeros(
+                    (n_group, value.shape[1]), dtype=value.dtype, device=x.device
+                ).index_add_(0, group, value)
+            elif reduction == "max":
+                reduced = torch.zeros(
+                    (n_group, value.shape[1]), dtype=value.dtype, device=x.device
+                ).scatter_reduce(
+                    0, group.unsqueeze(-1).expand_as(value), value, "amax"
+                )
+            else:
+                reduced = new_value
+            new_value[merged] = reduced[merged]
+            values[k] = new_value
+
+        # split
+        names = [name for _, name, _, _ in arrays]
+        x = values[names.index("particle_x")]
+        F = values[names.index("particle_F_trial")].reshape(-1, 3, 3)
+        vol = values[names.index("particle_vol")].reshape(-1)
+        mass = values[names.index("particle_mass")].reshape(-1)
+        active = (values[names.index("particle_selection")].reshape(-1) == 0) & (
+            values[names.index("particle_rigid_id")].reshape(-1) < 0
+        )
+        # the Frobenius norm bounds sigma_max, only candidates need an svd
+        size = torch.pow(vol, 1.0 / 3.0)
+        candidates = torch.nonzero(
+            active & (size * torch.linalg.norm(F, dim=(1, 2)) > split_extent)
+        ).reshape(-1)
+        U, sig, _ = torch.linalg.svd(F[candidates])
+        extent = size[candidates] * sig[:, 0]
+        split = extent > split_extent
+        split_ids = candidates[split]
+        # halves sit at +-1/4 of the extent along the largest stretch
+        offset = 0.25 * extent[split].unsqueeze(-1) * U[split][:, :, 0]
+
+        src = torch.cat([torch.arange(n_group, device=x.device), split_ids])
+        n_new = src.shape[0]
+        new_ids = torch.arange(n_group, n_new, device=x.device)
+        for k in range(len(values)):
+            values[k] = values[k][src]
+        x = values[names.index("particle_x")]
+        x[split_ids] -= offset
+        x[new_ids] += offset
+        for name in ["particle_vol", "particle_mass"]:
+            values[names.index(name)][split_ids] *= 0.5
+            values[names.index(name)][new_ids] *= 0.5
+        # density of a merged particle
+        values[names.index("particle_density")] = (
+            values[names.index("particle_mass")] / values[names.index("particle_vol")]
+        )
+
+        for k, (owner, name, to_warp, _) in enumerate(arrays):
+            value = values[k]
+            if to_warp is torch2warp_vec3 or to_warp is torch2warp_quat:
+                value = value.contiguous()
+            elif to_warp is torch2warp_mat33:
+                value = value.reshape(-1, 3, 3).contiguous()
+            else:
+                value = value.reshape(-1).contiguous()
+            setattr(owner, name, to_warp(value, dvc=device))
+        self.n_particles = n_new
+        self.update_material_groups(device=device)
+
+        # split particles keep their index, so only merging moves a Gaussian
+        if self.render_particle_ids is not None:
+            ids = group[self.render_particle_ids]
+            self.render_particle_ids = ids
+            self.render_offsets = torch.linalg.solve(
+                F[ids], (render_x - x[ids]).unsqueeze(-1)
+            ).squeeze(-1)
+
+        print(
+            "Resampled particles: {} merged into {}, {} split, total {}".format(
+                int(group_size[merged].sum()),
+                int(merged.sum()),
+                split_ids.shape[0],
+                n_new,
+            )
+        )
+
     def print_time_profile(self):
         print("MPM Time profile:")
         for key, value in self.time_profile.items():
             print(key, sum(value))
 
+    # particles inside the cuboid point±size become one rigid body: they still
+    # take part in p2g, but g2p projects them onto a single linear and angular
+    # velocity and their stress is skipped, so their stiffness does not limit dt
+    def add_rigid_body_on_cuboid(self, point, size, device="cuda:0"):
+        wp.launch(
+            kernel=set_rigid_body_on_cuboid,
+            dim=self.n_particles,
+            inputs=[
+                self.mpm_state,
+                wp.vec3(point[0], point[1], point[2]),
+                wp.vec3(size[0], size[1], size[2]),
+                self.n_rigid_bodies,
+            ],
+            device=device,
+        )
+        self.n_rigid_bodies += 1
+
+        n = self.n_rigid_bodies
+        self.rigid_bodies.mass = wp.zeros(shape=n, dtype=float, device=device)
+        self.rigid_bodies.mass_x = wp.zeros(shape=n, dtype=wp.vec3, device=device)
+        self.rigid_bodies.mass_v = wp.zeros(shape=n, dtype=wp.vec3, device=device)
+        self.rigid_bodies.mass_x_cross_v = wp.zeros(
+            shape=n, dtype=wp.vec3, device=device
+        )
+        self.rigid_bodies.mass_inertia = wp.zeros(
+            shape=n, dtype=wp.mat33, device=device
+        )
+        self.rigid_bodies.x = wp.zeros(shape=n, dtype=wp.vec3, device=device)
+        self.rigid_bodies.v = wp.zeros(shape=n, dtype=wp.vec3, device=device)
+        self.rigid_bodies.w = wp.zeros(shape=n, dtype=wp.vec3, device=device)
+
     # a surface specified by a point and the normal vector
     def add_surface_collider(
         self,
@@ -712,6 +2072,164 @@ class MPM_Simulator_WARP:
         self.grid_postprocess.append(collide)
         self.modify_bc.append(None)
 
+    # A static collider given by its signed distance sdf (negative inside) at the
+    # grid nodes, as a numpy array of shape (grid_dim_x, grid_dim_y, grid_dim_z).
+    # Nodes with sdf < thickness are projected along sdf_normal, the outward
+    # direction, computed from the gradient of sdf if not given. The cost per
+    # node is one lookup, whatever the shape of the collider. surface is
+    # "sticky", "slip" or "separate", which only removes the inward velocity
+    # and applies friction.
+    def add_sdf_collider(
+        self,
+        sdf,
+        sdf_normal=None,
+        surface="sticky",
+        friction=0.0,
+        thickness=0.0,
+        start_time=0.0,
+        end_time=999.0,
+        device="cuda:0",
+    ):
+        sdf = np.asarray(sdf, dtype=np.float32)
+        grid_size = (
+            self.mpm_model.grid_dim_x,
+            self.mpm_model.grid_dim_y,
+            self.mpm_model.grid_dim_z,
+        )
+        if sdf.shape != grid_size:
+            raise ValueError(
+                "sdf shape {} differs from grid {}".format(sdf.shape, grid_size)
+            )
+        if sdf_normal is None:
+            sdf_normal = np.stack(np.gradient(sdf, self.mpm_model.dx), axis=-1)
+            length = np.linalg.norm(sdf_normal, axis=-1, keepdims=True)
+            sdf_normal = sdf_normal / np.maximum(length, 1e-12)
+
+        collider_param = Dirichlet_collider()
+        collider_param.start_time = start_time
+        collider_param.end_time = end_time
+        collider_param.threshold = thickness
+        collider_param.friction = friction
+        collider_param.sdf = wp.array(sdf, dtype=float, device=device)
+        collider_param.sdf_normal = wp.array(
+            np.asarray(sdf_normal, dtype=np.float32), dtype=wp.vec3, device=device
+        )
+        if surface == "sticky" and friction != 0:
+            raise ValueError("friction must be 0 on sticky surfaces.")
+        if surface == "sticky":
+            collider_param.surface_type = 0
+        elif surface == "slip":
+            collider_param.surface_type = 1
+        else:
+            collider_param.surface_type = 2
+        self.collider_params.append(collider_param)
+
+        @wp.kernel
+        def collide(
+            time: float,
+            dt: float,
+            state: MPMStateStruct,
+            model: MPMModelStruct,
+            param: Dirichlet_collider,
+        ):
+            grid_x, grid_y, grid_z = wp.tid()
+            if time >= param.start_time and time < param.end_time:
+                if param.sdf[grid_x, grid_y, grid_z] < param.threshold:
+                    if param.surface_type == 0:
+                        state.grid_v_out[grid_x, grid_y, grid_z] = wp.vec3(
+                            0.0, 0.0, 0.0
+                        )
+                    else:
+                        n = param.sdf_normal[grid_x, grid_y, grid_z]
+                        v = state.grid_v_out[grid_x, grid_y, grid_z]
+                        normal_component = wp.dot(v, n)
+                        if param.surface_type == 1:
+                            v = v - normal_component * n
+                        else:
+                            v = v - wp.min(normal_component, 0.0) * n
+                        if normal_component < 0.0 and wp.length(v) > 1e-20:
+                            v = wp.max(
+                                0.0, wp.length(v) + normal_component * param.friction
+                            ) * wp.normalize(v)
+                        state.grid_v_out[grid_x, grid_y, grid_z] = v
+
+        self.grid_postprocess.append(collide)
+        self.modify_bc.append(None)
+
+    # A static collider from an OBJ or PLY triangle mesh, see add_sdf_collider.
+    # The mesh is voxelized once into a signed distance on the grid nodes.
+    # vertex_transform maps the (n, 3) vertices into simulation space. The
+    # result is cached in cache_dir (next to the mesh by default), keyed by the
+    # transformed mesh and the grid, so later runs skip the voxelization.
+    def add_mesh_collider(
+        self,
+        filename,
+        surface="sticky",
+        friction=0.0,
+        thickness=0.0,
+        start_time=0.0,
+        end_time=999.0,
+        vertex_transform=None,
+        cache_dir=None,
+        device="cuda:0",
+    ):
+        vertices, faces = load_triangle_mesh(filename)
+        if vertex_transform is not None:
+            vertices = np.asarray(vertex_transform(vertices), dtype=np.float32)
+        grid_size = (
+            self.mpm_model.grid_dim_x,
+            self.mpm_model.grid_dim_y,
+            self.mpm_model.grid_dim_z,
+        )
+
+        key = hashlib.sha1()
+        key.update(vertices.tobytes())
+        key.update(faces.tobytes())
+        key.update(str((grid_size, self.mpm_model.dx)).encode())
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.path.dirname(os.path.abspath(filename)), "sdf_cache"
+            )
+        cache_file = os.path.join(cache_dir, "sdf_" + key.hexdigest() + ".npz")
+
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            sdf, sdf_normal = cached["sdf"], cached["sdf_normal"]
+        else:
+            mesh = wp.Mesh(
+                points=wp.array(vertices, dtype=wp.vec3, device=device),
+                indices=wp.array(faces.flatten(), dtype=int, device=device),
+                support_winding_number=True,
+            )
+            sdf = wp.zeros(shape=grid_size, dtype=float, device=device)
+            sdf_normal = wp.zeros(shape=grid_size, dtype=wp.vec3, device=device)
+            wp.launch(
+                kernel=compute_mesh_sdf,
+                dim=grid_size,
+                inputs=[
+                    mesh.id,
+                    self.mpm_model,
+                    2.0 * self.mpm_model.grid_lim,
+                    sdf,
+                    sdf_normal,
+                ],
+                device=device,
+            )
+            sdf, sdf_normal = sdf.numpy(), sdf_normal.numpy()
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez_compressed(cache_file, sdf=sdf, sdf_normal=sdf_normal)
+
+        self.add_sdf_collider(
+            sdf,
+            sdf_normal,
+            surface=surface,
+            friction=friction,
+            thickness=thickness,
+            start_time=start_time,
+            end_time=end_time,
+            device=device,
+        )
+
     # a cubiod is a rectangular cube'
     # centered at `point`
     # dimension is x: point[0]±size[0]
@@ -4,13 +4,59 @@ import numpy as np
 import math
 
 
+# polar svd decomposition, R = U V^T with det(U) = det(V) = 1
+@wp.func
+def svd_rotation(F: wp.mat33):
+    U = wp.mat33(0.0)
+    V = wp.mat33(0.0)
+    sig = wp.vec3(0.0)
+    wp.svd3(F, U, sig, V)
+
+    if wp.determinant(U) < 0.0:
+        U[0, 2] = -U[0, 2]
+        U[1, 2] = -U[1, 2]
+        U[2, 2] = -U[2, 2]
+
+    if wp.determinant(V) < 0.0:
+        V[0, 2] = -V[0, 2]
+        V[1, 2] = -V[1, 2]
+        V[2, 2] = -V[2, 2]
+
+    return U * wp.transpose(V)
+
+
+# rotational part R of the polar decomposition F = RS, no svd needed
+# quaternion iteration of Mueller et al. 2016, warm-started from q (e.g. the rotation of the
+# previous substep). it stops once the correction angle drops below tol; if that does not
+# happen within max_iters updates, R is taken from svd3 instead. the residual is also
+# checked after the last update, so the returned rotation is converged to tol or exact.
+@wp.func
+def polar_rotation(F: wp.mat33, q: wp.quat, max_iters: int, tol: float):
+    residual = tol + 1.0
+    for it in range(max_iters + 1):
+        R = wp.quat_to_matrix(q)
+        omega = wp.vec3(0.0, 0.0, 0.0)
+        r_dot_f = float(0.0)
+        for c in range(3):
+            r_c = wp.vec3(R[0, c], R[1, c], R[2, c])
+            f_c = wp.vec3(F[0, c], F[1, c], F[2, c])
+            omega = omega + wp.cross(r_c, f_c)
+            r_dot_f = r_dot_f + wp.dot(r_c, f_c)
+        omega = omega * (1.0 / (wp.abs(r_dot_f) + 1.0e-9))
+        residual = wp.length(omega)
+        if residual < tol or it == max_iters:
+            break
+        q = wp.normalize(wp.mul(wp.quat_from_axis_angle(omega / residual, residual), q))
+
+    if residual >= tol:
+        q = wp.quat_from_matrix(svd_rotation(F))
+    return q
+
+
 # compute stress from F
 @wp.func
-def kirchoff_stress_FCR(
-    F: wp.mat33, U: wp.mat33, V: wp.mat33, J: float, mu: float, lam: float
-):
+def kirchoff_stress_FCR(F: wp.mat33, R: wp.mat33, J: float, mu: float, lam: float):
     # compute kirchoff stress for FCR model (remember tau = P F^T)
-    R = U * wp.transpose(V)
     id = wp.mat33(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
     return 2.0 * mu * (F - R) * wp.transpose(F) + id * lam * J * (J - 1.0)
 
@@ -74,6 +120,32 @@ def kirchoff_stress_drucker_prager(
     return U * center * wp.transpose(V) * wp.transpose(F)
 
 
+# material constants of particle p: the model scalars when every particle shares
+# them (model.uniform_params == 1), saving the per-particle loads in the stress pass
+@wp.func
+def get_mu(model: MPMModelStruct, p: int):
+    mu = model.uniform_mu
+    if model.uniform_params == 0:
+        mu = model.mu[p]
+    return mu
+
+
+@wp.func
+def get_lam(model: MPMModelStruct, p: int):
+    lam = model.uniform_lam
+    if model.uniform_params == 0:
+        lam = model.lam[p]
+    return lam
+
+
+@wp.func
+def get_yield_stress(model: MPMModelStruct, p: int):
+    yield_stress = model.uniform_yield_stress
+    if model.uniform_params == 0:
+        yield_stress = model.yield_stress[p]
+    return yield_stress
+
+
 @wp.func
 def von_mises_return_mapping(F_trial: wp.mat33, model: MPMModelStruct, p: int):
     U = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
@@ -87,17 +159,20 @@ def von_mises_return_mapping(F_trial: wp.mat33, model: MPMModelStruct, p: int):
     epsilon = wp.vec3(wp.log(sig[0]), wp.log(sig[1]), wp.log(sig[2]))
     temp = (epsilon[0] + epsilon[1] + epsilon[2]) / 3.0
 
-    tau = 2.0 * model.mu[p] * epsilon + model.lam[p] * (
+    mu = get_mu(model, p)
+    yield_stress = get_yield_stress(model, p)
+    tau = 2.0 * mu * epsilon + get_lam(model, p) * (
         epsilon[0] + epsilon[1] + epsilon[2]
     ) * wp.vec3(1.0, 1.0, 1.0)
     sum_tau = tau[0] + tau[1] + tau[2]
     cond = wp.vec3(
         tau[0] - sum_tau / 3.0, tau[1] - sum_tau / 3.0, tau[2] - sum_tau / 3.0
     )
-    if wp.length(cond) > model.yield_stress[p]:
+    F_elastic = F_trial
+    if wp.length(cond) > yield_stress:
         epsilon_hat = epsilon - wp.vec3(temp, temp, temp)
         epsilon_hat_norm = wp.length(epsilon_hat) + 1e-6
-        delta_gamma = epsilon_hat_norm - model.yield_stress[p] / (2.0 * model.mu[p])
+        delta_gamma = epsilon_hat_norm - yield_stress / (2.0 * mu)
         epsilon = epsilon - (delta_gamma / epsilon_hat_norm) * epsilon_hat
         sig_elastic = wp.mat33(
             wp.exp(epsilon[0]),
@@ -111,13 +186,10 @@ def von_mises_return_mapping(F_trial: wp.mat33, model: MPMModelStruct, p: int):
             wp.exp(epsilon[2]),
         )
         F_elastic = U * sig_elastic * wp.transpose(V)
+        # hardening keeps per-particle yield stresses, never uniform_params
         if model.hardening == 1:
-            model.yield_stress[p] = (
-                model.yield_stress[p] + 2.0 * model.mu[p] * model.xi * delta_gamma
-            )
-        return F_elastic
-    else:
-        return F_trial
+            model.yield_stress[p] = yield_stress + 2.0 * mu * model.xi * delta_gamma
+    return F_elastic
 
 
 @wp.func
@@ -142,9 +214,9 @@ def von_mises_return_mapping_with_damage(
     cond = wp.vec3(
         tau[0] - sum_tau / 3.0, tau[1] - sum_tau / 3.0, tau[2] - sum_tau / 3.0
     )
-    if wp.length(cond) > model.yield_stress[p]:
-        if model.yield_stress[p] <= 0:
-            return F_trial
+    # softening changes the constants per particle, never uniform_params
+    F_elastic = F_trial
+    if wp.length(cond) > model.yield_stress[p] and model.yield_stress[p] > 0:
         epsilon_hat = epsilon - wp.vec3(temp, temp, temp)
         epsilon_hat_norm = wp.length(epsilon_hat) + 1e-6
         delta_gamma = epsilon_hat_norm - model.yield_stress[p] / (2.0 * model.mu[p])
@@ -171,9 +243,7 @@ def von_mises_return_mapping_with_damage(
             model.yield_stress[p] = (
                 model.yield_stress[p] + 2.0 * model.mu[p] * model.xi * delta_gamma
             )
-        return F_elastic
-    else:
-        return F_trial
+    return F_elastic
 
 
 # for toothpaste
@@ -195,16 +265,18 @@ def viscoplasticity_return_mapping_with_StVK(
     epsilon_hat = epsilon - wp.vec3(
         trace_epsilon / 3.0, trace_epsilon / 3.0, trace_epsilon / 3.0
     )
-    s_trial = 2.0 * model.mu[p] * epsilon_hat
+    mu = get_mu(model, p)
+    s_trial = 2.0 * mu * epsilon_hat
     s_trial_norm = wp.length(s_trial)
-    y = s_trial_norm - wp.sqrt(2.0 / 3.0) * model.yield_stress[p]
+    y = s_trial_norm - wp.sqrt(2.0 / 3.0) * get_yield_stress(model, p)
+    F_elastic = F_trial
     if y > 0:
-        mu_hat = model.mu[p] * (b_trial[0] + b_trial[1] + b_trial[2]) / 3.0
+        mu_hat = mu * (b_trial[0] + b_trial[1] + b_trial[2]) / 3.0
         s_new_norm = s_trial_norm - y / (
             1.0 + model.plastic_viscosity / (2.0 * mu_hat * dt)
         )
         s_new = (s_new_norm / s_trial_norm) * s_trial
-        epsilon_new = 1.0 / (2.0 * model.mu[p]) * s_new + wp.vec3(
+        epsilon_new = 1.0 / (2.0 * mu) * s_new + wp.vec3(
             trace_epsilon / 3.0, trace_epsilon / 3.0, trace_epsilon / 3.0
         )
         sig_elastic = wp.mat33(
@@ -219,9 +291,7 @@ def viscoplasticity_return_mapping_with_StVK(
             wp.exp(epsilon_new[2]),
         )
         F_elastic = U * sig_elastic * wp.transpose(V)
-        return F_elastic
-    else:
-        return F_trial
+    return F_elastic
 
 
 @wp.func
@@ -242,12 +312,10 @@ def sand_return_mapping(
     tr = epsilon[0] + epsilon[1] + epsilon[2]  # + state.particle_Jp[p]
     epsilon_hat = epsilon - wp.vec3(tr / 3.0, tr / 3.0, tr / 3.0)
     epsilon_hat_norm = wp.length(epsilon_hat)
+    mu = get_mu(model, p)
     delta_gamma = (
         epsilon_hat_norm
-        + (3.0 * model.lam[p] + 2.0 * model.mu[p])
-        / (2.0 * model.mu[p])
-        * tr
-        * model.alpha
+        + (3.0 * get_lam(model, p) + 2.0 * mu) / (2.0 * mu) * tr * model.alpha
     )
 
     if delta_gamma <= 0:
@@ -316,65 +384,205 @@ def update_cov(state: MPMStateStruct, p: int, grad_v: wp.mat33, dt: float):
     state.particle_cov[p * 6 + 5] = cov_np1[2, 2]
 
 
-@wp.kernel
-def p2g_apic_with_stress(state: MPMStateStruct, model: MPMModelStruct, dt: float):
+# base node of the quadratic B-spline stencil of a particle at x, and the
+# offset of x from it in cells
+@wp.func
+def get_stencil_base(model: MPMModelStruct, x: wp.vec3):
+    grid_pos = x * model.inv_dx
+    base_pos_x = wp.int(grid_pos[0] - 0.5)
+    base_pos_y = wp.int(grid_pos[1] - 0.5)
+    base_pos_z = wp.int(grid_pos[2] - 0.5)
+    fx = grid_pos - wp.vec3(
+        wp.float(base_pos_x), wp.float(base_pos_y), wp.float(base_pos_z)
+    )
+    return base_pos_x, base_pos_y, base_pos_z, fx
+
+
+# per-axis weights w and weight derivatives dw of the stencil nodes
+@wp.func
+def get_stencil_weights(fx: wp.vec3):
+    wa = wp.vec3(1.5) - fx
+    wb = fx - wp.vec3(1.0)
+    wc = fx - wp.vec3(0.5)
+    w = wp.mat33(
+        wp.cw_mul(wa, wa) * 0.5,
+        wp.vec3(0.0, 0.0, 0.0) - wp.cw_mul(wb, wb) + wp.vec3(0.75),
+        wp.cw_mul(wc, wc) * 0.5,
+    )
+    dw = wp.mat33(fx - wp.vec3(1.5), -2.0 * (fx - wp.vec3(1.0)), fx - wp.vec3(0.5))
+    return w, dw
+
+
+@wp.func
+def get_apic_C(state: MPMStateStruct, model: MPMModelStruct, p: int):
+    C = state.particle_C[p]
+    # if model.rpic = 0, standard apic
+    C = (1.0 - model.rpic_damping) * C + model.rpic_damping / 2.0 * (
+        C - wp.transpose(C)
+    )
+    if model.rpic_damping < -0.001:
+        # standard pic
+        C = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    return C
+
+
+# scatter mass, momentum and stress of particle p to the stencil node (i, j, k)
+# with the given weight and weight gradient, the stress enters scaled by dt
+@wp.func
+def p2g_at_node(
+    state: MPMStateStruct,
+    model: MPMModelStruct,
+    p: int,
+    base_pos_x: int,
+    base_pos_y: int,
+    base_pos_z: int,
+    fx: wp.vec3,
+    i: int,
+    j: int,
+    k: int,
+    weight: float,
+    dweight: wp.vec3,
+    C: wp.mat33,
+    stress: wp.mat33,
+    dt: float,
+):
+    dpos = (wp.vec3(wp.float(i), wp.float(j), wp.float(k)) - fx) * model.dx
+    ix = base_pos_x + i
+    iy = base_pos_y + j
+    iz = base_pos_z + k
+    elastic_force = -state.particle_vol[p] * stress * dweight
+    v_in_add = (
+        weight * state.particle_mass[p] * (state.particle_v[p] + C * dpos)
+        + dt * elastic_force
+    )
+    wp.atomic_add(state.grid_v_in, ix, iy, iz, v_in_add)
+    wp.atomic_add(state.grid_m, ix, iy, iz, weight * state.particle_mass[p])
+
+
+# p2g of particle p placed at x, the stress enters scaled by dt
+@wp.func
+def p2g_at_particle(
+    state: MPMStateStruct, model: MPMModelStruct, p: int, x: wp.vec3, dt: float
+):
     # input given to p2g:   particle_stress
     #                       particle_x
     #                       particle_v
     #                       particle_C
+    stress = state.particle_stress[p]
+    base_pos_x, base_pos_y, base_pos_z, fx = get_stencil_base(model, x)
+    w, dw = get_stencil_weights(fx)
+    C = get_apic_C(state, model, p)
+
+    for i in range(0, 3):
+        for j in range(0, 3):
+            for k in range(0, 3):
+                weight = w[0, i] * w[1, j] * w[2, k]  # tricubic interpolation
+                dweight = compute_dweight(model, w, dw, i, j, k)
+                p2g_at_node(
+                    state,
+                    model,
+                    p,
+                    base_pos_x,
+                    base_pos_y,
+                    base_pos_z,
+                    fx,
+                    i,
+                    j,
+                    k,
+                    weight,
+                    dweight,
+                    C,
+                    stress,
+                    dt,
+                )
+
+
+@wp.kernel
+def p2g_apic_with_stress(state: MPMStateStruct, model: MPMModelStruct, dt: float):
+    p = wp.tid()
+    if state.particle_selection[p] == 0:
+        p2g_at_particle(state, model, p, state.particle_x[p], dt)
+
+
+# p2g that also stores the 27 weights and weight gradients for g2p_cached
+@wp.kernel
+def p2g_apic_with_stress_cached(
+    state: MPMStateStruct, model: MPMModelStruct, cache: WeightCacheStruct, dt: float
+):
     p = wp.tid()
     if state.particle_selection[p] == 0:
         stress = state.particle_stress[p]
-        grid_pos = state.particle_x[p] * model.inv_dx
-        base_pos_x = wp.int(grid_pos[0] - 0.5)
-        base_pos_y = wp.int(grid_pos[1] - 0.5)
-        base_pos_z = wp.int(grid_pos[2] - 0.5)
-        fx = grid_pos - wp.vec3(
-            wp.float(base_pos_x), wp.float(base_pos_y), wp.float(base_pos_z)
+        base_pos_x, base_pos_y, base_pos_z, fx = get_stencil_base(
+            model, state.particle_x[p]
         )
-        wa = wp.vec3(1.5) - fx
-        wb = fx - wp.vec3(1.0)
-        wc = fx - wp.vec3(0.5)
-        w = wp.mat33(
-            wp.cw_mul(wa, wa) * 0.5,
-            wp.vec3(0.0, 0.0, 0.0) - wp.cw_mul(wb, wb) + wp.vec3(0.75),
-            wp.cw_mul(wc, wc) * 0.5,
-        )
-        dw = wp.mat33(fx - wp.vec3(1.5), -2.0 * (fx - wp.vec3(1.0)), fx - wp.vec3(0.5))
+        w, dw = get_stencil_weights(fx)
+        C = get_apic_C(state, model, p)
 
         for i in range(0, 3):
             for j in range(0, 3):
                 for k in range(0, 3):
-                    dpos = (
-                        wp.vec3(wp.float(i), wp.float(j), wp.float(k)) - fx
-                    ) * model.dx
-                    ix = base_pos_x + i
-                    iy = base_pos_y + j
-                    iz = base_pos_z + k
                     weight = w[0, i] * w[1, j] * w[2, k]  # tricubic interpolation
                     dweight = compute_dweight(model, w, dw, i, j, k)
-                    C = state.particle_C[p]
-                    # if model.rpic = 0, standard apic
-                    C = (1.0 - model.rpic_damping) * C + model.rpic_damping / 2.0 * (
-                        C - wp.transpose(C)
-                    )
-                    if model.rpic_damping < -0.001:
-                        # standard pic
-                        C = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
-
-                    elastic_force = -state.particle_vol[p] * stress * dweight
-                    v_in_add = (
-                        weight
-                        * state.particle_mass[p]
-                        * (state.particle_v[p] + C * dpos)
-                        + dt * elastic_force
-                    )
-                    wp.atomic_add(state.grid_v_in, ix, iy, iz, v_in_add)
-                    wp.atomic_add(
-                        state.grid_m, ix, iy, iz, weight * state.particle_mass[p]
+                    node = (i * 3 + j) * 3 + k
+                    cache.weight[p, node] = weight
+                    cache.dweight[p, node] = dweight
+                    p2g_at_node(
+                        state,
+                        model,
+                        p,
+                        base_pos_x,
+                        base_pos_y,
+                        base_pos_z,
+                        fx,
+                        i,
+                        j,
+                        k,
+                        weight,
+                        dweight,
+                        C,
+                        stress,
+                        dt,
                     )
 
 
+# position at time t of a particle of another rate class, whose x and v belong
+# to particle_time[p]
+@wp.func
+def get_multirate_halo_x(
+    state: MPMStateStruct, particle_time: wp.array(dtype=float), p: int, t: float
+):
+    return state.particle_x[p] + (t - particle_time[p]) * state.particle_v[p]
+
+
+# multi-rate p2g: the first n_active ids belong to the rate class being stepped
+# and scatter mass, momentum and stress, after taking the velocity change
+# particle_dv they received as halo of other classes. the others are nearby
+# particles of other classes, they only scatter mass and momentum at their
+# position interpolated to time t, which gives the class moving boundary data at
+# its interfaces
+@wp.kernel
+def p2g_apic_multirate(
+    state: MPMStateStruct,
+    model: MPMModelStruct,
+    particle_ids: wp.array(dtype=int),
+    particle_time: wp.array(dtype=float),
+    particle_dv: wp.array(dtype=wp.vec3),
+    n_active: int,
+    t: float,
+    dt: float,
+):
+    i = wp.tid()
+    p = particle_ids[i]
+    if state.particle_selection[p] == 0:
+        if i < n_active:
+            state.particle_v[p] = state.particle_v[p] + particle_dv[p]
+            particle_dv[p] = wp.vec3(0.0, 0.0, 0.0)
+            p2g_at_particle(state, model, p, state.particle_x[p], dt)
+        else:
+            x = get_multirate_halo_x(state, particle_time, p, t)
+            p2g_at_particle(state, model, p, x, 0.0)
+
+
 # add gravity
 @wp.kernel
 def grid_normalization_and_gravity(
@@ -390,118 +598,315 @@ def grid_normalization_and_gravity(
         state.grid_v_out[grid_x, grid_y, grid_z] = v_out
 
 
+# contribution of the stencil node (i, j, k) with the given weight and weight
+# gradient to the new v, C and velocity gradient of a particle
+@wp.func
+def g2p_at_node(
+    state: MPMStateStruct,
+    model: MPMModelStruct,
+    base_pos_x: int,
+    base_pos_y: int,
+    base_pos_z: int,
+    fx: wp.vec3,
+    i: int,
+    j: int,
+    k: int,
+    weight: float,
+    dweight: wp.vec3,
+):
+    dpos = wp.vec3(wp.float(i), wp.float(j), wp.float(k)) - fx
+    grid_v = state.grid_v_out[base_pos_x + i, base_pos_y + j, base_pos_z + k]
+    return (
+        grid_v * weight,
+        wp.outer(grid_v, dpos) * (weight * model.inv_dx * 4.0),
+        wp.outer(grid_v, dweight),
+    )
+
+
+# writes the gathered v, C and velocity gradient new_F of particle p into
+# next_state: v, x, C and F_trial, and the covariance if it follows F
+@wp.func
+def g2p_update_particle(
+    state: MPMStateStruct,
+    next_state: MPMStateStruct,
+    model: MPMModelStruct,
+    p: int,
+    new_v: wp.vec3,
+    new_C: wp.mat33,
+    new_F: wp.mat33,
+    dt: float,
+):
+    next_state.particle_v[p] = new_v
+    next_state.particle_x[p] = state.particle_x[p] + dt * new_v
+    next_state.particle_C[p] = new_C
+    I33 = wp.mat33(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+    F_tmp = (I33 + new_F * dt) * state.particle_F[p]
+    next_state.particle_F_trial[p] = F_tmp
+
+    if model.update_cov_with_F:
+        update_cov(state, p, new_F, dt)
+
+
+# g2p of particle p, reads state and writes v, x, C and F_trial into next_state.
+# next_state is state itself except in the differentiable step, where every
+# substep needs its own copy of these arrays for the adjoint
+@wp.func
+def g2p_at_particle(
+    state: MPMStateStruct,
+    next_state: MPMStateStruct,
+    model: MPMModelStruct,
+    p: int,
+    dt: float,
+):
+    base_pos_x, base_pos_y, base_pos_z, fx = get_stencil_base(
+        model, state.particle_x[p]
+    )
+    w, dw = get_stencil_weights(fx)
+    new_v = wp.vec3(0.0, 0.0, 0.0)
+    new_C = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    new_F = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    for i in range(0, 3):
+        for j in range(0, 3):
+            for k in range(0, 3):
+                weight = w[0, i] * w[1, j] * w[2, k]  # tricubic interpolation
+                dweight = compute_dweight(model, w, dw, i, j, k)
+                dv, dC, dF = g2p_at_node(
+                    state,
+                    model,
+                    base_pos_x,
+                    base_pos_y,
+                    base_pos_z,
+                    fx,
+                    i,
+                    j,
+                    k,
+                    weight,
+                    dweight,
+                )
+                new_v = new_v + dv
+                new_C = new_C + dC
+                new_F = new_F + dF
+
+    g2p_update_particle(state, next_state, model, p, new_v, new_C, new_F, dt)
+
+
 @wp.kernel
 def g2p(state: MPMStateStruct, model: MPMModelStruct, dt: float):
     p = wp.tid()
     if state.particle_selection[p] == 0:
-        grid_pos = state.particle_x[p] * model.inv_dx
-        base_pos_x = wp.int(grid_pos[0] - 0.5)
-        base_pos_y = wp.int(grid_pos[1] - 0.5)
-        base_pos_z = wp.int(grid_pos[2] - 0.5)
-        fx = grid_pos - wp.vec3(
-            wp.float(base_pos_x), wp.float(base_pos_y), wp.float(base_pos_z)
-        )
-        wa = wp.vec3(1.5) - fx
-        wb = fx - wp.vec3(1.0)
-        wc = fx - wp.vec3(0.5)
-        w = wp.mat33(
-            wp.cw_mul(wa, wa) * 0.5,
-            wp.vec3(0.0, 0.0, 0.0) - wp.cw_mul(wb, wb) + wp.vec3(0.75),
-            wp.cw_mul(wc, wc) * 0.5,
+        g2p_at_particle(state, state, model, p, dt)
+
+
+# g2p of one rate class, particle_time is the time its x and v belong to. the
+# halo particles (ids from n_active on) are not moved, they add the velocity
+# change the grid gave them, less gravity which they get in their own step, to
+# particle_dv. so the momentum they exchanged with the class is not lost and
+# total momentum is conserved across the interface
+@wp.kernel
+def g2p_multirate(
+    state: MPMStateStruct,
+    model: MPMModelStruct,
+    particle_ids: wp.array(dtype=int),
+    particle_time: wp.array(dtype=float),
+    particle_dv: wp.array(dtype=wp.vec3),
+    n_active: int,
+    t: float,
+    dt: float,
+):
+    index = wp.tid()
+    p = particle_ids[index]
+    if state.particle_selection[p] == 0:
+        if index < n_active:
+            g2p_at_particle(state, state, model, p, dt)
+            particle_time[p] = particle_time[p] + dt
+        else:
+            x = get_multirate_halo_x(state, particle_time, p, t)
+            base_pos_x, base_pos_y, base_pos_z, fx = get_stencil_base(model, x)
+            w, dw = get_stencil_weights(fx)
+            new_v = wp.vec3(0.0, 0.0, 0.0)
+            for i in range(0, 3):
+                for j in range(0, 3):
+                    for k in range(0, 3):
+                        weight = w[0, i] * w[1, j] * w[2, k]
+                        grid_v = state.grid_v_out[
+                            base_pos_x + i, base_pos_y + j, base_pos_z + k
+                        ]
+                        new_v = new_v + grid_v * weight
+            particle_dv[p] = (
+                particle_dv[p]
+                + new_v
+                - state.particle_v[p]
+                - dt * model.gravitational_accelaration
+            )
+
+
+# hands the velocity changes still pending from p2g2p_multirate to the particles
+@wp.kernel
+def apply_particle_dv(state: MPMStateStruct, particle_dv: wp.array(dtype=wp.vec3)):
+    p = wp.tid()
+    state.particle_v[p] = state.particle_v[p] + particle_dv[p]
+    particle_dv[p] = wp.vec3(0.0, 0.0, 0.0)
+
+
+# g2p with the weights stored by p2g_apic_with_stress_cached
+@wp.kernel
+def g2p_cached(
+    state: MPMStateStruct, model: MPMModelStruct, cache: WeightCacheStruct, dt: float
+):
+    p = wp.tid()
+    if state.particle_selection[p] == 0:
+        base_pos_x, base_pos_y, base_pos_z, fx = get_stencil_base(
+            model, state.particle_x[p]
         )
-        dw = wp.mat33(fx - wp.vec3(1.5), -2.0 * (fx - wp.vec3(1.0)), fx - wp.vec3(0.5))
         new_v = wp.vec3(0.0, 0.0, 0.0)
         new_C = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
         new_F = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
         for i in range(0, 3):
             for j in range(0, 3):
                 for k in range(0, 3):
-                    ix = base_pos_x + i
-                    iy = base_pos_y + j
-                    iz = base_pos_z + k
-                    dpos = wp.vec3(wp.float(i), wp.float(j), wp.float(k)) - fx
-                    weight = w[0, i] * w[1, j] * w[2, k]  # tricubic interpolation
-                    grid_v = state.grid_v_out[ix, iy, iz]
-                    new_v = new_v + grid_v * weight
-                    new_C = new_C + wp.outer(grid_v, dpos) * (
-                        weight * model.inv_dx * 4.0
+                    node = (i * 3 + j) * 3 + k
+                    dv, dC, dF = g2p_at_node(
+                        state,
+                        model,
+                        base_pos_x,
+                        base_pos_y,
+                        base_pos_z,
+                        fx,
+                        i,
+                        j,
+                        k,
+                        cache.weight[p, node],
+                        cache.dweight[p, node],
                     )
-                    dweight = compute_dweight(model, w, dw, i, j, k)
-                    new_F = new_F + wp.outer(grid_v, dweight)
+                    new_v = new_v + dv
+                    new_C = new_C + dC
+                    new_F = new_F + dF
 
-        state.particle_v[p] = new_v
-        state.particle_x[p] = state.particle_x[p] + dt * new_v
-        state.particle_C[p] = new_C
-        I33 = wp.mat33(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
-        F_tmp = (I33 + new_F * dt) * state.particle_F[p]
-        state.particle_F_trial[p] = F_tmp
+        g2p_update_particle(state, state, model, p, new_v, new_C, new_F, dt)
 
-        if model.update_cov_with_F:
-            update_cov(state, p, new_F, dt)
 
+@wp.kernel
+def g2p_to_next_state(
+    state: MPMStateStruct,
+    next_state: MPMStateStruct,
+    model: MPMModelStruct,
+    dt: float,
+):
+    p = wp.tid()
+    if state.particle_selection[p] == 0:
+        g2p_at_particle(state, next_state, model, p, dt)
 
-# compute (Kirchhoff) stress = stress(returnMap(F_trial))
+
+# loss += scale * |x_p - target_p|^2
 @wp.kernel
-def compute_stress_from_F_trial(
-    state: MPMStateStruct, model: MPMModelStruct, dt: float
+def add_position_loss(
+    state: MPMStateStruct,
+    target_x: wp.array(dtype=wp.vec3),
+    scale: float,
+    loss: wp.array(dtype=float),
 ):
     p = wp.tid()
     if state.particle_selection[p] == 0:
-        # apply return mapping
-        if model.material == 1:  # metal
-            state.particle_F[p] = von_mises_return_mapping(
-                state.particle_F_trial[p], model, p
-            )
-        elif model.material == 2:  # sand
-            state.particle_F[p] = sand_return_mapping(
-                state.particle_F_trial[p], state, model, p
-            )
-        elif model.material == 3:  # visplas, with StVk+VM, no thickening
-            state.particle_F[p] = viscoplasticity_return_mapping_with_StVK(
-                state.particle_F_trial[p], model, p, dt
-            )
-        elif model.material == 5:
-            state.particle_F[p] = von_mises_return_mapping_with_damage(
-                state.particle_F_trial[p], model, p
+        diff = state.particle_x[p] - target_x[p]
+        wp.atomic_add(loss, 0, scale * wp.dot(diff, diff))
+
+
+# compute (Kirchhoff) stress = stress(returnMap(F_trial)) of particle p
+@wp.func
+def compute_stress_at_particle(
+    state: MPMStateStruct, model: MPMModelStruct, p: int, material: int, dt: float
+):
+    # apply return mapping
+    if material == 1:  # metal
+        state.particle_F[p] = von_mises_return_mapping(
+            state.particle_F_trial[p], model, p
+        )
+    elif material == 2:  # sand
+        state.particle_F[p] = sand_return_mapping(
+            state.particle_F_trial[p], state, model, p
+        )
+    elif material == 3:  # visplas, with StVk+VM, no thickening
+        state.particle_F[p] = viscoplasticity_return_mapping_with_StVK(
+            state.particle_F_trial[p], model, p, dt
+        )
+    elif material == 5:
+        state.particle_F[p] = von_mises_return_mapping_with_damage(
+            state.particle_F_trial[p], model, p
+        )
+    else:  # elastic
+        state.particle_F[p] = state.particle_F_trial[p]
+
+    # also compute stress here
+    J = wp.determinant(state.particle_F[p])
+    mu = get_mu(model, p)
+    lam = get_lam(model, p)
+    U = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    V = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    sig = wp.vec3(0.0)
+    stress = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    if material == 0 or material == 5:
+        # FCR only needs the rotation
+        R = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        if model.polar_rotation == 1:
+            q = polar_rotation(
+                state.particle_F[p],
+                state.particle_polar_q[p],
+                model.polar_max_iters,
+                model.polar_tol,
             )
-        else:  # elastic
-            state.particle_F[p] = state.particle_F_trial[p]
-
-        # also compute stress here
-        J = wp.determinant(state.particle_F[p])
-        U = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
-        V = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
-        sig = wp.vec3(0.0)
-        stress = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+            state.particle_polar_q[p] = q
+            R = wp.quat_to_matrix(q)
+        else:
+            wp.svd3(state.particle_F[p], U, sig, V)
+            R = U * wp.transpose(V)
+        stress = kirchoff_stress_FCR(state.particle_F[p], R, J, mu, lam)
+    else:
         wp.svd3(state.particle_F[p], U, sig, V)
-        if model.material == 0 or model.material == 5:
-            stress = kirchoff_stress_FCR(
-                state.particle_F[p], U, V, J, model.mu[p], model.lam[p]
-            )
-        if model.material == 1:
-            stress = kirchoff_stress_StVK(
-                state.particle_F[p], U, V, sig, model.mu[p], model.lam[p]
-            )
-        if model.material == 2:
-            stress = kirchoff_stress_drucker_prager(
-                state.particle_F[p], U, V, sig, model.mu[p], model.lam[p]
-            )
-        if model.material == 3:
-            # temporarily use stvk, subject to change
-            stress = kirchoff_stress_StVK(
-                state.particle_F[p], U, V, sig, model.mu[p], model.lam[p]
-            )
+    if material == 1:
+        stress = kirchoff_stress_StVK(
+            state.particle_F[p], U, V, sig, mu, lam
+        )
+    if material == 2:
+        stress = kirchoff_stress_drucker_prager(
+            state.particle_F[p], U, V, sig, mu, lam
+        )
+    if material == 3:
+        # temporarily use stvk, subject to change
+        stress = kirchoff_stress_StVK(
+            state.particle_F[p], U, V, sig, mu, lam
+        )
 
-        stress = (stress + wp.transpose(stress)) / 2.0  # enfore symmetry
-        state.particle_stress[p] = stress
+    stress = (stress + wp.transpose(stress)) / 2.0  # enfore symmetry
+    state.particle_stress[p] = stress
 
 
 @wp.kernel
-def compute_cov_from_F(state: MPMStateStruct, model: MPMModelStruct):
+def compute_stress_from_F_trial(
+    state: MPMStateStruct, model: MPMModelStruct, dt: float
+):
     p = wp.tid()
+    if state.particle_selection[p] == 0 and state.particle_rigid_id[p] < 0:
+        compute_stress_at_particle(state, model, p, model.material, dt)
 
-    F = state.particle_F_trial[p]
 
+# same as above for the particles of one material, so a mixed scene runs one
+# launch per material instead of diverging inside a single launch
+@wp.kernel
+def compute_stress_from_F_trial_grouped(
+    state: MPMStateStruct,
+    model: MPMModelStruct,
+    particle_ids: wp.array(dtype=int),
+    material: int,
+    dt: float,
+):
+    p = particle_ids[wp.tid()]
+    if state.particle_selection[p] == 0 and state.particle_rigid_id[p] < 0:
+        compute_stress_at_particle(state, model, p, material, dt)
+
+
+# cov = F * init_cov * F^T
+@wp.func
+def set_cov_from_F(state: MPMStateStruct, p: int, F: wp.mat33):
     init_cov = wp.mat33(0.0)
     init_cov[0, 0] = state.particle_init_cov[p * 6]
     init_cov[0, 1] = state.particle_init_cov[p * 6 + 1]
@@ -523,31 +928,160 @@ def compute_cov_from_F(state: MPMStateStruct, model: MPMModelStruct):
     state.particle_cov[p * 6 + 5] = cov[2, 2]
 
 
+@wp.kernel
+def compute_cov_from_F(state: MPMStateStruct, model: MPMModelStruct):
+    p = wp.tid()
+    set_cov_from_F(state, p, state.particle_F_trial[p])
+
+
 @wp.kernel
 def compute_R_from_F(state: MPMStateStruct, model: MPMModelStruct):
     p = wp.tid()
 
     F = state.particle_F_trial[p]
 
-    # polar svd decomposition
-    U = wp.mat33(0.0)
-    V = wp.mat33(0.0)
-    sig = wp.vec3(0.0)
-    wp.svd3(F, U, sig, V)
+    if model.polar_rotation == 1:
+        q = polar_rotation(
+            F, state.particle_R_q[p], model.polar_max_iters, model.polar_tol
+        )
+        state.particle_R_q[p] = q
+        state.particle_R[p] = wp.transpose(wp.quat_to_matrix(q))
+    else:
+        state.particle_R[p] = wp.transpose(svd_rotation(F))
 
-    if wp.determinant(U) < 0.0:
-        U[0, 2] = -U[0, 2]
-        U[1, 2] = -U[1, 2]
-        U[2, 2] = -U[2, 2]
 
-    if wp.determinant(V) < 0.0:
-        V[0, 2] = -V[0, 2]
-        V[1, 2] = -V[1, 2]
-        V[2, 2] = -V[2, 2]
+# per-frame health reductions, slots as in MPM_Simulator_WARP.diagnostics_names
+@wp.kernel
+def reset_diagnostics(diagnostics: wp.array(dtype=float)):
+    i = wp.tid()
+    diagnostics[i] = 0.0
+    if i == 6:  # min_J
+        diagnostics[i] = 1e30
+    if i == 7:  # max_J
+        diagnostics[i] = -1e30
+
 
-    # compute rotation matrix
-    R = U * wp.transpose(V)
-    state.particle_R[p] = wp.transpose(R)
+@wp.kernel
+def compute_particle_diagnostics(
+    state: MPMStateStruct, model: MPMModelStruct, diagnostics: wp.array(dtype=float)
+):
+    p = wp.tid()
+    if state.particle_selection[p] == 0:
+        m = state.particle_mass[p]
+        v = state.particle_v[p]
+        wp.atomic_add(diagnostics, 0, 0.5 * m * wp.dot(v, v))
+        wp.atomic_add(diagnostics, 2, m * v[0])
+        wp.atomic_add(diagnostics, 3, m * v[1])
+        wp.atomic_add(diagnostics, 4, m * v[2])
+        wp.atomic_max(diagnostics, 5, wp.length(v))
+
+        F = state.particle_F_trial[p]
+        J = wp.determinant(F)
+        wp.atomic_min(diagnostics, 6, J)
+        wp.atomic_max(diagnostics, 7, J)
+        wp.atomic_add(diagnostics, 8, m)
+
+        if state.particle_rigid_id[p] < 0:
+            # fixed-corotated energy, a common yardstick for every material
+            U = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+            V = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+            sig = wp.vec3(0.0)
+            wp.svd3(F, U, sig, V)
+            stretch = sig - wp.vec3(1.0, 1.0, 1.0)
+            psi = get_mu(model, p) * wp.dot(stretch, stretch) + 0.5 * get_lam(
+                model, p
+            ) * (J - 1.0) * (J - 1.0)
+            wp.atomic_add(diagnostics, 1, state.particle_vol[p] * psi)
+
+
+@wp.kernel
+def compute_grid_diagnostics(state: MPMStateStruct, diagnostics: wp.array(dtype=float)):
+    grid_x, grid_y, grid_z = wp.tid()
+    wp.atomic_add(diagnostics, 9, state.grid_m[grid_x, grid_y, grid_z])
+
+
+# NaN/inf guard of the last substep, slots as in MPM_Simulator_WARP.guard_stages.
+# x - x is nan for nan and inf. offending particles get selection 2 so that the
+# following substeps skip them instead of scattering out of the grid
+@wp.kernel
+def check_particle_guard(
+    state: MPMStateStruct, model: MPMModelStruct, guard: wp.array(dtype=int)
+):
+    p = wp.tid()
+    if state.particle_selection[p] == 0:
+        stress = state.particle_stress[p]
+        s = wp.ddot(stress, stress)
+        healthy = int(1)
+        if s - s != 0.0:
+            wp.atomic_add(guard, 0, 1)
+            healthy = 0
+        v = state.particle_v[p]
+        C = state.particle_C[p]
+        s = wp.dot(v, v) + wp.ddot(C, C)
+        if s - s != 0.0:
+            wp.atomic_add(guard, 2, 1)
+            healthy = 0
+        F = state.particle_F_trial[p]
+        s = wp.ddot(F, F)
+        if s - s != 0.0:
+            wp.atomic_add(guard, 3, 1)
+            healthy = 0
+        # p2g touches nodes base..base+2, all of them have to be on the grid
+        # (written as a negation so that a nan position counts as outside)
+        grid_pos = state.particle_x[p] * model.inv_dx
+        inside = (
+            grid_pos[0] >= 0.5
+            and grid_pos[1] >= 0.5
+            and grid_pos[2] >= 0.5
+            and grid_pos[0] < float(model.grid_dim_x) - 1.5
+            and grid_pos[1] < float(model.grid_dim_y) - 1.5
+            and grid_pos[2] < float(model.grid_dim_z) - 1.5
+        )
+        if not inside:
+            wp.atomic_add(guard, 4, 1)
+            healthy = 0
+        if healthy == 0:
+            state.particle_selection[p] = 2
+
+
+@wp.kernel
+def check_grid_guard(state: MPMStateStruct, guard: wp.array(dtype=int)):
+    grid_x, grid_y, grid_z = wp.tid()
+    v = state.grid_v_out[grid_x, grid_y, grid_z]
+    s = wp.dot(v, v)
+    if s - s != 0.0:
+        wp.atomic_add(guard, 1, 1)
+
+
+# signed distance of every grid node to a triangle mesh, negative inside, and
+# the outward direction from the closest point on the mesh. the sign comes from
+# the winding number, which also works for scanned meshes that are not closed
+@wp.kernel
+def compute_mesh_sdf(
+    mesh: wp.uint64,
+    model: MPMModelStruct,
+    max_dist: float,
+    sdf: wp.array(dtype=float, ndim=3),
+    sdf_normal: wp.array(dtype=wp.vec3, ndim=3),
+):
+    grid_x, grid_y, grid_z = wp.tid()
+    x = wp.vec3(float(grid_x), float(grid_y), float(grid_z)) * model.dx
+    inside = float(0.0)
+    face = int(0)
+    u = float(0.0)
+    v = float(0.0)
+    d = max_dist
+    n = wp.vec3(0.0, 0.0, 0.0)
+    if wp.mesh_query_point_sign_winding_number(mesh, x, max_dist, inside, face, u, v):
+        closest = wp.mesh_eval_position(mesh, face, u, v)
+        d = wp.length(x - closest)
+        if d > 1e-8:
+            n = (x - closest) * (inside / d)
+        else:
+            n = wp.mesh_eval_face_normal(mesh, face)
+        d = inside * d
+    sdf[grid_x, grid_y, grid_z] = d
+    sdf_normal[grid_x, grid_y, grid_z] = n
 
 
 @wp.kernel
@@ -577,6 +1111,164 @@ def apply_additional_params(
         model.E[p] = params_modifier.E
         model.nu[p] = params_modifier.nu
         state.particle_density[p] = params_modifier.density
+        if params_modifier.material >= 0:
+            state.particle_material[p] = params_modifier.material
+
+
+# trilinear sample of channel c of a voxel volume, pos in voxel units
+# (voxel centers at integer positions), clamped at the border
+@wp.func
+def sample_volume(field: wp.array(dtype=float, ndim=4), c: int, pos: wp.vec3):
+    i = wp.int(wp.clamp(pos[0], 0.0, float(field.shape[1] - 1)))
+    j = wp.int(wp.clamp(pos[1], 0.0, float(field.shape[2] - 1)))
+    k = wp.int(wp.clamp(pos[2], 0.0, float(field.shape[3] - 1)))
+    i1 = wp.min(i + 1, field.shape[1] - 1)
+    j1 = wp.min(j + 1, field.shape[2] - 1)
+    k1 = wp.min(k + 1, field.shape[3] - 1)
+    tx = wp.clamp(pos[0] - float(i), 0.0, 1.0)
+    ty = wp.clamp(pos[1] - float(j), 0.0, 1.0)
+    tz = wp.clamp(pos[2] - float(k), 0.0, 1.0)
+    c00 = field[c, i, j, k] * (1.0 - tx) + field[c, i1, j, k] * tx
+    c10 = field[c, i, j1, k] * (1.0 - tx) + field[c, i1, j1, k] * tx
+    c01 = field[c, i, j, k1] * (1.0 - tx) + field[c, i1, j, k1] * tx
+    c11 = field[c, i, j1, k1] * (1.0 - tx) + field[c, i1, j1, k1] * tx
+    c0 = c00 * (1.0 - ty) + c10 * ty
+    c1 = c01 * (1.0 - ty) + c11 * ty
+    return c0 * (1.0 - tz) + c1 * tz
+
+
+# material parameters from a voxel volume with channels E, nu, density and
+# yield_stress (has_channel[c] = 0 skips one). the volume covers the box
+# origin..origin+size, particles outside keep their values
+@wp.kernel
+def apply_material_field(
+    state: MPMStateStruct,
+    model: MPMModelStruct,
+    field: wp.array(dtype=float, ndim=4),
+    has_channel: wp.array(dtype=int),
+    origin: wp.vec3,
+    inv_voxel_size: wp.vec3,
+):
+    p = wp.tid()
+    pos = wp.cw_mul(state.particle_x[p] - origin, inv_voxel_size)
+    if (
+        pos[0] >= 0.0
+        and pos[1] >= 0.0
+        and pos[2] >= 0.0
+        and pos[0] <= float(field.shape[1])
+        and pos[1] <= float(field.shape[2])
+        and pos[2] <= float(field.shape[3])
+    ):
+        pos = pos - wp.vec3(0.5)
+        if has_channel[0] == 1:
+            model.E[p] = sample_volume(field, 0, pos)
+        if has_channel[1] == 1:
+            model.nu[p] = sample_volume(field, 1, pos)
+        if has_channel[2] == 1:
+            state.particle_density[p] = sample_volume(field, 2, pos)
+        if has_channel[3] == 1:
+            model.yield_stress[p] = sample_volume(field, 3, pos)
+
+
+# rigid particles keep their current F and carry no stress
+@wp.kernel
+def set_rigid_body_on_cuboid(
+    state: MPMStateStruct, point: wp.vec3, size: wp.vec3, body: int
+):
+    p = wp.tid()
+    offset = state.particle_x[p] - point
+    if (
+        wp.abs(offset[0]) < size[0]
+        and wp.abs(offset[1]) < size[1]
+        and wp.abs(offset[2]) < size[2]
+        and state.particle_selection[p] == 0
+    ):
+        state.particle_rigid_id[p] = body
+        state.particle_F[p] = state.particle_F_trial[p]
+        state.particle_stress[p] = wp.mat33(
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
+        )
+
+
+@wp.kernel
+def zero_rigid_bodies(bodies: RigidBodyStruct):
+    b = wp.tid()
+    bodies.mass[b] = 0.0
+    bodies.mass_x[b] = wp.vec3(0.0, 0.0, 0.0)
+    bodies.mass_v[b] = wp.vec3(0.0, 0.0, 0.0)
+    bodies.mass_x_cross_v[b] = wp.vec3(0.0, 0.0, 0.0)
+    bodies.mass_inertia[b] = wp.mat33(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+# gather the velocities g2p interpolated for the rigid particles, at their
+# positions before g2p advanced them
+@wp.kernel
+def accumulate_rigid_bodies(state: MPMStateStruct, bodies: RigidBodyStruct, dt: float):
+    p = wp.tid()
+    b = state.particle_rigid_id[p]
+    if b >= 0 and state.particle_selection[p] == 0:
+        m = state.particle_mass[p]
+        v = state.particle_v[p]
+        x = state.particle_x[p] - dt * v
+        I33 = wp.mat33(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+        wp.atomic_add(bodies.mass, b, m)
+        wp.atomic_add(bodies.mass_x, b, m * x)
+        wp.atomic_add(bodies.mass_v, b, m * v)
+        wp.atomic_add(bodies.mass_x_cross_v, b, m * wp.cross(x, v))
+        wp.atomic_add(
+            bodies.mass_inertia, b, m * (wp.dot(x, x) * I33 - wp.outer(x, x))
+        )
+
+
+# linear and angular velocity that carry the gathered momentum
+@wp.kernel
+def compute_rigid_body_velocity(bodies: RigidBodyStruct):
+    b = wp.tid()
+    mass = bodies.mass[b]
+    if mass > 0.0:
+        x_c = bodies.mass_x[b] / mass
+        v_c = bodies.mass_v[b] / mass
+        I33 = wp.mat33(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+        # angular momentum and inertia about the center of mass
+        L = bodies.mass_x_cross_v[b] - mass * wp.cross(x_c, v_c)
+        inertia = bodies.mass_inertia[b] - mass * (
+            wp.dot(x_c, x_c) * I33 - wp.outer(x_c, x_c)
+        )
+        w = wp.vec3(0.0, 0.0, 0.0)
+        tr = (inertia[0, 0] + inertia[1, 1] + inertia[2, 2]) / 3.0
+        # no rotation for degenerate (single particle or collinear) bodies
+        if tr > 0.0 and wp.determinant(inertia) > 1e-6 * tr * tr * tr:
+            w = wp.inverse(inertia) * L
+        bodies.x[b] = x_c
+        bodies.v[b] = v_c
+        bodies.w[b] = w
+
+
+# replace the g2p update of rigid particles by the rigid motion of their body.
+# With update_cov_with_F, g2p has already moved cov by the non-rigid velocity
+# gradient, so cov is set from the projected F instead
+@wp.kernel
+def project_rigid_particles(
+    state: MPMStateStruct, model: MPMModelStruct, bodies: RigidBodyStruct, dt: float
+):
+    p = wp.tid()
+    b = state.particle_rigid_id[p]
+    if b >= 0 and state.particle_selection[p] == 0:
+        v_c = bodies.v[b]
+        w = bodies.w[b]
+        r = state.particle_x[p] - dt * state.particle_v[p] - bodies.x[b]
+        angle = wp.length(w) * dt
+        q = wp.quat_identity()
+        if angle > 0.0:
+            q = wp.quat_from_axis_angle(wp.normalize(w), angle)
+        state.particle_x[p] = bodies.x[b] + dt * v_c + wp.quat_rotate(q, r)
+        state.particle_v[p] = v_c + wp.cross(w, r)
+        state.particle_C[p] = wp.skew(w)
+        F = wp.quat_to_matrix(q) * state.particle_F[p]
+        state.particle_F_trial[p] = F
+        state.particle_F[p] = F
+        if model.update_cov_with_F:
+            set_cov_from_F(state, p, F)
 
 
 @wp.kernel
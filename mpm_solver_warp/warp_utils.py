@@ -37,6 +37,17 @@ class MPMModelStruct:
     ####### for PhysGaussian: covariance
     update_cov_with_F: int
 
+    ####### polar decomposition for FCR stress and rotation export
+    polar_rotation: int  # 1: warm-started iteration, 0: svd
+    polar_max_iters: int
+    polar_tol: float
+
+    ####### material constants shared by every particle, see update_uniform_params
+    uniform_params: int  # 1: stress pass reads the scalars below, 0: the arrays
+    uniform_mu: float
+    uniform_lam: float
+    uniform_yield_stress: float
+
 
 @wp.struct
 class MPMStateStruct:
@@ -51,6 +62,12 @@ class MPMStateStruct:
         dtype=wp.mat33
     )  # apply return mapping on this to obtain elastic def grad
     particle_R: wp.array(dtype=wp.mat33)  # rotation matrix
+    particle_polar_q: wp.array(
+        dtype=wp.quat
+    )  # rotation of F as quaternion, warm start for polar_rotation in the stress
+    particle_R_q: wp.array(
+        dtype=wp.quat
+    )  # rotation of F_trial as quaternion, warm start for the R export
     particle_stress: wp.array(dtype=wp.mat33)  # Kirchoff stress, elastic stress
     particle_C: wp.array(dtype=wp.mat33)
     particle_vol: wp.array(dtype=float)  # current volume
@@ -61,6 +78,8 @@ class MPMStateStruct:
     particle_selection: wp.array(
         dtype=int
     )  # only particle_selection[p] = 0 will be simulated
+    particle_material: wp.array(dtype=int)  # per-particle material id, same ids as model.material
+    particle_rigid_id: wp.array(dtype=int)  # rigid body of the particle, -1 if deformable
 
     # grid
     grid_m: wp.array(dtype=float, ndim=3)
@@ -70,6 +89,31 @@ class MPMStateStruct:
     )  # grid node momentum/velocity, after grid update
 
 
+# particle groups moving as rigid bodies, one entry per body
+@wp.struct
+class RigidBodyStruct:
+    # gathered from the g2p velocities of the body's particles
+    mass: wp.array(dtype=float)
+    mass_x: wp.array(dtype=wp.vec3)  # sum of m * x
+    mass_v: wp.array(dtype=wp.vec3)  # sum of m * v
+    mass_x_cross_v: wp.array(dtype=wp.vec3)  # sum of m * (x cross v)
+    mass_inertia: wp.array(dtype=wp.mat33)  # sum of m * (|x|^2 I - x x^T)
+
+    # rigid motion of the current substep
+    x: wp.array(dtype=wp.vec3)  # center of mass
+    v: wp.array(dtype=wp.vec3)  # linear velocity
+    w: wp.array(dtype=wp.vec3)  # angular velocity
+
+
+# B-spline weights and weight gradients of the 27 stencil nodes of every particle,
+# node (i, j, k) at (i * 3 + j) * 3 + k. p2g writes them and g2p of the same
+# substep reads them, both see the same particle_x
+@wp.struct
+class WeightCacheStruct:
+    weight: wp.array(dtype=float, ndim=2)  # (n_particles, 27)
+    dweight: wp.array(dtype=wp.vec3, ndim=2)  # (n_particles, 27)
+
+
 # for various boundary conditions
 @wp.struct
 class Dirichlet_collider:
@@ -104,6 +148,11 @@ class Dirichlet_collider:
     horizontal_axis_2: wp.vec3
     half_height_and_radius: wp.vec2
 
+    # signed distance to the collider and its outward direction at every grid
+    # node, see add_sdf_collider
+    sdf: wp.array(dtype=float, ndim=3)
+    sdf_normal: wp.array(dtype=wp.vec3, ndim=3)
+
 
 @wp.struct
 class Impulse_modifier:
@@ -154,6 +203,7 @@ class MaterialParamsModifier:
     E: float
     nu: float
     density: float
+    material: int  # -1 keeps the current material
 
 
 @wp.struct
@@ -190,6 +240,12 @@ def set_mat33_to_identity(target_array: wp.array(dtype=wp.mat33)):
     target_array[tid] = wp.mat33(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
 
 
+@wp.kernel
+def set_quat_to_identity(target_array: wp.array(dtype=wp.quat)):
+    tid = wp.tid()
+    target_array[tid] = wp.quat(0.0, 0.0, 0.0, 1.0)
+
+
 @wp.kernel
 def add_identity_to_mat33(target_array: wp.array(dtype=wp.mat33)):
     tid = wp.tid()
@@ -220,6 +276,12 @@ def set_value_to_float_array(target_array: wp.array(dtype=float), value: float):
     target_array[tid] = value
 
 
+@wp.kernel
+def set_value_to_int_array(target_array: wp.array(dtype=int), value: int):
+    tid = wp.tid()
+    target_array[tid] = value
+
+
 @wp.kernel
 def get_float_array_product(
     arrayA: wp.array(dtype=float),
@@ -311,3 +373,34 @@ def torch2warp_mat33(t, copy=False, dtype=warp.types.float32, dvc="cuda:0"):
     )
     a.tensor = t
     return a
+
+
+def torch2warp_int(t, copy=False, dtype=warp.types.int32, dvc="cuda:0"):
+    assert t.is_contiguous()
+    if t.dtype != torch.int32:
+        raise RuntimeError(
+            "Error aliasing Torch tensor to Warp array. Torch tensor must be int32 type"
+        )
+    a = warp.types.array(
+        ptr=t.data_ptr(),
+        dtype=warp.types.int32,
+        shape=t.shape[0],
+        copy=False,
+        owner=False,
+        requires_grad=t.requires_grad,
+        # device=t.device.type)
+        device=dvc,
+    )
+    a.tensor = t
+    return a
+
+
+# copy of a struct instance, its arrays are cloned unless share_arrays is set
+def clone_struct(struct, share_arrays=False):
+    copy = struct._cls()
+    for name in struct._cls.vars:
+        value = getattr(struct, name)
+        if isinstance(value, wp.array) and not share_arrays:
+            value = wp.clone(value)
+        setattr(copy, name, value)
+    return copy
@@ -3,6 +3,9 @@ import os
 import numpy as np
 import taichi as ti
 import mcubes
+from scipy import ndimage
+
+from utils.sym_eig_utils import get_inverse_cov
 
 # 1. densify grids
 # 2. identify grids whose density is larger than some threshold
@@ -27,7 +30,8 @@ def compute_density(index, pos, opacity, cov, grid_dx):
 def densify_grids(
     init_particles: ti.template(),
     opacity: ti.template(),
-    cov_upper: ti.template(),
+    cov_inv_upper: ti.template(),
+    kernel_radius: ti.template(),
     grid: ti.template(),
     grid_density: ti.template(),
     grid_dx: float,
@@ -42,31 +46,15 @@ def densify_grids(
         j = ti.floor(y / grid_dx, dtype=int)
         k = ti.floor(z / grid_dx, dtype=int)
         ti.atomic_add(grid[i, j, k], 1)
-        cov = ti.Matrix(
+        # inverse covariance and kernel radius are precomputed by get_inverse_cov
+        cov_inv = ti.Matrix(
             [
-                [cov_upper[pi][0], cov_upper[pi][1], cov_upper[pi][2]],
-                [cov_upper[pi][1], cov_upper[pi][3], cov_upper[pi][4]],
-                [cov_upper[pi][2], cov_upper[pi][4], cov_upper[pi][5]],
+                [cov_inv_upper[pi][0], cov_inv_upper[pi][1], cov_inv_upper[pi][2]],
+                [cov_inv_upper[pi][1], cov_inv_upper[pi][3], cov_inv_upper[pi][4]],
+                [cov_inv_upper[pi][2], cov_inv_upper[pi][4], cov_inv_upper[pi][5]],
             ]
         )
-        sig, Q = ti.sym_eig(cov)
-        sig[0] = ti.max(sig[0], 1e-8)
-        sig[1] = ti.max(sig[1], 1e-8)
-        sig[2] = ti.max(sig[2], 1e-8)
-        sig_mat = ti.Matrix(
-            [[1.0 / sig[0], 0, 0], [0, 1.0 / sig[1], 0], [0, 0, 1.0 / sig[2]]]
-        )
-        cov = Q @ sig_mat @ Q.transpose()
-        r = 0.0
-        for idx in ti.static(range(3)):
-            if sig[idx] < 0:
-                sig[idx] = ti.sqrt(-sig[idx])
-            else:
-                sig[idx] = ti.sqrt(sig[idx])
-
-            r = ti.max(r, sig[idx])
-
-        r = ti.ceil(r / grid_dx, dtype=int)
+        r = ti.ceil(kernel_radius[pi] / grid_dx, dtype=int)
         # r indicates the radius of each gaussian kernel
         for dx in range(-r, r + 1):
             for dy in range(-r, r + 1):
@@ -84,7 +72,7 @@ def densify_grids(
                             ti.Vector([i + dx, j + dy, k + dz]),
                             pos,
                             opacity[pi],
-                            cov,
+                            cov_inv,
                             grid_dx,
                         )
                         ti.atomic_add(grid_density[i + dx, j + dy, k + dz], density)
@@ -325,12 +313,18 @@ def fill_particles(
         new_origin = torch.tensor([boundary[0], boundary[2], boundary[4]]).cuda()
         pos = pos - new_origin
 
+    # batched eigen-decomposition for all kernels at once instead of ti.sym_eig per particle
+    cov_inv, sig = get_inverse_cov(cov.reshape(-1, 6), eps=1e-8)
+    kernel_radius = torch.sqrt(torch.max(sig, dim=-1)[0])
+
     ti_pos = ti.Vector.field(n=3, dtype=float, shape=pos.shape[0])
     ti_opacity = ti.field(dtype=float, shape=opacity.shape[0])
-    ti_cov = ti.Vector.field(n=6, dtype=float, shape=cov.shape[0])
+    ti_cov_inv = ti.Vector.field(n=6, dtype=float, shape=cov.shape[0])
+    ti_radius = ti.field(dtype=float, shape=cov.shape[0])
     ti_pos.from_torch(pos.reshape(-1, 3))
     ti_opacity.from_torch(opacity.reshape(-1))
-    ti_cov.from_torch(cov.reshape(-1, 6))
+    ti_cov_inv.from_torch(cov_inv.contiguous())
+    ti_radius.from_torch(kernel_radius.contiguous())
 
     grid = ti.field(dtype=int, shape=(grid_n, grid_n, grid_n))
     grid_density = ti.field(dtype=float, shape=(grid_n, grid_n, grid_n))
@@ -340,7 +334,9 @@ def fill_particles(
     # compute density_field
     # here we loop over all initial particles and compute `grid <ti.field, (n,n,n), int>` and `grid_density <ti.field, (n,n,n). float>`
     # specifically, we know how many particles each grid cover and the grid opacity computed from eq11   
-    densify_grids(ti_pos, ti_opacity, ti_cov, grid, grid_density, grid_dx)
+    densify_grids(
+        ti_pos, ti_opacity, ti_cov_inv, ti_radius, grid, grid_density, grid_dx
+    )
 
 
     # fill dense grids
@@ -391,6 +387,53 @@ def fill_particles(
     return particles_tensor
 
 
+# density (eq 11) of the Gaussians at the nodes i * grid_dx of a grid_n^3 grid.
+# densify_grids averages the 8 corners of a cell, shifting the positions by half
+# a cell centers cell i on node i. Gaussians outside the grid are left out
+def get_density_grid(pos, opacity, cov, grid_n: int, grid_dx: float):
+    pos = pos + 0.5 * grid_dx
+    mask = torch.logical_and(pos >= 0.0, pos < grid_n * grid_dx).all(dim=1)
+    pos = pos[mask]
+    opacity = opacity[mask]
+    cov = cov[mask]
+
+    cov_inv, sig = get_inverse_cov(cov.reshape(-1, 6), eps=1e-8)
+    kernel_radius = torch.sqrt(torch.max(sig, dim=-1)[0])
+
+    ti_pos = ti.Vector.field(n=3, dtype=float, shape=pos.shape[0])
+    ti_opacity = ti.field(dtype=float, shape=opacity.shape[0])
+    ti_cov_inv = ti.Vector.field(n=6, dtype=float, shape=cov.shape[0])
+    ti_radius = ti.field(dtype=float, shape=cov.shape[0])
+    ti_pos.from_torch(pos.reshape(-1, 3))
+    ti_opacity.from_torch(opacity.reshape(-1))
+    ti_cov_inv.from_torch(cov_inv.contiguous())
+    ti_radius.from_torch(kernel_radius.contiguous())
+
+    grid = ti.field(dtype=int, shape=(grid_n, grid_n, grid_n))
+    grid_density = ti.field(dtype=float, shape=(grid_n, grid_n, grid_n))
+    densify_grids(
+        ti_pos, ti_opacity, ti_cov_inv, ti_radius, grid, grid_density, grid_dx
+    )
+    return grid_density.to_numpy()
+
+
+# signed distance (negative inside) at the grid nodes to the region where the
+# density exceeds density_thres, with the surface halfway between nodes.
+# None if no node is dense enough
+def density_to_sdf(density, grid_dx: float, density_thres: float):
+    inside = density > density_thres
+    if not inside.any():
+        return None
+    if inside.all():
+        return np.full(density.shape, -0.5 * grid_dx, dtype=np.float32)
+    sdf = np.where(
+        inside,
+        0.5 - ndimage.distance_transform_edt(inside),
+        ndimage.distance_transform_edt(~inside) - 0.5,
+    )
+    return (sdf * grid_dx).astype(np.float32)
+
+
 @ti.kernel
 def get_attr_from_closest(
     ti_pos: ti.template(),
@@ -104,6 +104,7 @@ def get_camera_view(
     delta_a=0,
     delta_e=0,
     delta_r=0,
+    resolution_scale=1.0,
 ):
     """Load one of the default cameras for the scene."""
     cam_path = os.path.join(model_path, "cameras.json")
@@ -127,6 +128,7 @@ def get_camera_view(
 
         if default_camera_index > -1:
             raw_camera = data[default_camera_index]
+            R, T = get_world_to_camera(raw_camera["rotation"], raw_camera["position"])
 
         else:
             raw_camera = data[0]  # get data to be modified
@@ -154,37 +156,164 @@ def get_camera_view(
                     center_view_world_space,
                     observant_coordinates,
                 )
-            raw_camera["rotation"] = R.tolist()
-            raw_camera["position"] = position.tolist()
-
-        tmp = np.zeros((4, 4))
-        tmp[:3, :3] = raw_camera["rotation"]
-        tmp[:3, 3] = raw_camera["position"]
-        tmp[3, 3] = 1
-        C2W = np.linalg.inv(tmp)
-        R = C2W[:3, :3].transpose()
-        T = C2W[:3, 3]
-
-        width = raw_camera["width"]
-        height = raw_camera["height"]
-        fovx = focal2fov(raw_camera["fx"], width)
-        fovy = focal2fov(raw_camera["fy"], height)
-
-        K = np.array([
-            [raw_camera["fx"], 0, width / 2],
-            [0, raw_camera["fy"], height / 2],
-            [0, 0, 1],
-        ])
-
-        return GSCamera(
-            colmap_id=0,
-            R=R,
-            T=T,
-            FoVx=fovx,
-            FoVy=fovy,
-            image=torch.zeros((3, height, width)),  # fake
-            gt_alpha_mask=None,
-            image_name="fake",
-            uid=0,
-            K=K,
+            R, T = get_world_to_camera(R, position)
+
+        return make_camera(raw_camera, R, T, resolution_scale)
+
+
+# R, T of the GSCamera for a camera-to-world rotation and a camera position
+def get_world_to_camera(rotation, position):
+    tmp = np.zeros((4, 4))
+    tmp[:3, :3] = rotation
+    tmp[:3, 3] = position
+    tmp[3, 3] = 1
+    C2W = np.linalg.inv(tmp)
+    R = C2W[:3, :3].transpose()
+    T = C2W[:3, 3]
+    return R, T
+
+
+# GSCamera with the intrinsics of an entry of cameras.json
+def make_camera(raw_camera, R, T, resolution_scale=1.0):
+    # resolution_scale < 1 renders a smaller image with the same field of view
+    width = int(raw_camera["width"] * resolution_scale)
+    height = int(raw_camera["height"] * resolution_scale)
+    fx = raw_camera["fx"] * resolution_scale
+    fy = raw_camera["fy"] * resolution_scale
+    fovx = focal2fov(fx, width)
+    fovy = focal2fov(fy, height)
+
+    K = np.array([
+        [fx, 0, width / 2],
+        [0, fy, height / 2],
+        [0, 0, 1],
+    ])
+
+    return GSCamera(
+        colmap_id=0,
+        R=R,
+        T=T,
+        FoVx=fovx,
+        FoVy=fovy,
+        image=torch.zeros((3, height, width)),  # fake
+        gt_alpha_mask=None,
+        image_name="fake",
+        uid=0,
+        K=K,
+    )
+
+
+# azimuth, elevation and radius at a frame of a keyframed camera path: linear
+# between the keyframes {"frame", "azimuth", "elevation", "radius"} and held
+# before the first and after the last one
+def interpolate_camera_keyframes(keyframes, frame):
+    keyframes = sorted(keyframes, key=lambda keyframe: keyframe["frame"])
+    frames = [keyframe["frame"] for keyframe in keyframes]
+    return [
+        float(np.interp(frame, frames, [keyframe[name] for keyframe in keyframes]))
+        for name in ["azimuth", "elevation", "radius"]
+    ]
+
+
+# The camera of every frame, computed once: cameras.json is read a single time
+# and the view and projection matrices and camera centers of all frames are
+# stacked on the device. get_camera updates one camera in place instead of
+# building a new one (with its fake image) per frame. The path is the one of
+# get_camera_view, or piecewise linear in azimuth, elevation and radius when
+# camera_params["keyframes"] is set. frame_scale maps frames to path frames,
+# as --preview does.
+class CameraTrajectory:
+    def __init__(
+        self,
+        model_path,
+        frame_num,
+        camera_params,
+        center_view_world_space=None,
+        observant_coordinates=None,
+        frame_scale=1,
+        resolution_scale=1.0,
+    ):
+        cam_path = os.path.join(model_path, "cameras.json")
+        with open(cam_path) as f:
+            data = json.load(f)
+
+        default_camera_index = camera_params["default_camera_index"]
+        if camera_params["show_hint"]:
+            # prints the default camera and exits
+            get_camera_view(
+                model_path,
+                default_camera_index=default_camera_index,
+                center_view_world_space=center_view_world_space,
+                observant_coordinates=observant_coordinates,
+                show_hint=True,
+            )
+
+        self.R = []
+        self.T = []
+        for frame in range(frame_num):
+            current_frame = frame * frame_scale
+            if default_camera_index > -1:
+                raw_camera = data[default_camera_index]
+                R, T = get_world_to_camera(
+                    raw_camera["rotation"], raw_camera["position"]
+                )
+            else:
+                raw_camera = data[0]
+                if camera_params["keyframes"] is not None:
+                    azimuth, elevation, radius = interpolate_camera_keyframes(
+                        camera_params["keyframes"], current_frame
+                    )
+                elif camera_params["move_camera"]:
+                    azimuth = (
+                        camera_params["init_azimuthm"]
+                        + current_frame * camera_params["delta_a"]
+                    )
+                    elevation = (
+                        camera_params["init_elevation"]
+                        + current_frame * camera_params["delta_e"]
+                    )
+                    radius = (
+                        camera_params["init_radius"]
+                        + current_frame * camera_params["delta_r"]
+                    )
+                else:
+                    azimuth = camera_params["init_azimuthm"]
+                    elevation = camera_params["init_elevation"]
+                    radius = camera_params["init_radius"]
+                position, R = get_camera_position_and_rotation(
+                    azimuth,
+                    elevation,
+                    radius,
+                    center_view_world_space,
+                    observant_coordinates,
+                )
+                R, T = get_world_to_camera(R, position)
+            self.R.append(R)
+            self.T.append(T)
+
+        self.camera = make_camera(raw_camera, self.R[0], self.T[0], resolution_scale)
+        projection = self.camera.projection_matrix
+        # world to camera, transposed like GSCamera.world_view_transform
+        world_view = np.zeros((frame_num, 4, 4))
+        for frame in range(frame_num):
+            world_view[frame, :3, :3] = self.R[frame]
+            world_view[frame, 3, :3] = self.T[frame]
+            world_view[frame, 3, 3] = 1.0
+        self.world_view_transform = torch.tensor(
+            world_view, dtype=projection.dtype, device=projection.device
         )
+        self.full_proj_transform = torch.matmul(self.world_view_transform, projection)
+        self.camera_center = torch.inverse(self.world_view_transform)[:, 3, :3]
+
+    def __len__(self):
+        return len(self.R)
+
+    # the camera of a frame, valid until the next call
+    def get_camera(self, frame):
+        camera = self.camera
+        camera.R = self.R[frame]
+        camera.T = self.T[frame]
+        camera.world_view_transform = self.world_view_transform[frame]
+        camera.full_proj_transform = self.full_proj_transform[frame]
+        camera.camera_center = self.camera_center[frame]
+        return camera
@@ -76,6 +76,19 @@ def decode_param_json(json_file):
     if "grid_v_damping_scale" in sim_params.keys():
         material_params["grid_v_damping_scale"] = sim_params["grid_v_damping_scale"]
 
+    if "polar_rotation" in sim_params.keys():
+        material_params["polar_rotation"] = sim_params["polar_rotation"]
+
+    if "polar_max_iters" in sim_params.keys():
+        material_params["polar_max_iters"] = sim_params["polar_max_iters"]
+
+    if "polar_tol" in sim_params.keys():
+        material_params["polar_tol"] = sim_params["polar_tol"]
+
+    # g2p reuses the p2g B-spline weights, for compute-bound configs
+    if "weight_cache" in sim_params.keys():
+        material_params["weight_cache"] = sim_params["weight_cache"]
+
     if "additional_material_params" in sim_params.keys():
         additional_params = sim_params["additional_material_params"]
         for i in range(len(additional_params)):
@@ -94,8 +107,28 @@ def decode_param_json(json_file):
             if not "density" in additional_params[i].keys():
                 additional_params[i]["density"] = material_params["density"]
 
+            # optional "material" switches the material inside the region
+            if "material" in additional_params[i].keys() and additional_params[i][
+                "material"
+            ] not in ["jelly", "metal", "sand", "foam", "snow", "plasticine"]:
+                raise TypeError(
+                    "Undefined material type " + str(additional_params[i]["material"])
+                )
+
         material_params["additional_material_params"] = additional_params
 
+    # particle groups simulated as rigid bodies, cuboids point±size
+    if "rigid_bodies" in sim_params.keys():
+        rigid_bodies = sim_params["rigid_bodies"]
+        for i in range(len(rigid_bodies)):
+            if not "point" in rigid_bodies[i].keys():
+                raise TypeError("point is not defined")
+
+            if not "size" in rigid_bodies[i].keys():
+                raise TypeError("size is not defined")
+
+        material_params["rigid_bodies"] = rigid_bodies
+
     # boundary conditions
     bc_params = {}
     if "boundary_conditions" in sim_params.keys():
@@ -118,6 +151,29 @@ def decode_param_json(json_file):
     else:
         time_params["frame_num"] = 100
 
+    # multi-rate subcycling: substep_dt is the step of the softest particles,
+    # stiffer ones take 2^l substeps of substep_dt / 2^l (up to max_level)
+    if "multirate" in sim_params.keys():
+        time_params["multirate"] = sim_params["multirate"]
+        multirate_params = time_params["multirate"]
+        if not "cfl" in multirate_params.keys():
+            multirate_params["cfl"] = 0.5
+
+        if not "max_level" in multirate_params.keys():
+            multirate_params["max_level"] = 6
+
+        if not "halo_cells" in multirate_params.keys():
+            multirate_params["halo_cells"] = 3
+
+        if not "skin_cells" in multirate_params.keys():
+            multirate_params["skin_cells"] = 1
+
+        # rigid bodies are projected once per substep of the whole scene
+        if "rigid_bodies" in material_params.keys():
+            raise ValueError("multirate does not support rigid_bodies")
+    else:
+        time_params["multirate"] = None
+
     # preprocessing_params
     preprocessing_params = {}
     if "opacity_threshold" in sim_params.keys():
@@ -142,38 +198,117 @@ def decode_param_json(json_file):
 
     if "particle_filling" in sim_params.keys():
         preprocessing_params["particle_filling"] = sim_params["particle_filling"]
-        filling_params = preprocessing_params["particle_filling"]
-        if not "n_grid" in filling_params.keys():
-            filling_params["n_grid"] = material_params["n_grid"] * 4
+        set_filling_defaults(preprocessing_params["particle_filling"], material_params)
+    else:
+        preprocessing_params["particle_filling"] = None
 
-        if not "density_threshold" in filling_params.keys():
-            filling_params["density_threshold"] = 5.0
+    # several Gaussian models in one simulation, see decode_scene_manifest
+    if "scene_manifest" in sim_params.keys():
+        preprocessing_params["scene_objects"] = decode_scene_manifest(
+            sim_params["scene_manifest"],
+            material_params,
+            preprocessing_params["particle_filling"],
+        )
+    else:
+        preprocessing_params["scene_objects"] = None
 
-        if not "search_threshold" in filling_params.keys():
-            filling_params["search_threshold"] = 3.0
+    # the Gaussians outside sim_area as a static sdf collider, see
+    # density_to_sdf and MPM_Simulator_WARP.add_sdf_collider
+    if "static_collider" in sim_params.keys():
+        preprocessing_params["static_collider"] = sim_params["static_collider"]
+        static_collider_params = preprocessing_params["static_collider"]
+        if not "density_threshold" in static_collider_params.keys():
+            static_collider_params["density_threshold"] = 5.0
 
-        if not "max_particles_num" in filling_params.keys():
-            filling_params["max_particles_num"] = 2000000
+        if not "surface" in static_collider_params.keys():
+            static_collider_params["surface"] = "sticky"
 
-        if not "max_partciels_per_cell" in filling_params.keys():
-            filling_params["max_partciels_per_cell"] = 1
+        if not "friction" in static_collider_params.keys():
+            static_collider_params["friction"] = 0.0
 
-        if not "search_exclude_direction" in filling_params.keys():
-            filling_params["search_exclude_direction"] = 5
+        if not "thickness" in static_collider_params.keys():
+            static_collider_params["thickness"] = 0.0
+    else:
+        preprocessing_params["static_collider"] = None
 
-        if not "ray_cast_direction" in filling_params.keys():
-            filling_params["ray_cast_direction"] = 4
+    # adaptive particle merging/splitting every "interval" frames
+    if "particle_resampling" in sim_params.keys():
+        preprocessing_params["particle_resampling"] = sim_params["particle_resampling"]
+        resampling_params = preprocessing_params["particle_resampling"]
+        if not "interval" in resampling_params.keys():
+            resampling_params["interval"] = 10
 
-        if not "boundary" in filling_params.keys():
-            filling_params["boundary"] = None
+        if not "max_particles_per_cell" in resampling_params.keys():
+            resampling_params["max_particles_per_cell"] = 8
 
-        if not "smooth" in filling_params.keys():
-            filling_params["smooth"] = False
-        
-        if not "visualize" in filling_params.keys():
-            filling_params["visualize"] = False
+        if not "split_extent" in resampling_params.keys():
+            resampling_params["split_extent"] = None
     else:
-        preprocessing_params["particle_filling"] = None
+        preprocessing_params["particle_resampling"] = None
+
+    # NaN/explosion guard, checked once per frame. on trigger "abort" stops with
+    # a report, "rollback" restores the frame's start and halves substep_dt
+    if "guard" in sim_params.keys():
+        preprocessing_params["guard"] = sim_params["guard"]
+        guard_params = preprocessing_params["guard"]
+        if not "mode" in guard_params.keys():
+            guard_params["mode"] = "rollback"
+
+        if not "max_retries" in guard_params.keys():
+            guard_params["max_retries"] = 4
+    else:
+        preprocessing_params["guard"] = None
+
+    # per-Gaussian material labels, one int per Gaussian of the checkpoint.
+    # labels are material ids (0 jelly, 1 metal, 2 sand, 3 foam, 4 snow, 5 plasticine)
+    # unless material_label_map maps them to material names, e.g. {"1": "sand"}
+    if "material_label_file" in sim_params.keys():
+        preprocessing_params["material_label_file"] = sim_params["material_label_file"]
+    else:
+        preprocessing_params["material_label_file"] = None
+
+    if "material_label_map" in sim_params.keys():
+        preprocessing_params["material_label_map"] = sim_params["material_label_map"]
+    else:
+        preprocessing_params["material_label_map"] = None
+
+    # spatially varying E / nu / density / yield_stress, as a voxel volume in MPM
+    # space (.npz with one (X, Y, Z) array per name, or a (C, X, Y, Z) .npy with
+    # channels in material_field_channels) covering origin..origin+size, or per
+    # Gaussian of the checkpoint (.npz of (N,) arrays or a (N, C) .npy)
+    if "material_field_file" in sim_params.keys():
+        preprocessing_params["material_field_file"] = sim_params["material_field_file"]
+    else:
+        preprocessing_params["material_field_file"] = None
+
+    if "material_field_origin" in sim_params.keys():
+        preprocessing_params["material_field_origin"] = sim_params[
+            "material_field_origin"
+        ]
+    else:
+        preprocessing_params["material_field_origin"] = None
+
+    if "material_field_size" in sim_params.keys():
+        preprocessing_params["material_field_size"] = sim_params["material_field_size"]
+    else:
+        preprocessing_params["material_field_size"] = None
+
+    if "material_param_file" in sim_params.keys():
+        preprocessing_params["material_param_file"] = sim_params["material_param_file"]
+    else:
+        preprocessing_params["material_param_file"] = None
+
+    if "material_field_channels" in sim_params.keys():
+        preprocessing_params["material_field_channels"] = sim_params[
+            "material_field_channels"
+        ]
+    else:
+        preprocessing_params["material_field_channels"] = [
+            "E",
+            "nu",
+            "density",
+            "yield_stress",
+        ]
 
     # camera params
     camera_params = {}
@@ -225,12 +360,117 @@ def decode_param_json(json_file):
         camera_params["move_camera"] = sim_params["move_camera"]
     else:
         camera_params["move_camera"] = False
+    # [{"frame", "azimuth", "elevation", "radius"}, ...], overrides move_camera
+    if "camera_keyframes" in sim_params.keys():
+        camera_params["keyframes"] = sim_params["camera_keyframes"]
+    else:
+        camera_params["keyframes"] = None
 
     return material_params, bc_params, time_params, preprocessing_params, camera_params
 
 
+# missing particle_filling values
+def set_filling_defaults(filling_params, material_params):
+    if not "n_grid" in filling_params.keys():
+        filling_params["n_grid"] = material_params["n_grid"] * 4
+
+    if not "density_threshold" in filling_params.keys():
+        filling_params["density_threshold"] = 5.0
+
+    if not "search_threshold" in filling_params.keys():
+        filling_params["search_threshold"] = 3.0
+
+    if not "max_particles_num" in filling_params.keys():
+        filling_params["max_particles_num"] = 2000000
+
+    if not "max_partciels_per_cell" in filling_params.keys():
+        filling_params["max_partciels_per_cell"] = 1
+
+    if not "search_exclude_direction" in filling_params.keys():
+        filling_params["search_exclude_direction"] = 5
+
+    if not "ray_cast_direction" in filling_params.keys():
+        filling_params["ray_cast_direction"] = 4
+
+    if not "boundary" in filling_params.keys():
+        filling_params["boundary"] = None
+
+    if not "smooth" in filling_params.keys():
+        filling_params["smooth"] = False
+
+    if not "visualize" in filling_params.keys():
+        filling_params["visualize"] = False
+    return filling_params
+
+
+# A scene manifest lists several Gaussian models that are simulated together:
+# {"objects": [{"model_path": ..., "name": ..., "rotation_degree": [...],
+#   "rotation_axis": [...], "scale": 1.0, "translation": [x, y, z],
+#   "material": {"material": "jelly", "E": ..., "nu": ..., "density": ...,
+#                "yield_stress": ...},
+#   "particle_filling": {...}}, ...]}
+# rotation, scale and translation place each model in the world space of
+# --model_path, whose cameras render the scene. Missing material values come
+# from the config, particle_filling defaults to the config's, null disables it.
+def decode_scene_manifest(manifest_file, material_params, filling_params):
+    with open(manifest_file) as f:
+        objects = json.load(f)["objects"]
+    for i, obj in enumerate(objects):
+        assert "model_path" in obj.keys()
+        if not "name" in obj.keys():
+            obj["name"] = "object_" + str(i)
+
+        if not "rotation_degree" in obj.keys():
+            obj["rotation_degree"] = []
+
+        if not "rotation_axis" in obj.keys():
+            obj["rotation_axis"] = []
+
+        if not "scale" in obj.keys():
+            obj["scale"] = 1.0
+
+        if not "translation" in obj.keys():
+            obj["translation"] = [0.0, 0.0, 0.0]
+
+        if not "material" in obj.keys():
+            obj["material"] = {}
+        for name in ["material", "E", "nu", "density", "yield_stress"]:
+            if not name in obj["material"].keys() and name in material_params.keys():
+                obj["material"][name] = material_params[name]
+
+        if not "particle_filling" in obj.keys():
+            obj["particle_filling"] = filling_params
+        if obj["particle_filling"] is not None:
+            obj["particle_filling"] = set_filling_defaults(
+                dict(obj["particle_filling"]), material_params
+            )
+    return objects
+
+
+# --preview: the simulation grid and the filling grid are divided by scale, and
+# frames become scale times longer so the same duration takes fewer frames.
+# substep_dt is raised separately once the material parameters are known.
+def get_preview_params(material_params, time_params, preprocessing_params, scale=2):
+    material_params["n_grid"] = max(material_params["n_grid"] // scale, 16)
+    filling_params = preprocessing_params["particle_filling"]
+    if filling_params is not None:
+        filling_params["n_grid"] = max(filling_params["n_grid"] // scale, 16)
+    if preprocessing_params["scene_objects"] is not None:
+        for obj in preprocessing_params["scene_objects"]:
+            if obj["particle_filling"] is not None:
+                n_grid = obj["particle_filling"]["n_grid"]
+                obj["particle_filling"]["n_grid"] = max(n_grid // scale, 16)
+    time_params["frame_dt"] = time_params["frame_dt"] * scale
+    time_params["frame_num"] = (time_params["frame_num"] + scale - 1) // scale
+    return material_params, time_params, preprocessing_params
+
+
+# world_to_mpm maps scene coordinates (n, 3) to simulation space, for meshes
 def set_boundary_conditions(
-    mpm_solver: MPM_Simulator_WARP, bc_params: dict, time_params: dict
+    mpm_solver: MPM_Simulator_WARP,
+    bc_params: dict,
+    time_params: dict,
+    world_to_mpm=None,
 ):
     for bc in bc_params:
         if bc["type"] == "cuboid":
@@ -312,6 +552,43 @@ def set_boundary_conditions(
                 start_time=bc["start_time"],
                 end_time=bc["end_time"],
             )
+        elif bc["type"] == "mesh_collider":
+            assert "mesh" in bc.keys()
+
+            surface = "sticky"
+            if "surface" in bc.keys():
+                surface = bc["surface"]
+            friction = 0.0
+            if "friction" in bc.keys():
+                friction = bc["friction"]
+            thickness = 0.0
+            if "thickness" in bc.keys():
+                thickness = bc["thickness"]
+            start_time = 0.0
+            if "start_time" in bc.keys():
+                start_time = bc["start_time"]
+            end_time = 1e3
+            if "end_time" in bc.keys():
+                end_time = bc["end_time"]
+            # "world": the mesh is in the coordinates of the Gaussians, "mpm": it
+            # is already in simulation space like the points of the other BCs
+            vertex_transform = None
+            if "mesh_space" not in bc.keys() or bc["mesh_space"] == "world":
+                vertex_transform = world_to_mpm
+            cache_dir = None
+            if "cache_dir" in bc.keys():
+                cache_dir = bc["cache_dir"]
+
+            mpm_solver.add_mesh_collider(
+                bc["mesh"],
+                surface=surface,
+                friction=friction,
+                thickness=thickness,
+                start_time=start_time,
+                end_time=end_time,
+                vertex_transform=vertex_transform,
+                cache_dir=cache_dir,
+            )
         elif bc["type"] == "release_particles_sequentially":
             assert "normal" in bc.keys()
             assert "start_position" in bc.keys()
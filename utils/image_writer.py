@@ -0,0 +1,135 @@
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+
+
+# Writes rendered (3, H, W) RGB images in [0, 1] to disk off the render loop.
+# write() copies the image into a reusable staging buffer (pinned when the
+# image is on the GPU, so the copy is asynchronous) and returns; a pool of
+# threads converts to BGR and encodes the PNG/JPEG, with cv2 releasing the GIL.
+# At most max_pending images are in flight: write() blocks once they are all
+# taken, which bounds the staging memory. flush() waits for every pending
+# image and raises the first encoding error. An image can also (or only, with
+# path None) go to a VideoStream; those are encoded on the stream's own thread
+# so its frames stay in order.
+class ImageWriter:
+    def __init__(self, num_workers=2, max_pending=8):
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = threading.Semaphore(max_pending)
+        self.lock = threading.Lock()
+        # free staging buffers by (shape, pinned)
+        self.staging = {}
+        self.futures = []
+
+    def get_staging_buffer(self, shape, pin_memory):
+        key = (tuple(shape), pin_memory)
+        with self.lock:
+            buffers = self.staging.setdefault(key, [])
+            if len(buffers) > 0:
+                return buffers.pop()
+        return torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory)
+
+    def release_staging_buffer(self, buffer, pin_memory):
+        with self.lock:
+            self.staging[(tuple(buffer.shape), pin_memory)].append(buffer)
+
+    def write(self, path, image, video=None):
+        self.pending.acquire()
+        pin_memory = image.is_cuda
+        buffer = self.get_staging_buffer(
+            (image.shape[1], image.shape[2], image.shape[0]), pin_memory
+        )
+        buffer.copy_(image.permute(1, 2, 0), non_blocking=pin_memory)
+        copied = None
+        if pin_memory:
+            copied = torch.cuda.Event()
+            copied.record()
+        # drop finished images, raising their errors early
+        futures = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                futures.append(future)
+        pool = self.pool if video is None else video.pool
+        futures.append(
+            pool.submit(self.encode, path, video, buffer, copied, pin_memory)
+        )
+        self.futures = futures
+
+    def encode(self, path, video, buffer, copied, pin_memory):
+        try:
+            if copied is not None:
+                copied.synchronize()
+            image = cv2.cvtColor(buffer.numpy(), cv2.COLOR_RGB2BGR)
+            image = np.clip(np.rint(255 * image), 0, 255).astype(np.uint8)
+            if path is not None and not cv2.imwrite(path, image):
+                raise IOError("Failed to write " + path)
+            if video is not None:
+                video.write(image)
+        finally:
+            self.release_staging_buffer(buffer, pin_memory)
+            self.pending.release()
+
+    def flush(self):
+        futures = self.futures
+        self.futures = []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+# H.264 video fed frame by frame: a local ffmpeg process is started on the
+# first frame and raw BGR frames are piped to its stdin, so nothing is read
+# back from disk. Frames are cropped to even sizes for yuv420p. Pass the
+# stream to ImageWriter.write; close() after the writer is flushed.
+class VideoStream:
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.process = None
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+    def write(self, image):
+        height, width = image.shape[:2]
+        if self.process is None:
+            self.process = subprocess.Popen(
+                [
+                    "ffmpeg",
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-f",
+                    "rawvideo",
+                    "-pix_fmt",
+                    "bgr24",
+                    "-s",
+                    f"{width}x{height}",
+                    "-framerate",
+                    str(self.fps),
+                    "-i",
+                    "-",
+                    "-vf",
+                    f"crop={width // 2 * 2}:{height // 2 * 2}:0:0",
+                    "-c:v",
+                    "libx264",
+                    "-pix_fmt",
+                    "yuv420p",
+                    self.path,
+                ],
+                stdin=subprocess.PIPE,
+            )
+        self.process.stdin.write(np.ascontiguousarray(image).tobytes())
+
+    def close(self):
+        self.pool.shutdown()
+        if self.process is not None:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise RuntimeError("ffmpeg failed to encode " + self.path)
@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+import torch
+
+
+# Overlaps the simulation with rendering. submit() copies the render state of a
+# frame (a dict of tensors, e.g. x, cov and R of the rendered particles) into
+# one of num_buffers snapshot buffers and returns, while a worker thread calls
+# render_fn(frame, snapshot) on it. With two buffers the solver fills one while
+# the other is rendered, and submit() only blocks when every buffer is still
+# being rendered. For CUDA tensors the worker renders on its own stream once
+# the copy has finished. Errors in render_fn are raised by the next submit()
+# or by close().
+class RenderPipeline:
+    def __init__(self, render_fn, num_buffers=2):
+        self.render_fn = render_fn
+        self.buffers = [None] * num_buffers
+        self.free = queue.Queue()
+        for index in range(num_buffers):
+            self.free.put(index)
+        self.jobs = queue.Queue()
+        self.stream = None
+        self.error = None
+
+        self.frames = 0
+        self.wait_time = 0.0
+        self.render_time = 0.0
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, frame, snapshot):
+        self.check_error()
+        start = time.perf_counter()
+        index = self.free.get()
+        self.wait_time += time.perf_counter() - start
+
+        buffer = self.buffers[index]
+        with torch.inference_mode():
+            if buffer is None or any(
+                buffer[name].shape != tensor.shape for name, tensor in snapshot.items()
+            ):
+                buffer = {
+                    name: torch.empty_like(tensor) for name, tensor in snapshot.items()
+                }
+                self.buffers[index] = buffer
+            for name, tensor in snapshot.items():
+                buffer[name].copy_(tensor)
+        copied = None
+        if any(tensor.is_cuda for tensor in snapshot.values()):
+            copied = torch.cuda.Event()
+            copied.record()
+        self.jobs.put((frame, index, copied))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            frame, index, copied = job
+            try:
+                if self.error is None:
+                    start = time.perf_counter()
+                    if copied is not None:
+                        if self.stream is None:
+                            self.stream = torch.cuda.Stream()
+                        self.stream.wait_event(copied)
+                        with torch.cuda.stream(self.stream):
+                            self.render_fn(frame, self.buffers[index])
+                        # the buffer is overwritten once it is free again
+                        self.stream.synchronize()
+                    else:
+                        self.render_fn(frame, self.buffers[index])
+                    self.render_time += time.perf_counter() - start
+                    self.frames += 1
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free.put(index)
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Rendering failed") from self.error
+
+    def close(self):
+        start = time.perf_counter()
+        self.jobs.put(None)
+        self.worker.join()
+        self.wait_time += time.perf_counter() - start
+        self.end_time = time.perf_counter()
+        self.check_error()
+
+    # Timings after close(): the simulation time is the wall time the producer
+    # was not blocked on the renderer, and overlap is the fraction of the render
+    # time that ran concurrently with it, 0 for a serial loop and 1 when
+    # rendering is fully hidden.
+    def stats(self):
+        wall_time = self.end_time - self.start_time
+        sim_time = wall_time - self.wait_time
+        overlap = 0.0
+        if self.render_time > 0:
+            overlap = (sim_time + self.render_time - wall_time) / self.render_time
+        return {
+            "frames": self.frames,
+            "wall_time": wall_time,
+            "sim_time": sim_time,
+            "render_time": self.render_time,
+            "overlap": min(max(overlap, 0.0), 1.0),
+        }
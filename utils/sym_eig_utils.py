@@ -0,0 +1,112 @@
+import torch
+
+
+# upper-triangular (n,6) covariance -> (n,3,3) symmetric matrix
+def cov3d_tensor_to_matrix(cov3d_tensor):
+    cov3d_tensor = cov3d_tensor.view(-1, 6)
+    cov3d_matrix = torch.zeros(
+        (cov3d_tensor.shape[0], 3, 3),
+        dtype=cov3d_tensor.dtype,
+        device=cov3d_tensor.device,
+    )
+    cov3d_matrix[:, 0, 0] = cov3d_tensor[:, 0]
+    cov3d_matrix[:, 0, 1] = cov3d_tensor[:, 1]
+    cov3d_matrix[:, 0, 2] = cov3d_tensor[:, 2]
+    cov3d_matrix[:, 1, 0] = cov3d_tensor[:, 1]
+    cov3d_matrix[:, 1, 1] = cov3d_tensor[:, 3]
+    cov3d_matrix[:, 1, 2] = cov3d_tensor[:, 4]
+    cov3d_matrix[:, 2, 0] = cov3d_tensor[:, 2]
+    cov3d_matrix[:, 2, 1] = cov3d_tensor[:, 4]
+    cov3d_matrix[:, 2, 2] = cov3d_tensor[:, 5]
+    return cov3d_matrix
+
+
+def sym_eig3x3(cov3d_tensor, sweeps=4):
+    """Batched eigen-decomposition of symmetric 3x3 matrices.
+
+    Cyclic Jacobi with a fixed number of sweeps, written on the six upper
+    entries so every rotation is a handful of elementwise ops over all
+    Gaussians at once. Four sweeps reach float32 round-off.
+
+    Args:
+        cov3d_tensor: (n, 6) upper-triangular entries [xx, xy, xz, yy, yz, zz].
+        sweeps: number of (0,1), (0,2), (1,2) rotation sweeps.
+
+    Returns:
+        eigvals: (n, 3) eigenvalues in ascending order.
+        eigvecs: (n, 3, 3) matching unit eigenvectors stored as columns.
+    """
+    cov = cov3d_tensor.reshape(-1, 6)
+    a = [[None] * 3 for _ in range(3)]
+    a[0][0], a[0][1], a[0][2] = cov[:, 0], cov[:, 1], cov[:, 2]
+    a[1][1], a[1][2], a[2][2] = cov[:, 3], cov[:, 4], cov[:, 5]
+    for i in range(3):
+        for j in range(i):
+            a[i][j] = a[j][i]
+
+    one = torch.ones_like(cov[:, 0])
+    zero = torch.zeros_like(cov[:, 0])
+    v = [[one if i == j else zero for j in range(3)] for i in range(3)]
+
+    tiny = torch.finfo(cov.dtype).tiny
+    for _ in range(sweeps):
+        for p, q in ((0, 1), (0, 2), (1, 2)):
+            r = 3 - p - q
+            apq = a[p][q]
+            active = apq.abs() > tiny
+            safe_apq = torch.where(active, apq, one)
+            theta = (a[q][q] - a[p][p]) / (2.0 * safe_apq)
+            t = torch.sign(theta) / (theta.abs() + torch.sqrt(theta * theta + 1.0))
+            # theta == 0 means a 45 degree rotation, sign() would give 0 there
+            t = torch.where(theta == 0.0, one, t)
+            t = torch.where(active, t, zero)
+            c = torch.rsqrt(t * t + 1.0)
+            s = t * c
+
+            app = a[p][p] - t * apq
+            aqq = a[q][q] + t * apq
+            arp = c * a[r][p] - s * a[r][q]
+            arq = s * a[r][p] + c * a[r][q]
+            a[p][p], a[q][q] = app, aqq
+            a[p][q] = a[q][p] = zero
+            a[r][p] = a[p][r] = arp
+            a[r][q] = a[q][r] = arq
+
+            for k in range(3):
+                vkp = v[k][p]
+                vkq = v[k][q]
+                v[k][p] = c * vkp - s * vkq
+                v[k][q] = s * vkp + c * vkq
+
+    eigvals = torch.stack([a[0][0], a[1][1], a[2][2]], dim=-1)
+    eigvecs = torch.stack([torch.stack(row, dim=-1) for row in v], dim=-2)
+
+    eigvals, order = torch.sort(eigvals, dim=-1)
+    eigvecs = torch.gather(eigvecs, 2, order.unsqueeze(1).expand(-1, 3, -1))
+    return eigvals, eigvecs
+
+
+# unit eigenvector of the smallest eigenvalue, (n,3)
+def get_min_variance_axis(cov3d_tensor, sweeps=4):
+    _, eigvecs = sym_eig3x3(cov3d_tensor, sweeps)
+    return eigvecs[:, :, 0]
+
+
+# inverse of a (n,6) covariance as (n,6) upper entries, eigenvalues clamped to eps
+# also returns the clamped eigenvalues, e.g. to bound the kernel radius
+def get_inverse_cov(cov3d_tensor, eps=1e-8, sweeps=4):
+    eigvals, eigvecs = sym_eig3x3(cov3d_tensor, sweeps)
+    eigvals = torch.clamp_min(eigvals, eps)
+    inv = torch.matmul(eigvecs * (1.0 / eigvals).unsqueeze(1), eigvecs.transpose(1, 2))
+    inv_upper = torch.stack(
+        [
+            inv[:, 0, 0],
+            inv[:, 0, 1],
+            inv[:, 0, 2],
+            inv[:, 1, 1],
+            inv[:, 1, 2],
+            inv[:, 2, 2],
+        ],
+        dim=-1,
+    )
+    return inv_upper, eigvals
@@ -0,0 +1,307 @@
+import json
+import os
+import queue
+import threading
+import zlib
+import numpy as np
+import torch
+
+
+# tensors in nested dicts and lists moved to device
+def to_device(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.detach().to(device)
+    if isinstance(value, dict):
+        return {key: to_device(item, device) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_device(item, device) for item in value]
+    return value
+
+
+# Everything rendering needs from a simulation, so it can be rendered again
+# (other cameras, background or environment map) without simulating: per frame
+# pos, cov3D and rot of the rendered Gaussians in solver space, and the static
+# render attributes once in static.pt. Frame f is row f of particles.npy, one
+# float32 array of shape (frame_num, num_particles, 18).
+class TrajectoryWriter:
+    fields = [("pos", 3), ("cov3D", 6), ("rot", 9)]
+
+    def __init__(self, path, frame_num, static):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.frame_num = frame_num
+        self.particles = None
+        self.frames = 0
+        torch.save(to_device(static, "cpu"), os.path.join(path, "static.pt"))
+
+    # particles as one (num_particles, 18) float32 array
+    def to_row(self, particles):
+        row = torch.cat(
+            [
+                particles[name].reshape(-1, width).float()
+                for name, width in self.fields
+            ],
+            dim=1,
+        )
+        return row.cpu().numpy()
+
+    def write(self, frame, particles):
+        row = self.to_row(particles)
+        if self.particles is None:
+            self.particles = np.lib.format.open_memmap(
+                os.path.join(self.path, "particles.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(self.frame_num,) + tuple(row.shape),
+            )
+        self.particles[frame] = row
+        self.frames = max(self.frames, frame + 1)
+
+    def get_info(self):
+        return {"frames": self.frames}
+
+    def close(self):
+        if self.particles is not None:
+            self.particles.flush()
+        with open(os.path.join(self.path, "trajectory.json"), "w") as f:
+            json.dump(self.get_info(), f)
+
+
+# The same content as TrajectoryWriter in a fraction of the space. Every
+# keyframe_interval frames a keyframe is stored in full float32; the frames in
+# between store their difference to that keyframe, quantized with a step of
+# twice the error bound of each field and offset by the per-channel minimum of
+# every block of block_size particles (the block's bounding box). The codes of
+# each field take the narrowest unsigned type that fits its largest block range
+# in the frame, and every frame can also be compressed with zlib. A frame
+# decodes from its keyframe and its own delta, so any frame can be read
+# directly, and every value is within error_bounds[field] of the simulated one
+# (up to float32 rounding). Frames are appended to frames.bin, index.npy holds
+# where each one starts.
+class CompactTrajectoryWriter(TrajectoryWriter):
+    index_dtype = np.dtype(
+        [
+            ("offset", np.int64),
+            ("size", np.int64),
+            ("keyframe", np.int64),
+            # bytes per code of each field, 0 for keyframes
+            ("itemsize", np.int64, (len(TrajectoryWriter.fields),)),
+        ]
+    )
+
+    def __init__(
+        self,
+        path,
+        frame_num,
+        static,
+        keyframe_interval=10,
+        error_bounds=None,
+        block_size=4096,
+        compress=False,
+    ):
+        super().__init__(path, frame_num, static)
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1")
+        self.keyframe_interval = keyframe_interval
+        self.error_bounds = {"pos": 1e-4, "cov3D": 1e-8, "rot": 1e-3}
+        if error_bounds is not None:
+            self.error_bounds.update(error_bounds)
+        self.block_size = block_size
+        self.compress = compress
+        self.steps = np.concatenate(
+            [
+                np.full(width, 2.0 * self.error_bounds[name], dtype=np.float32)
+                for name, width in self.fields
+            ]
+        )
+
+        self.data = open(os.path.join(path, "frames.bin"), "wb")
+        self.offset = 0
+        self.index = np.zeros(frame_num, dtype=self.index_dtype)
+        self.num_particles = None
+        self.keyframe = None
+        self.keyframe_frame = None
+
+    def write(self, frame, particles):
+        row = self.to_row(particles)
+        if self.num_particles is None:
+            self.num_particles = row.shape[0]
+        elif row.shape[0] != self.num_particles:
+            raise ValueError(
+                "Frame {} has {} particles, the trajectory has {}".format(
+                    frame, row.shape[0], self.num_particles
+                )
+            )
+
+        keyframe = frame - frame % self.keyframe_interval
+        if frame == keyframe:
+            self.keyframe = row
+            self.keyframe_frame = frame
+            chunk = row.tobytes()
+            itemsize = [0] * len(self.fields)
+        else:
+            if self.keyframe_frame != keyframe:
+                raise ValueError(
+                    "Frame {} is written before its keyframe {}".format(frame, keyframe)
+                )
+            delta = row - self.keyframe
+            starts = np.arange(0, delta.shape[0], self.block_size)
+            mins = np.minimum.reduceat(delta, starts, axis=0)
+            block = np.arange(delta.shape[0]) // self.block_size
+            codes = np.maximum(np.rint((delta - mins[block]) / self.steps), 0)
+            chunks = [mins.tobytes()]
+            itemsize = []
+            start = 0
+            for name, width in self.fields:
+                field_codes = codes[:, start : start + width]
+                top = field_codes.max() if field_codes.size > 0 else 0
+                for dtype in [np.uint8, np.uint16, np.uint32]:
+                    if top <= np.iinfo(dtype).max:
+                        break
+                else:
+                    raise ValueError(
+                        "The {} error bound is too small for frame {}".format(
+                            name, frame
+                        )
+                    )
+                chunks.append(field_codes.astype(dtype).tobytes())
+                itemsize.append(np.dtype(dtype).itemsize)
+                start += width
+            chunk = b"".join(chunks)
+        if self.compress:
+            chunk = zlib.compress(chunk)
+
+        self.data.write(chunk)
+        self.index[frame] = (self.offset, len(chunk), keyframe, itemsize)
+        self.offset += len(chunk)
+        self.frames = max(self.frames, frame + 1)
+
+    def get_info(self):
+        return {
+            "frames": self.frames,
+            "format": "compact",
+            "num_particles": self.num_particles,
+            "keyframe_interval": self.keyframe_interval,
+            "block_size": self.block_size,
+            "error_bounds": self.error_bounds,
+            "compress": self.compress,
+        }
+
+    def close(self):
+        self.data.close()
+        np.save(os.path.join(self.path, "index.npy"), self.index[: self.frames])
+        super().close()
+
+
+# Random access to a cache written by TrajectoryWriter or
+# CompactTrajectoryWriter; the frame data is memory-mapped, so only the frames
+# that are read (and their keyframes) are loaded from disk.
+class TrajectoryReader:
+    def __init__(self, path):
+        info_file = os.path.join(path, "trajectory.json")
+        if not os.path.exists(info_file):
+            raise ValueError(path + " is not a complete trajectory cache")
+        with open(info_file) as f:
+            self.info = json.load(f)
+        self.frame_num = self.info["frames"]
+        self.compact = "format" in self.info.keys() and self.info["format"] == "compact"
+        self.static = torch.load(os.path.join(path, "static.pt"))
+        if self.compact:
+            self.index = np.load(os.path.join(path, "index.npy"))
+            self.data = None
+            if self.frame_num > 0:
+                self.data = np.memmap(
+                    os.path.join(path, "frames.bin"), dtype=np.uint8, mode="r"
+                )
+            self.steps = np.concatenate(
+                [
+                    np.full(
+                        width, 2.0 * self.info["error_bounds"][name], dtype=np.float32
+                    )
+                    for name, width in TrajectoryWriter.fields
+                ]
+            )
+            # the last decoded keyframe, (frame, row)
+            self.keyframe = (None, None)
+        else:
+            self.particles = np.load(
+                os.path.join(path, "particles.npy"), mmap_mode="r"
+            )
+
+    def __len__(self):
+        return self.frame_num
+
+    def split(self, row):
+        particles = {}
+        start = 0
+        for name, width in TrajectoryWriter.fields:
+            particles[name] = row[:, start : start + width]
+            start += width
+        particles["rot"] = particles["rot"].reshape(-1, 3, 3)
+        return particles
+
+    def load(self, frame, pin_memory=False):
+        if frame < 0 or frame >= self.frame_num:
+            raise ValueError(
+                "Frame {} is not in the cache ({} frames)".format(frame, self.frame_num)
+            )
+        if self.compact:
+            row = torch.from_numpy(self.decode(frame))
+        else:
+            row = torch.from_numpy(np.array(self.particles[frame]))
+        return row.pin_memory() if pin_memory else row
+
+    def get_chunk(self, frame):
+        offset, size, keyframe, itemsize = self.index[frame]
+        chunk = self.data[offset : offset + size]
+        if self.info["compress"]:
+            chunk = np.frombuffer(zlib.decompress(chunk), dtype=np.uint8)
+        return chunk, keyframe, itemsize
+
+    def decode(self, frame):
+        n = self.info["num_particles"]
+        channels = self.steps.shape[0]
+        chunk, keyframe, itemsize = self.get_chunk(frame)
+        if itemsize[0] == 0:
+            return chunk.view(np.float32).reshape(n, channels).copy()
+
+        keyframe_frame, keyframe_row = self.keyframe
+        if keyframe_frame != keyframe:
+            keyframe_row = self.decode(keyframe)
+            self.keyframe = (keyframe, keyframe_row)
+        num_blocks = (n + self.info["block_size"] - 1) // self.info["block_size"]
+        offset = num_blocks * channels * 4
+        mins = chunk[:offset].view(np.float32).reshape(num_blocks, channels)
+        codes = []
+        for (name, width), size in zip(TrajectoryWriter.fields, itemsize):
+            end = offset + n * width * size
+            codes.append(chunk[offset:end].view("u" + str(size)).reshape(n, width))
+            offset = end
+        codes = np.concatenate(codes, axis=1)
+        block = np.arange(n) // self.info["block_size"]
+        return (keyframe_row + mins[block] + codes * self.steps).astype(np.float32)
+
+    def read(self, frame, device="cpu"):
+        return self.split(self.load(frame).to(device))
+
+    # (frame, particles) for frames, read ahead by up to depth frames on a
+    # background thread
+    def prefetch(self, frames, device="cpu", depth=2):
+        frames = list(frames)
+        pin_memory = torch.device(device).type == "cuda"
+        loaded = queue.Queue(maxsize=depth)
+
+        def load_frames():
+            for frame in frames:
+                try:
+                    loaded.put((frame, self.load(frame, pin_memory=pin_memory)))
+                except Exception as e:
+                    loaded.put((frame, e))
+                    return
+
+        threading.Thread(target=load_frames, daemon=True).start()
+        for _ in frames:
+            frame, row = loaded.get()
+            if isinstance(row, Exception):
+                raise row
+            yield frame, self.split(row.to(device, non_blocking=pin_memory))